@@ -0,0 +1,301 @@
+"""
+Block-compressed, seekable storage for integer audio
+
+Copyright 2015 Justin Palpant
+
+This file is part of the Jarvis Lab Audio Analysis program.
+
+Audio Analysis is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+Audio Analysis is distributed in the hope that it will be useful, but WITHOUT
+ANYWARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Audio Analysis. If not, see http://www.gnu.org/licenses/.
+"""
+import os
+import json
+import zlib
+import struct
+import logging
+
+import scipy.io.wavfile
+import numpy as np
+
+
+def _encode(block):
+    """Losslessly pack a (frames, channels) int16 block into bytes
+
+    Samples are replaced by their difference from the previous sample, which
+    wraps around in int16 and so is exactly reversible, and the low and high
+    bytes are stored in separate planes before zlib compression.  Both steps
+    make audio far more compressible than raw samples.
+    """
+    delta = np.diff(block, axis=0, prepend=np.zeros((1,) + block.shape[1:],
+                                                    dtype=block.dtype))
+    planes = delta.astype('<i2').view(np.uint8).reshape(-1, 2).T
+
+    return planes.tobytes()
+
+
+def _decode(raw, shape):
+    planes = np.frombuffer(raw, dtype=np.uint8).reshape(2, -1)
+    delta = planes.T.copy().view('<i2').reshape(shape)
+
+    return np.cumsum(delta, axis=0, dtype=np.int16)
+
+
+class BlockAudioFile(object):
+    """Read access to audio stored by BlockAudioWriter
+
+    The file holds int16 samples in fixed-size blocks of frames, each
+    compressed on its own, followed by a JSON header (sampling rate, scale,
+    channels, block size, frame count and any extra metadata), a table of
+    block offsets, the length of both as an 8-byte little-endian integer,
+    and a closing magic string.  Reading a time range decompresses only the
+    blocks it touches.
+    """
+    logger = logging.getLogger('JLAA.BlockAudioFile')
+
+    MAGIC = b'JLAABLK1'
+    EXTENSION = '.blk'
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        footer = len(self.MAGIC) + 8
+        with open(filename, 'rb') as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError('{0} is not a block audio file'.format(
+                    filename))
+
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            table_len = None
+            if size >= len(self.MAGIC) + footer:
+                f.seek(-footer, os.SEEK_END)
+                (table_len,) = struct.unpack('<Q', f.read(8))
+                if f.read(len(self.MAGIC)) != self.MAGIC:
+                    table_len = None
+            if table_len is None or table_len > size - len(self.MAGIC) - footer:
+                raise ValueError('Block audio file {0} is incomplete; it was '
+                        'not closed after writing'.format(filename))
+
+            f.seek(-footer - table_len, os.SEEK_END)
+            (header_len,) = struct.unpack('<Q', f.read(8))
+            self.header = json.loads(f.read(header_len).decode('utf-8'))
+            self.offsets = np.frombuffer(
+                f.read(table_len - 8 - header_len), dtype='<u8')
+
+        self._file = None
+        self._cached = (None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @property
+    def Fs(self):
+        return self.header['Fs']
+
+    @property
+    def scale(self):
+        """The float value of one integer step"""
+        return self.header['scale']
+
+    @property
+    def channels(self):
+        return self.header['channels']
+
+    @property
+    def block_size(self):
+        return self.header['block_size']
+
+    def __len__(self):
+        """The number of frames"""
+        return self.header['frames']
+
+    @property
+    def duration(self):
+        return len(self) / float(self.Fs)
+
+    def block(self, i):
+        """The (frames, channels) int16 samples of block i"""
+        if self._cached[0] == i:
+            return self._cached[1]
+
+        if self._file is None:
+            self._file = open(self.filename, 'rb')
+
+        self._file.seek(int(self.offsets[i]))
+        raw = zlib.decompress(
+            self._file.read(int(self.offsets[i + 1] - self.offsets[i])))
+
+        frames = min(self.block_size, len(self) - i * self.block_size)
+        samples = _decode(raw, (frames, self.channels))
+        self._cached = (i, samples)
+
+        return samples
+
+    def read(self, first=0, last=None):
+        """int16 frames [first, last), shaped (frames,) for mono audio and
+        (frames, channels) otherwise"""
+        n = len(self)
+        last = n if last is None else min(n, last)
+        first = max(0, first)
+
+        out = np.empty((max(0, last - first), self.channels), dtype=np.int16)
+        pos = first
+        while pos < last:
+            i = pos // self.block_size
+            block = self.block(i)
+            lo = pos - i * self.block_size
+            hi = min(block.shape[0], last - i * self.block_size)
+            out[pos - first:pos - first + hi - lo] = block[lo:hi]
+            pos += hi - lo
+
+        if self.channels == 1:
+            return out[:, 0]
+        return out
+
+    def read_time(self, t0, t1):
+        """int16 frames between times t0 and t1, in seconds"""
+        return self.read(int(t0 * self.Fs), int(np.ceil(t1 * self.Fs)))
+
+    @classmethod
+    def from_wav(cls, wav_filename, filename, block_size=65536, **metadata):
+        """Compress a WAV file of integer samples into a block audio file
+
+        The WAV file is read through a memory map, one block at a time.
+        Returns the opened BlockAudioFile.
+        """
+        rate, data = scipy.io.wavfile.read(wav_filename, mmap=True)
+        if data.dtype != np.int16:
+            raise TypeError('Only int16 WAV files can be stored as block '
+                            'audio, not {0}'.format(data.dtype))
+
+        with BlockAudioWriter(filename, rate, block_size=block_size,
+                              channels=1 if data.ndim == 1 else data.shape[1],
+                              **metadata) as writer:
+            for start in range(0, data.shape[0], block_size):
+                writer.write(data[start:start + block_size])
+
+        return cls(filename)
+
+
+class BlockAudioWriter(object):
+    """Writes int16 audio to a BlockAudioFile, block by block
+
+    Samples may be written in pieces of any length.  Unless a scale is given,
+    the stored scale is one over the peak sample, which is how SongFile.load
+    scales WAV files.  Use as a context manager, or call close() when done.
+    """
+    logger = logging.getLogger('JLAA.BlockAudioWriter')
+
+    def __init__(self, filename, Fs, block_size=65536, channels=1, scale=None,
+                 level=6, **metadata):
+        """Create a BlockAudioWriter
+
+        Inputs:
+            filename: the file to write
+            Fs: the sampling rate
+        Keyword Arguments:
+            block_size: frames per compressed block; the unit of random access
+            channels: the number of interleaved channels
+            scale: the float value of one integer step
+            level: the zlib compression level
+            metadata: extra JSON-serializable entries for the header
+        """
+        self.outfile = open(filename, 'wb')
+        self.outfile.write(BlockAudioFile.MAGIC)
+
+        self.header = dict(metadata)
+        self.header.update({
+            'Fs': float(Fs),
+            'channels': int(channels),
+            'block_size': int(block_size),
+            'scale': scale,
+        })
+        self.level = level
+
+        self.offsets = [self.outfile.tell()]
+        self.frames = 0
+        self.peak = 0
+        self._pending = []
+        self._pending_frames = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, samples):
+        """Append int16 frames, shaped (frames,) or (frames, channels)"""
+        samples = np.asarray(samples)
+        if samples.dtype != np.int16:
+            raise TypeError('Block audio stores int16 samples, not '
+                            '{0}'.format(samples.dtype))
+        if samples.ndim == 1:
+            samples = samples[:, np.newaxis]
+        if samples.shape[1] != self.header['channels']:
+            raise ValueError('Expected {0} channels, got {1}'.format(
+                self.header['channels'], samples.shape[1]))
+
+        if samples.size:
+            self.peak = max(self.peak, int(np.amax(samples)))
+
+        self._pending.append(samples)
+        self._pending_frames += samples.shape[0]
+
+        block_size = self.header['block_size']
+        if self._pending_frames >= block_size:
+            pending = np.concatenate(self._pending)
+            full = (pending.shape[0] // block_size) * block_size
+            for start in range(0, full, block_size):
+                self._write_block(pending[start:start + block_size])
+            self._pending = [pending[full:]]
+            self._pending_frames = pending.shape[0] - full
+
+    def _write_block(self, block):
+        self.outfile.write(zlib.compress(_encode(block), self.level))
+        self.offsets.append(self.outfile.tell())
+        self.frames += block.shape[0]
+
+    def close(self):
+        """Write the last partial block and the header"""
+        if self.outfile is None:
+            return
+
+        if self._pending_frames:
+            self._write_block(np.concatenate(self._pending))
+        self._pending = []
+
+        self.header['frames'] = self.frames
+        if self.header['scale'] is None:
+            self.header['scale'] = 1.0 / self.peak if self.peak > 0 else 1.0
+
+        header = json.dumps(self.header).encode('utf-8')
+        table = np.asarray(self.offsets, dtype='<u8').tobytes()
+
+        self.outfile.write(struct.pack('<Q', len(header)))
+        self.outfile.write(header)
+        self.outfile.write(table)
+        self.outfile.write(struct.pack('<Q', 8 + len(header) + len(table)))
+        self.outfile.write(BlockAudioFile.MAGIC)
+        self.outfile.close()
+        self.outfile = None
+
+        self.logger.info('Wrote %d frames in %d blocks', self.frames,
+                len(self.offsets) - 1)
@@ -0,0 +1,200 @@
+"""
+Cheap feature-based first stage for cascaded frame classification
+
+Copyright 2015 Justin Palpant
+
+This file is part of the Jarvis Lab Audio Analysis program.
+
+Audio Analysis is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+Audio Analysis is distributed in the hope that it will be useful, but WITHOUT
+ANYWARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Audio Analysis. If not, see http://www.gnu.org/licenses/.
+"""
+import os
+import logging
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import numpy as np
+
+from sklearn.linear_model import LogisticRegression
+from sklearn.preprocessing import StandardScaler
+
+from audioanalysis.normalization import NormalizationStats
+
+
+def frame_features(sf, Sxx, idx=None, bands=4, chunk_cols=8192):
+    """Per-frame features of a processed SongFile
+
+    Returns a (frames, bands + 2) float64 array holding, for each frame in idx
+    (all frames by default), its log10 power, its entropy and the log10
+    energy in each of bands equal-width frequency bands of Sxx.
+    """
+    if idx is None:
+        idx = np.arange(Sxx.shape[1])
+    idx = np.asarray(idx)
+
+    log_power = NormalizationStats.log_power
+    edges = np.linspace(0, Sxx.shape[0], bands + 1).astype(int)[:-1]
+
+    features = np.empty((idx.size, bands + 2))
+    features[:, 0] = log_power(np.asarray(sf.power, dtype=np.float64)[idx])
+    features[:, 1] = np.asarray(sf.entropy, dtype=np.float64)[idx]
+
+    for start in range(0, idx.size, chunk_cols):
+        cols = idx[start:start + chunk_cols]
+        energy = np.add.reduceat(Sxx[:, cols], edges, axis=0, dtype=np.float64)
+        features[start:start + cols.size, 2:] = log_power(energy).T
+
+    return features
+
+
+class CascadeClassifier(object):
+    """A logistic regression over frame features that settles easy frames
+
+    The cascade runs ahead of the neural net.  Frames whose most probable
+    class has a probability of at least threshold are settled here; the rest
+    are deferred to the neural net.  fit() chooses the threshold on held-out
+    frames as the lowest one whose settled frames are still classified with
+    the target accuracy, so the fraction deferred adapts to how separable the
+    data is.
+    """
+    logger = logging.getLogger('JLAA.CascadeClassifier')
+
+    FILENAME = 'cascade.pkl'
+
+    def __init__(self, bands=4, accuracy=0.98, C=1.0):
+        """Create an untrained CascadeClassifier
+
+        Keyword Arguments:
+            bands: the number of frequency band energies used as features
+            accuracy: the accuracy required of settled frames
+            C: the inverse regularization strength of the regression
+        """
+        self.bands = bands
+        self.accuracy = accuracy
+
+        self.scaler = StandardScaler()
+        self.model = LogisticRegression(C=C)
+        self.num_classes = None
+        self.threshold = np.inf
+
+        # filled in by evaluate()
+        self.report = {}
+
+    def features(self, sf, Sxx, idx=None):
+        return frame_features(sf, Sxx, idx, self.bands)
+
+    def fit(self, X, y, calibration_split=0.25):
+        """Train on features X and integer labels y
+
+        A random calibration_split of the frames is held out of the fit and
+        used to choose the threshold.
+        """
+        y = np.asarray(y).astype(int)
+        order = np.random.permutation(y.size)
+        held = int(round(y.size * calibration_split))
+        fit_idx, cal_idx = order[held:], order[:held]
+
+        self.num_classes = int(np.amax(y)) + 1
+        self.scaler.fit(X[fit_idx])
+        self.model.fit(self.scaler.transform(X[fit_idx]), y[fit_idx])
+
+        self.calibrate(X[cal_idx] if held else X, y[cal_idx] if held else y)
+
+        return self
+
+    def calibrate(self, X, y):
+        """Choose the threshold meeting the target accuracy on X and y"""
+        prbs = self.predict_proba(X)
+        confidence = np.amax(prbs, axis=1)
+        correct = np.argmax(prbs, axis=1) == np.asarray(y)
+
+        order = np.argsort(-confidence, kind='mergesort')
+        running = np.cumsum(correct[order]) / np.arange(1.0, y.size + 1)
+        ok = np.flatnonzero(running >= self.accuracy)
+
+        if ok.size:
+            self.threshold = float(confidence[order[ok[-1]]])
+        else:
+            self.threshold = np.inf
+
+        self.logger.info('Cascade threshold %g settles %d of %d calibration '
+                'frames', self.threshold, ok[-1] + 1 if ok.size else 0, y.size)
+
+    def predict_proba(self, X):
+        """Class probabilities, with a column for every class up to the
+        largest label seen in fit"""
+        prbs = np.zeros((X.shape[0], self.num_classes))
+        if X.shape[0]:
+            prbs[:, self.model.classes_] = self.model.predict_proba(
+                self.scaler.transform(X))
+        return prbs
+
+    def settle(self, X):
+        """Return (probabilities, settled) for the frames of X
+
+        settled is a boolean array, False for frames to defer to the net.
+        """
+        prbs = self.predict_proba(X)
+        return prbs, np.amax(prbs, axis=1) >= self.threshold
+
+    def evaluate(self, X, y, net_prbs):
+        """Compare the cascade with the neural net alone on labeled frames
+
+        Inputs:
+            X: frame features
+            y: the true labels
+            net_prbs: the neural net's (frames, classes) probabilities
+
+        Returns and stores in self.report a dict of the deferred fraction,
+        the accuracy of the net alone and of the cascade, and the change
+        """
+        y = np.asarray(y).astype(int)
+        prbs, settled = self.settle(X)
+
+        net_classes = np.argmax(net_prbs, axis=1)
+        cascade_classes = np.where(settled, np.argmax(prbs, axis=1),
+                                   net_classes)
+
+        net_accuracy = float(np.mean(net_classes == y)) if y.size else 0.0
+        accuracy = float(np.mean(cascade_classes == y)) if y.size else 0.0
+
+        self.report = {
+            'frames': int(y.size),
+            'deferred': float(np.mean(~settled)) if y.size else 0.0,
+            'net_accuracy': net_accuracy,
+            'cascade_accuracy': accuracy,
+            'accuracy_change': accuracy - net_accuracy,
+        }
+
+        self.logger.info('Cascade defers %.1f%% of %d frames; accuracy %.4f '
+                'against %.4f for the neural net alone',
+                100 * self.report['deferred'], y.size, accuracy, net_accuracy)
+
+        return self.report
+
+    def save(self, folder):
+        """Write the trained cascade to folder"""
+        with open(os.path.join(folder, self.FILENAME), 'wb') as f:
+            pickle.dump(self, f, protocol=2)
+
+    @classmethod
+    def load(cls, folder):
+        """Read a cascade written by save, or return None if there is none"""
+        path = os.path.join(folder, cls.FILENAME)
+        if not os.path.exists(path):
+            return None
+
+        with open(path, 'rb') as f:
+            return pickle.load(f)
@@ -0,0 +1,375 @@
+"""
+Out-of-core training datasets stored as memory mapped .npy shards
+
+Copyright 2015 Justin Palpant
+
+This file is part of the Jarvis Lab Audio Analysis program.
+
+Audio Analysis is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+Audio Analysis is distributed in the hope that it will be useful, but WITHOUT
+ANYWARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Audio Analysis. If not, see http://www.gnu.org/licenses/.
+"""
+import os
+import json
+import logging
+import multiprocessing
+
+import numpy as np
+
+from audioanalysis.freqanalysis import AudioAnalyzer
+from audioanalysis.normalization import NormalizationStats
+
+
+INDEX_FILENAME = 'index.json'
+
+
+def _song_stats(task):
+    """Gather normalization statistics for one SongFile in a worker process"""
+    params, sf, mode = task
+
+    stats = NormalizationStats(mode)
+    stats.update(AudioAnalyzer(**params).process(sf))
+
+    return stats
+
+
+def _build_song_shards(task):
+    """Process one labeled SongFile and write its samples into the shards
+
+    Runs in a worker process, so it takes and returns only picklable values.
+    The shards are created by DatasetBuilder.build; placement lists
+    (first, last, offset) for each block of the song's frames, offset being
+    the block's position in the dataset.  Samples are built at most
+    shard_size frames at a time.  Returns the number of samples written.
+    """
+    (params, normalization, sf, destination, names, shard_size,
+     placement) = task
+
+    analyzer = AudioAnalyzer(**params)
+    analyzer.normalization = normalization
+    analyzer.set_active(sf)
+
+    frames = sf.time.size
+    expected = placement[-1][1] if placement else 0
+    if frames != expected:
+        raise ValueError('{0} has {1} frames, but {2} were planned'.format(
+            str(sf), frames, expected))
+
+    y = analyzer.get_classification(np.arange(frames)).astype(np.int32)
+
+    # scale every chunk as the whole song would be scaled in one request
+    bounds = analyzer.sample_bounds() if normalization is None else None
+
+    maps = {}
+    try:
+        pos = 0
+        while pos < len(placement):
+            # a run of blocks covering at most shard_size frames
+            first = placement[pos][0]
+            end = pos + 1
+            while (end < len(placement) and
+                   placement[end][1] - first <= shard_size):
+                end += 1
+
+            X = analyzer.get_data_sample(
+                np.arange(first, placement[end - 1][1]), bounds=bounds)
+            for b_first, b_last, offset in placement[pos:end]:
+                _write_samples(destination, names, shard_size, maps, offset,
+                               X[b_first - first:b_last - first],
+                               y[b_first:b_last])
+            del X
+            pos = end
+    finally:
+        for X_map, y_map in maps.values():
+            X_map.flush()
+            y_map.flush()
+
+    return frames
+
+
+def _write_samples(destination, names, shard_size, maps, offset, X, y):
+    """Write samples X and labels y at dataset position offset
+
+    The write is split where it crosses into the next shard.  maps caches
+    the shards opened for writing.
+    """
+    done = 0
+    while done < y.size:
+        n, start = divmod(offset + done, shard_size)
+        count = min(y.size - done, shard_size - start)
+
+        if n not in maps:
+            maps[n] = tuple(np.load(os.path.join(destination, name),
+                                    mmap_mode='r+') for name in names[n])
+        X_map, y_map = maps[n]
+
+        X_map[start:start + count] = X[done:done + count]
+        y_map[start:start + count] = y[done:done + count]
+        done += count
+
+
+class DatasetBuilder(object):
+    """Writes windowed, normalized samples from labeled SongFiles to shards
+
+    Each SongFile is processed exactly as AudioAnalyzer.train_neural_net would
+    process it, but instead of being held in memory the samples and their
+    integer labels are written to .npy shards of shard_size samples (the
+    last may be shorter).  The shards hold blocks of block_size consecutive
+    frames from every song in random order, so a shard, and a batch drawn
+    from it, mixes all the recordings.  An index file describing the shards
+    is written alongside them, and the result can be opened with
+    ShardedDataset for any number of training runs.
+    """
+    logger = logging.getLogger('JLAA.DatasetBuilder')
+
+    def __init__(self, destination, shard_size=65536, block_size=1024,
+                 **params):
+        """Create a DatasetBuilder
+
+        Inputs:
+            destination: an existing folder for the shards and index
+        Keyword Arguments:
+            shard_size: the number of samples in one shard
+            block_size: the number of consecutive frames of a song kept
+                together in a shard
+            All other keyword arguments are AudioAnalyzer parameters used to
+            process the songs and build the samples
+        """
+        self.destination = destination
+        self.shard_size = shard_size
+        self.block_size = block_size
+        self.params = params
+
+    def build(self, songfiles, processes=None, normalization=None):
+        """Process and write every SongFile, then write the index
+
+        Inputs:
+            songfiles: a list of SongFiles with classifications
+        Keyword Arguments:
+            processes: the number of worker processes.  Defaults to the number
+                of CPUs; 1 builds in the calling process.
+            normalization: a NormalizationStats used to scale the samples, or
+                a mode ('minmax' or 'standard') to gather statistics over
+                songfiles first.  The statistics are saved with the shards.
+                If None, each song is scaled by its own min and max.
+
+        Returns a ShardedDataset for the written shards
+        """
+        if isinstance(normalization, str):
+            self.logger.info('Gathering %s normalization statistics from %d '
+                    'songs', normalization, len(songfiles))
+            stats = NormalizationStats(normalization)
+            for song_stats in self._map(
+                    _song_stats, [(self.params, sf, normalization)
+                                  for sf in songfiles], processes):
+                stats.merge(song_stats)
+            normalization = stats
+
+        analyzer = AudioAnalyzer(**self.params)
+        frames, sample_shape = self._plan(analyzer, songfiles)
+        if not sum(frames):
+            raise ValueError('No samples were produced, cannot build dataset')
+
+        shards = self._create_shards(sum(frames), sample_shape,
+                                     analyzer.processing_dtype())
+        names = [(shard['data'], shard['labels']) for shard in shards]
+
+        tasks = [(self.params, normalization, sf, self.destination, names,
+                  self.shard_size, placement)
+                 for sf, placement in zip(songfiles, self._layout(frames))]
+
+        self.logger.info('Building dataset of %d samples from %d songs in %s',
+                sum(frames), len(tasks), self.destination)
+
+        self._map(_build_song_shards, tasks, processes)
+
+        num_classes = 1 + max(
+            int(np.amax(np.load(os.path.join(self.destination, s['labels']),
+                                mmap_mode='r')))
+            for s in shards)
+
+        index = {
+            'sample_shape': list(sample_shape),
+            'dtype': analyzer.processing_dtype().str,
+            'num_classes': num_classes,
+            'num_samples': sum(frames),
+            'shards': shards,
+            'songs': [{'song': str(sf), 'size': n}
+                      for sf, n in zip(songfiles, frames)],
+        }
+
+        if normalization is not None:
+            normalization.save(self.destination)
+
+        with open(os.path.join(self.destination, INDEX_FILENAME), 'w') as f:
+            json.dump(index, f, indent=1)
+
+        self.logger.info('Wrote %d samples in %d shards',
+                index['num_samples'], len(shards))
+
+        return ShardedDataset(self.destination)
+
+    def _plan(self, analyzer, songfiles):
+        """The number of frames of each song and the shape of one sample"""
+        frames = []
+        shapes = set()
+        for sf in songfiles:
+            plan = analyzer.plan_processing(sf)
+            frames.append(plan['frames'])
+            shapes.add((1, self.params.get('img_rows', plan['nfft'] // 2),
+                        self.params.get('img_cols', 1)))
+
+        if len(shapes) > 1:
+            self.logger.error('Songs give samples of shapes %s', str(shapes))
+            raise ValueError('All songs must give samples of one shape; use '
+                             'one sampling rate or set img_rows')
+
+        return frames, shapes.pop() if shapes else None
+
+    def _create_shards(self, num_samples, sample_shape, dtype):
+        """Create the empty shard files and return their index entries"""
+        shards = []
+        for n, start in enumerate(range(0, num_samples, self.shard_size)):
+            size = min(self.shard_size, num_samples - start)
+            entry = {
+                'data': 'shard{0:05d}_X.npy'.format(n),
+                'labels': 'shard{0:05d}_y.npy'.format(n),
+                'size': size,
+            }
+
+            for name, shape, shard_dtype in (
+                    (entry['data'], (size,) + tuple(sample_shape), dtype),
+                    (entry['labels'], (size,), np.int32)):
+                shard = np.lib.format.open_memmap(
+                    os.path.join(self.destination, name), mode='w+',
+                    dtype=shard_dtype, shape=shape)
+                del shard
+
+            shards.append(entry)
+
+        return shards
+
+    def _layout(self, frames):
+        """Place blocks of every song's frames in random dataset order
+
+        Returns, for each song, a list of (first, last, offset) blocks in
+        order of first, where offset is the block's position in the dataset.
+        """
+        blocks = [(i, first, min(n, first + self.block_size))
+                  for i, n in enumerate(frames)
+                  for first in range(0, n, self.block_size)]
+
+        placement = [[] for _ in frames]
+        offset = 0
+        for k in np.random.permutation(len(blocks)):
+            i, first, last = blocks[k]
+            placement[i].append((first, last, offset))
+            offset += last - first
+
+        for song_blocks in placement:
+            song_blocks.sort()
+        return placement
+
+    @staticmethod
+    def _map(func, tasks, processes):
+        if processes == 1:
+            return [func(t) for t in tasks]
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            return pool.map(func, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+
+class ShardedDataset(object):
+    """Read access to shards written by DatasetBuilder
+
+    Shards are opened as read-only memory maps, so only the batches actually
+    requested are read from disk.  If the samples were scaled with corpus
+    statistics, those are available as normalization.
+    """
+    logger = logging.getLogger('JLAA.ShardedDataset')
+
+    def __init__(self, folder):
+        self.folder = folder
+
+        with open(os.path.join(folder, INDEX_FILENAME), 'r') as f:
+            index = json.load(f)
+
+        self.shards = index['shards']
+        self.sample_shape = tuple(index['sample_shape'])
+        self.dtype = np.dtype(index['dtype'])
+        self.num_classes = index['num_classes']
+        self.num_samples = index['num_samples']
+        self.normalization = NormalizationStats.load(folder)
+
+        self._maps = {}
+
+    def __len__(self):
+        return self.num_samples
+
+    def shard(self, n):
+        """Return the (X, y) memory maps of shard n"""
+        try:
+            return self._maps[n]
+        except KeyError:
+            entry = self.shards[n]
+            X = np.load(os.path.join(self.folder, entry['data']),
+                        mmap_mode='r')
+            y = np.load(os.path.join(self.folder, entry['labels']),
+                        mmap_mode='r')
+            self._maps[n] = (X, y)
+            return X, y
+
+    def split(self, validation_split, shuffle=True):
+        """Divide the shards into training and validation shard numbers
+
+        Whole shards are held out so that validation reads stay sequential,
+        as close to validation_split of the samples as whole shards allow.
+        At least one shard is kept for training.
+        """
+        order = np.arange(len(self.shards))
+        if shuffle:
+            np.random.shuffle(order)
+
+        # samples held out by holding out the first 0, 1, 2... shards
+        held = np.cumsum([0] + [self.shards[n]['size'] for n in order])
+        n_test = int(np.argmin(np.abs(held - validation_split * held[-1])))
+        n_test = min(n_test, order.size - 1)
+
+        return ([int(n) for n in order[n_test:]],
+                [int(n) for n in order[:n_test]])
+
+    def batches(self, batch_size, shards=None, shuffle=True):
+        """Generate (X, y) batches from the given shard numbers
+
+        With shuffle, shards are visited in random order and samples are drawn
+        in random order within each shard.  Each batch's indices are sorted
+        before reading so the memory map is read front to back.
+        """
+        if shards is None:
+            shards = list(range(len(self.shards)))
+
+        order = np.array(shards)
+        if shuffle:
+            np.random.shuffle(order)
+
+        for n in order:
+            X, y = self.shard(n)
+            idx = np.arange(y.shape[0])
+            if shuffle:
+                np.random.shuffle(idx)
+
+            for start in range(0, idx.size, batch_size):
+                batch = np.sort(idx[start:start + batch_size])
+                yield np.asarray(X[batch]), np.asarray(y[batch])
@@ -0,0 +1,278 @@
+"""
+Bulk export of SongFiles from a background writer pool
+
+Copyright 2015 Justin Palpant
+
+This file is part of the Jarvis Lab Audio Analysis program.
+
+Audio Analysis is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+Audio Analysis is distributed in the hope that it will be useful, but WITHOUT
+ANYWARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Audio Analysis. If not, see http://www.gnu.org/licenses/.
+"""
+import os
+import json
+import struct
+import logging
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import scipy.io.wavfile
+import numpy as np
+
+from audioanalysis.freqanalysis import SongFile
+
+
+def to_int16(sf):
+    """Return (samples, scale) with sf.data ~= samples * scale
+
+    SongFiles already holding int16 samples return them unchanged.  Float
+    data within [-1, 1] is stored at the usual full scale of 1/32767; louder
+    data is scaled down by its peak rather than clipped.
+    """
+    if sf.scale is not None and sf.samples.dtype == np.int16:
+        return sf.samples, sf.scale
+
+    data = np.asarray(sf.data)
+    peak = float(np.amax(np.abs(data))) if data.size else 0.0
+    scale = max(1.0, peak) / 32767
+
+    samples = np.round(data / scale)
+    np.clip(samples, -32768, 32767, out=samples)
+
+    return samples.astype(np.int16), scale
+
+
+class MotifArchive(object):
+    """Read access to a single-file archive written by BulkExporter
+
+    The archive holds int16 clips back to back, followed by a JSON table of
+    entries (name, start, Fs, scale, channels, sample offset, frame count and
+    the order the clip was submitted in), the length of the table as an
+    8-byte little-endian integer, and a closing magic string.  Entries are
+    in submission order, so clip i is the i-th clip submitted to the
+    BulkExporter, whichever order the clips were written in.  Clips are read
+    through a memory map, so opening an archive costs only the table.
+    """
+    logger = logging.getLogger('JLAA.MotifArchive')
+
+    MAGIC = b'JLAAMOT1'
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        footer = len(self.MAGIC) + 8
+        with open(filename, 'rb') as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError('{0} is not a motif archive'.format(filename))
+
+            f.seek(-footer, os.SEEK_END)
+            (table_len,) = struct.unpack('<Q', f.read(8))
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError('Motif archive {0} is incomplete; it was '
+                        'not closed after writing'.format(filename))
+
+            f.seek(-footer - table_len, os.SEEK_END)
+            data_end = f.tell()
+            self.entries = json.loads(f.read(table_len).decode('utf-8'))
+
+        self._samples = np.memmap(filename, dtype='<i2', mode='r',
+                                  shape=(data_end // 2,))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def samples(self, i):
+        """The raw int16 samples of clip i, as a memory map
+
+        Multi-channel clips are shaped (frames, channels).
+        """
+        entry = self.entries[i]
+        first = entry['offset']
+        channels = entry.get('channels', 1)
+
+        samples = self._samples[first:first + entry['count'] * channels]
+        if channels > 1:
+            samples = samples.reshape(entry['count'], channels)
+        return samples
+
+    def read(self, i):
+        """Clip i as a SongFile of int16 samples"""
+        entry = self.entries[i]
+
+        return SongFile(np.array(self.samples(i)), entry['Fs'],
+                        name=entry['name'], start=entry['start'],
+                        scale=entry['scale'])
+
+
+class _ArchiveWriter(object):
+    """Appends clips to a MotifArchive file; not thread safe"""
+
+    def __init__(self, filename):
+        self.outfile = open(filename, 'wb')
+        self.outfile.write(MotifArchive.MAGIC)
+        self.entries = []
+
+    def append(self, sf, samples, scale, seq):
+        offset = self.outfile.tell()
+        samples.astype('<i2', copy=False).tofile(self.outfile)
+
+        self.entries.append({
+            'name': sf.name,
+            'start': float(sf.start),
+            'Fs': float(sf.Fs),
+            'scale': scale,
+            # offsets count int16 samples from the start of the file
+            'offset': offset // 2,
+            'count': int(samples.shape[0]),
+            'channels': 1 if samples.ndim == 1 else int(samples.shape[1]),
+            'seq': seq,
+        })
+
+    def close(self):
+        # writer threads finish clips out of order
+        self.entries.sort(key=lambda entry: entry['seq'])
+        table = json.dumps(self.entries).encode('utf-8')
+        self.outfile.write(table)
+        self.outfile.write(struct.pack('<Q', len(table)))
+        self.outfile.write(MotifArchive.MAGIC)
+        self.outfile.close()
+
+
+class BulkExporter(object):
+    """Writes SongFiles to disk from a bounded pool of background threads
+
+    submit() hands a SongFile to the pool and returns at once, blocking only
+    while max_pending exports are already queued.  flush() waits for every
+    submitted export to be written.
+
+    By default each SongFile becomes its own WAV file, written exactly as
+    SongFile.export writes it.  Given an archive filename, all SongFiles are
+    instead packed as int16 into that one file, readable with MotifArchive.
+
+    Use as a context manager, or call close() when done.
+    """
+    logger = logging.getLogger('JLAA.BulkExporter')
+
+    def __init__(self, destination, workers=4, max_pending=64, archive=None,
+                 int16=False):
+        """Create a BulkExporter and start its threads
+
+        Inputs:
+            destination: the folder to write to
+        Keyword Arguments:
+            workers: the number of writer threads
+            max_pending: the number of queued exports at which submit blocks
+            archive: a filename in destination for a single MotifArchive
+            int16: convert SongFiles holding float data to int16 before
+                writing separate WAV files.  Archives are always int16.
+        """
+        self.destination = destination
+        self.int16 = int16
+        self.errors = []
+        self._submitted = 0
+
+        self._queue = queue.Queue(max_pending)
+        self._archive_lock = threading.Lock()
+        if archive is not None:
+            self._archive = _ArchiveWriter(os.path.join(destination, archive))
+        else:
+            self._archive = None
+
+        self._threads = []
+        for _ in range(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, sf, filename=None):
+        """Queue one SongFile for export
+
+        filename is only used for separate WAV files; it defaults to the
+        name SongFile.export would choose.
+        """
+        if self._threads is None:
+            raise ValueError('Cannot submit to a closed BulkExporter')
+
+        self._queue.put((sf, filename, self._submitted))
+        self._submitted += 1
+
+    def export(self, songfiles):
+        """Queue every SongFile in songfiles for export"""
+        for sf in songfiles:
+            self.submit(sf)
+
+    def flush(self):
+        """Wait until everything submitted has been written
+
+        Raises the first error raised by a writer thread since the last flush.
+        """
+        self._queue.join()
+
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise errors[0]
+
+    def close(self):
+        """Flush, stop the writer threads and finish the archive"""
+        if self._threads is None:
+            return
+
+        try:
+            self.flush()
+        finally:
+            for _ in self._threads:
+                self._queue.put(None)
+            for t in self._threads:
+                t.join()
+            self._threads = None
+
+            if self._archive is not None:
+                self._archive.close()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self.logger.error('Failed to export %s: %s', str(item[0]), e)
+                self.errors.append(e)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, sf, filename, seq):
+        if self._archive is not None:
+            samples, scale = to_int16(sf)
+            with self._archive_lock:
+                self._archive.append(sf, samples, scale, seq)
+            return
+
+        if self.int16:
+            data, _ = to_int16(sf)
+        else:
+            data = sf.samples
+
+        scipy.io.wavfile.write(
+            os.path.join(self.destination, sf.output_filename(filename)),
+            int(sf.Fs), data)
@@ -19,7 +19,6 @@ FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
 You should have received a copy of the GNU General Public License along with
 Audio Analysis. If not, see http://www.gnu.org/licenses/.
 """
-import sys
 import os
 import logging
 
@@ -39,6 +38,12 @@ from keras.models import Sequential, model_from_json
 from keras.utils import np_utils
 from sklearn.cross_validation import train_test_split
 
+from audioanalysis.blockaudio import BlockAudioFile
+from audioanalysis.cascade import CascadeClassifier
+from audioanalysis.instrumentation import Instrumentation
+from audioanalysis.normalization import NormalizationStats
+from audioanalysis.runs import LabelRuns
+
 
 class AudioAnalyzer():
     """AudioAnalyzer docstring goes here TODO
@@ -65,9 +70,24 @@ class AudioAnalyzer():
         # Reference to the neural net used for processing
         self.classifier = None
 
-    def build_neural_net(self):
+        # A CascadeClassifier that settles easy frames ahead of the net
+        self.cascade = None
+
+        # Corpus-wide scaling of samples; None scales each request separately
+        self.normalization = None
+
+        # Per-stage timing and memory records go to this object's sinks
+        self.instrumentation = Instrumentation()
+
+        # A RegionIndex to record every song classified by classify_active
+        self.region_index = None
+
+    def build_neural_net(self, dataset=None):
         """Construct and compile a Keras neural net
 
+        The input shape and number of classes come from the active song, or
+        from a ShardedDataset if one is given.
+
         Keyword Arguments:
             layers: a list of layerspecs, as defined in make_layer
             loss: a string specifying a Keras loss function.  Defaults to
@@ -79,8 +99,13 @@ class AudioAnalyzer():
         nn = Sequential()
 
         layers = self.params.get('layers', [])
-        img_rows = self.params.get('img_rows', self.Sxx.shape[0])
-        img_cols = self.params.get('img_cols', 1)
+        if dataset is None:
+            img_rows = self.params.get('img_rows', self.Sxx.shape[0])
+            img_cols = self.params.get('img_cols', 1)
+            num_classes = self.active_song.num_classes
+        else:
+            (_, img_rows, img_cols) = dataset.sample_shape
+            num_classes = dataset.num_classes
 
         for i, layerspec in enumerate(layers):
             if i == 0:  # size the input layer correctly
@@ -93,10 +118,10 @@ class AudioAnalyzer():
             self.logger.debug('Layer output: %s', str(l.output_shape))
 
         self.logger.info('Building the output layer for %d classes',
-                self.active_song.num_classes)
+                num_classes)
 
         l = self.make_layer(
-            {'type': 'Dense', 'args': (self.active_song.num_classes,)})
+            {'type': 'Dense', 'args': (num_classes,)})
         nn.add(l)
 
         l = self.make_layer({'type': 'Activation', 'args': ('softmax',)})
@@ -143,7 +168,9 @@ class AudioAnalyzer():
     def load_neural_net(self, folder):
         """Load a neural net from files exported with export_neural_net
 
-        The given folder should contain a json and an hd5 file
+        The given folder should contain a json and an hd5 file.  If it also
+        contains normalization statistics or a cascade, they replace
+        self.normalization and self.cascade.
         """
 
         self.logger.info('Loading neural net model')
@@ -151,6 +178,9 @@ class AudioAnalyzer():
             open(os.path.join(folder, 'nn_model.json')).read())
         self.logger.info('Loading neural net weights')
         model.load_weights(os.path.join(folder, 'nn_weights.h5'))
+
+        self._load_companions(folder)
+
         self.logger.info('Done loading neural net')
 
         return model
@@ -159,7 +189,8 @@ class AudioAnalyzer():
         """Export the analyzer's neural net to the given folder
 
         Creates two files, one a json string describing the model and one an
-        HDF5 file storing the model's weights
+        HDF5 file storing the model's weights.  The normalization statistics
+        and cascade, if any, are saved alongside them.
         """
 
         with open(os.path.join(folder, 'nn_model.json'), 'w') as outfile:
@@ -167,8 +198,72 @@ class AudioAnalyzer():
 
         self.classifier.save_weights(os.path.join(folder, 'nn_weights.h5'))
 
-    def train_neural_net(self):
-        """Using the currently active song, train_neural_net the neural net"""
+        if self.normalization is not None:
+            self.normalization.save(folder)
+
+        if self.cascade is not None:
+            self.cascade.save(folder)
+
+    def _load_companions(self, folder):
+        """Load the normalization and cascade saved with a neural net"""
+        normalization = NormalizationStats.load(folder)
+        if normalization is not None:
+            self.normalization = normalization
+
+        cascade = CascadeClassifier.load(folder)
+        if cascade is not None:
+            self.cascade = cascade
+
+    def connect_inference_server(self, address=None, authkey=None):
+        """Use a running InferenceServer as the classifier
+
+        classify_active then sends its samples to the server instead of
+        running a local model.  The normalization statistics and cascade
+        saved with the server's model, if any, replace self.normalization and
+        self.cascade.
+
+        Returns the InferenceClient, which is also stored as self.classifier
+        """
+        from audioanalysis.inference import InferenceClient, DEFAULT_ADDRESS
+
+        client = InferenceClient(address or DEFAULT_ADDRESS, authkey=authkey)
+
+        self._load_companions(client.folder)
+
+        self.classifier = client
+        return client
+
+    def compute_normalization(self, songfiles, mode='minmax'):
+        """Gather normalization statistics over a corpus of SongFiles
+
+        Each song is processed in turn and only its statistics are kept, so
+        the corpus can be far larger than memory.  The result is stored in
+        self.normalization and returned.
+        """
+        stats = NormalizationStats(mode)
+
+        for sf in songfiles:
+            self.logger.info('Gathering normalization statistics from %s',
+                    str(sf))
+            stats.update(self.process(sf))
+
+        self.normalization = stats
+        return stats
+
+    def train_neural_net(self, dataset=None):
+        """Using the currently active song, train_neural_net the neural net
+
+        If a ShardedDataset is given, train from its memory mapped shards
+        instead of the active song.
+
+        If the cascade parameter is set, a CascadeClassifier is trained on the
+        same training frames as the net, and the two are compared on the
+        validation frames; see train_cascade.  A cascade for a ShardedDataset
+        must be trained separately with train_cascade.
+        """
+        if dataset is not None:
+            return self._train_from_dataset(dataset)
+
         nb_epoch = self.params.get('epochs', 1)
         batch_size = self.params.get('batch_size', 16)
         nb_classes = self.active_song.num_classes
@@ -186,8 +281,9 @@ class AudioAnalyzer():
         self.logger.info('X_train max %s', str(np.amax(X_train)))
         self.logger.info('X_train min %s', str(np.amin(X_train)))
 
-        X_train, X_test, Y_train, Y_test = train_test_split(
-            X_train, Y_train,
+        (X_train, X_test, Y_train, Y_test,
+         idx_train, idx_test) = train_test_split(
+            X_train, Y_train, indices,
             test_size=validation_split,
             random_state=np.random.randint(0, 100000, 1)[0]
         )
@@ -203,13 +299,98 @@ class AudioAnalyzer():
             validation_data=(X_test, Y_test)
         )
 
+        if self.params.get('cascade', False):
+            cascade = self.train_cascade(indices=idx_train)
+            cascade.evaluate(
+                cascade.features(self.active_song, self.Sxx, idx_test),
+                np.argmax(Y_test, axis=1),
+                self.classifier.predict_proba(X_test, batch_size=batch_size,
+                                              verbose=0))
+
+    def train_cascade(self, songfiles=None, indices=None):
+        """Train the first stage of the classification cascade
+
+        The cascade learns from the frames of labeled SongFiles, each
+        processed in turn, or by default from the frames in indices (all
+        frames by default) of the active song.  It replaces self.cascade,
+        after which predict_active defers only uncertain frames to the net.
+
+        Keyword Arguments (from self.params):
+            cascade_bands: the number of band energy features (default 4)
+            cascade_accuracy: the accuracy required of the frames the
+                cascade settles (default 0.98)
+
+        Returns the CascadeClassifier
+        """
+        cascade = CascadeClassifier(
+            bands=self.params.get('cascade_bands', 4),
+            accuracy=self.params.get('cascade_accuracy', 0.98))
+
+        if songfiles is None:
+            if indices is None:
+                indices = np.arange(self.active_song.time.size)
+            X = cascade.features(self.active_song, self.Sxx, indices)
+            y = self.get_classification(indices)
+        else:
+            X, y = [], []
+            for sf in songfiles:
+                Sxx = self.process(sf)
+                X.append(cascade.features(sf, Sxx))
+                y.append(sf.classification)
+                del Sxx
+            X, y = np.concatenate(X), np.concatenate(y)
+
+        self.logger.info('Training the cascade on %d frames', y.size)
+        self.cascade = cascade.fit(X, y)
+
+        return cascade
+
+    def _train_from_dataset(self, dataset):
+        """Train the neural net batch by batch from a ShardedDataset
+
+        Only one batch of samples is in memory at a time.  Whole shards are
+        held out for validation, in the proportion given by validation_split.
+        """
+        nb_epoch = self.params.get('epochs', 1)
+        batch_size = self.params.get('batch_size', 16)
+        nb_classes = dataset.num_classes
+        validation_split = self.params.get('validation_split', 0.25)
+
+        train_shards, test_shards = dataset.split(validation_split)
+
+        # the samples were scaled with these, so the exported net needs them
+        if dataset.normalization is not None:
+            self.normalization = dataset.normalization
+
+        self.logger.info('Training from %d samples in %d shards, %d shards '
+                'held out for validation', len(dataset), len(train_shards),
+                len(test_shards))
+
+        for epoch in range(nb_epoch):
+            losses = []
+            for X, y in dataset.batches(batch_size, train_shards):
+                Y = np_utils.to_categorical(y, nb_classes)
+                losses.append(np.ravel(
+                    self.classifier.train_on_batch(X, Y))[0])
+
+            val_losses = []
+            for X, y in dataset.batches(batch_size, test_shards,
+                                        shuffle=False):
+                Y = np_utils.to_categorical(y, nb_classes)
+                val_losses.append(np.ravel(
+                    self.classifier.test_on_batch(X, Y))[0])
+
+            self.logger.info('Epoch %d/%d: loss %g, validation loss %s',
+                    epoch + 1, nb_epoch, np.mean(losses),
+                    str(np.mean(val_losses)) if val_losses else 'n/a')
+
     def get_classification(self, idx):
         """Docs"""
 
         img_rows = self.params.get('img_rows', self.Sxx.shape[0])
         img_cols = self.params.get('img_cols', 1)
 
-        if self.Sxx is None or self.active_song.classification is None:
+        if self.Sxx is None or self.active_song.classification_runs is None:
             raise TypeError('No active song from which to get data')
 
         if np.amax(idx) > self.Sxx.shape[1]:
@@ -221,11 +402,11 @@ class AudioAnalyzer():
                     'negative index requested')
 
         # index out the data
-        classification = self.active_song.classification[idx]
+        classification = self.active_song.classification_runs.at(idx)
 
         return classification
 
-    def get_data_sample(self, idx):
+    def get_data_sample(self, idx, bounds=None):
         """Get a sample from the spectrogram and the corresponding class
 
         Inputs:
@@ -237,6 +418,13 @@ class AudioAnalyzer():
                 the corresponding integer class from
                 self.active_song.classification
 
+        Log power is scaled with self.normalization when it is set.  Otherwise
+        it is scaled to [0, 1] by the min and max of this request alone, so
+        the same frame can take different values in different requests,
+        unless (min, max) bounds are given, e.g. from sample_bounds.  The min
+        is taken from sample_floor_row on, and quieter values are clamped to
+        it.
+
         If idx exceeds the dimensions of the data, throws IndexError
         If there is not a processed, active song, throws TypeError
         """
@@ -244,7 +432,7 @@ class AudioAnalyzer():
         img_rows = self.params.get('img_rows', self.Sxx.shape[0])
         img_cols = self.params.get('img_cols', 1)
 
-        if self.Sxx is None or self.active_song.classification is None:
+        if self.Sxx is None or self.active_song.classification_runs is None:
             raise TypeError('No active song from which to get data')
 
         if np.amax(idx) > self.Sxx.shape[1]:
@@ -255,20 +443,71 @@ class AudioAnalyzer():
             raise IndexError('Data index of sample out of bounds, '
                     'negative index requested')
 
-        # index out the data
-        max_idx = (self.Sxx.shape[1] - 1)
+        with self.instrumentation.stage('samples', items=idx.size):
+            # index out the data
+            max_idx = (self.Sxx.shape[1] - 1)
 
-        data_slices = [self.Sxx[0:img_rows, np.minimum(
-            max_idx, idx + i)].T.reshape(idx.size, 1, img_rows) for i in range(img_cols)]
-        data = np.stack(data_slices, axis=-1)
+            if self.normalization is not None:
+                scale = self.normalization.apply
+            else:
+                scale = np.log10
 
-        # scale the input
-        data = np.log10(data)
-        data -= np.amin(data)
-        data /= np.amax(data)
+            data_slices = [scale(self.Sxx[0:img_rows, np.minimum(
+                max_idx, idx + i)]).T.reshape(idx.size, 1, img_rows) for i in range(img_cols)]
+            data = np.stack(data_slices, axis=-1)
+
+            # scale the input
+            if self.normalization is None:
+                if bounds is None:
+                    first = self.sample_floor_row(img_rows)
+                    bounds = (np.amin(data[:, :, first:]), np.amax(data))
+                np.maximum(data, bounds[0], out=data)
+                data -= bounds[0]
+                data /= bounds[1] - bounds[0]
 
         return data
 
+    def sample_bounds(self):
+        """The (min, max) log power over every sample of the active song
+
+        Passed to get_data_sample, these scale any subset of frames as they
+        would be scaled in a request for the whole song.
+        """
+        img_rows = self.params.get('img_rows', self.Sxx.shape[0])
+        rows = self.Sxx[self.sample_floor_row(img_rows):img_rows]
+
+        return (np.log10(np.amin(rows)),
+                np.log10(np.amax(self.Sxx[0:img_rows])))
+
+    def sample_floor_row(self, img_rows):
+        """The first spectrogram row used for the lower bound of scaling
+
+        With the passband_floor parameter, rows below min_freq are left out
+        (see passband_row).  It defaults to True for float32 processing,
+        whose stopband floor differs from float64's, and to False for
+        float64, which keeps the scaling existing networks were trained with.
+        """
+        passband_floor = self.params.get(
+            'passband_floor', self.processing_dtype() != np.float64)
+
+        return self.passband_row(img_rows) if passband_floor else 0
+
+    def passband_row(self, img_rows):
+        """The first row of the active spectrogram at or above min_freq
+
+        Rows below the highpass cutoff hold the filter's stopband, whose
+        floor is rounding noise that differs between float32 and float64, so
+        the lower bound of sample scaling is found above it.  Returns 0 if
+        there is no min_freq parameter or every sample row is below it.
+        """
+        min_freq = self.params.get('min_freq')
+        freq = self.active_song.freq
+        if min_freq is None or freq is None:
+            return 0
+
+        first = int(np.searchsorted(freq, min_freq))
+        return first if first < img_rows else 0
+
     def set_active(self, sf):
         """Select a SongFile from the current list and designate one as the 
         active SongFile
@@ -277,100 +516,479 @@ class AudioAnalyzer():
 
         self.Sxx = self.process(self.active_song)
 
-    def process(self, sf):
+    def highpass(self, sf):
+        """Return the signal of sf highpass filtered at the min_freq parameter
+
+        If min_freq is not set the signal is returned unfiltered.  The whole
+        signal is returned as one array; process filters block by block
+        with highpass_blocks instead.
+        """
+        if 'min_freq' not in self.params and sf.scale is None:
+            self.logger.debug('No highpass filter applied')
+            return sf.data
+
+        n = sf.samples.shape[0]
+        block = self.params.get('filter_block', 1048576)
+        ranges = [(first, min(n, first + block))
+                  for first in range(0, n, block)]
+
+        blocks = list(self.highpass_blocks(sf, ranges))
+        if not blocks:
+            return sf.read(0, 0, self.processing_dtype())
+
+        return np.concatenate(blocks)
+
+    def highpass_blocks(self, sf, ranges):
+        """Yield the filtered signal of sf over each (first, last) range
+
+        Ranges must be in increasing order and may overlap, as STFT chunks
+        do.  Only the samples of one range are converted to float and
+        filtered at a time, with the filter state carried from one range to
+        the next, so each block is exactly that part of the whole signal
+        filtered at once.  Without a min_freq parameter the blocks are only
+        converted.
+        """
+        dtype = self.processing_dtype()
+
+        try:
+            min_freq = self.params['min_freq']
+        except KeyError:
+            self.logger.debug('No highpass filter applied')
+            for first, last in ranges:
+                yield sf.read(first, last, dtype)
+            return
+
+        self.logger.debug('Highpass filter %g Hz applied', min_freq)
+
+        zi = 0
+        done = 0  # samples filtered so far
+        buf_first, buf = 0, sf.read(0, 0, dtype)
+
+        for first, last in ranges:
+            with self.instrumentation.stage('highpass',
+                                            items=max(0, last - done)):
+                # keep the filter state across samples no range covers
+                if first > done:
+                    _, zi = AudioAnalyzer.butter_highpass_filter(
+                        sf.read(done, first, dtype), min_freq, sf.Fs, 5,
+                        dtype=dtype, zi=zi)
+                    done = first
+                    buf_first, buf = first, buf[0:0]
+
+                if last > done:
+                    new, zi = AudioAnalyzer.butter_highpass_filter(
+                        sf.read(done, last, dtype), min_freq, sf.Fs, 5,
+                        dtype=dtype, zi=zi)
+                    buf = np.concatenate((buf[first - buf_first:], new))
+                    buf_first = first
+                    done = last
+
+            yield buf[first - buf_first:last - buf_first]
+
+    def process(self, sf, data=None, per_channel=False):
         """Take a songfile and using its data, create the processed statistics
 
         This method both updates the data stored in the SongFile (for those
         values that are stored there) and RETURNS the calculated spectrogram of
         the SongFile.  You must catch the returned value and save it, it is not
         written to self.Sxx by default
-        """
-        time_window_ms = self.params.get('fft_time_window_ms', 10)
-        time_step_ms = self.params.get('fft_time_step_ms', 2)
-        nfft = self.params.get('nfft', 512)
-        process_chunk = self.params.get('process_chunk_s', 15)
 
-        noverlap = (time_window_ms - time_step_ms) * sf.Fs / 1000
-        noverlap = noverlap if noverlap > 0 else 0
+        The dtype parameter sets the floating point precision of the filtered
+        signal, the spectrogram and the features calculated from it.
+
+        The filter and STFT are calculated in chunks chosen by
+        plan_processing.  Chunks overlap by the window overlap, so the result
+        is the same as a single STFT of the whole song, and only one chunk of
+        the signal is converted to float at a time.
 
-        if sf.data.shape[0] > process_chunk * sf.Fs:
-            split_count = int(
-                np.ceil(sf.data.shape[0] / (process_chunk * sf.Fs)))
-            nchunk = process_chunk * sf.Fs
+        If data is given, it is used as the already filtered signal of sf and
+        the highpass filter is skipped.
+
+        The channels of a multi-channel SongFile are filtered and transformed
+        together in one batched call per chunk.  Each channel's power and
+        entropy are stored in sf.channel_power and sf.channel_entropy, and
+        their combination (see combine_channels) in sf.power and sf.entropy;
+        by default, the highest power and the entropy of that channel.
+        The returned spectrogram is the combination of the channels' unless
+        per_channel is set, in which case it is (channels, frequency, time).
+        """
+        plan = self.plan_processing(sf, per_channel=per_channel)
+        dtype = self.processing_dtype()
+        nfft = plan['nfft']
+        nrows = nfft // 2
+        multi = sf.samples.ndim > 1
+
+        if data is None:
+            blocks = self.highpass_blocks(sf, plan['chunks'])
         else:
-            split_count = 1
-            nchunk = sf.data.shape[0]
+            blocks = (np.asarray(data[first:last], dtype=dtype)
+                      for first, last in plan['chunks'])
+
+        Sxx = None
+        time_list = np.empty(plan['frames'])
+        if multi:
+            sf.channel_entropy = np.empty((sf.channels, plan['frames']),
+                                          dtype=dtype)
+            sf.channel_power = np.empty((sf.channels, plan['frames']),
+                                        dtype=dtype)
+        else:
+            sf.channel_entropy = sf.channel_power = None
+        sf.entropy = np.empty(plan['frames'], dtype=dtype)
+        sf.power = np.empty(plan['frames'], dtype=dtype)
+        pos = 0
+
+        for i, block in enumerate(blocks):
+            first, last = plan['chunks'][i]
+            self.logger.info('Processing songfile from %g seconds to %g '
+                    'seconds', first / sf.Fs, last / sf.Fs)
+
+            with self.instrumentation.stage('stft', chunk=i) as record:
+                # channels are transformed together along the last axis
+                (freq, time_part, Sxx_part) = signal.spectrogram(
+                    block.T if multi else block,
+                    fs=sf.Fs,
+                    nfft=nfft,  # number of bins; must be 2^z
+                    nperseg=plan['nperseg'],  # width in time domain
+                    noverlap=plan['noverlap'],  # overlap in time domain
+                    detrend='constant',
+                    return_onesided=True,
+                    scaling='density',
+                    window=('hamming'),
+                )
+                Sxx_part = Sxx_part.astype(dtype, copy=False)
+                record['items'] = time_part.size
+
+            rows = min(nrows, Sxx_part.shape[-2])
+            if Sxx is None:
+                if multi and per_channel:
+                    shape = (sf.channels, rows, plan['frames'])
+                else:
+                    shape = (rows, plan['frames'])
+                Sxx = np.empty(shape, dtype=dtype)
+
+            frames = time_part.size
+            with self.instrumentation.stage('features', items=frames):
+                entropy = self.calc_entropy(Sxx_part)
+                power = self.calc_power(Sxx_part)
+                if multi:
+                    sf.channel_entropy[:, pos:pos + frames] = entropy
+                    sf.channel_power[:, pos:pos + frames] = power
+                    entropy = self.combine_channels(entropy, power)
+                    power = self.combine_channels(power)
+                sf.entropy[pos:pos + frames] = entropy
+                sf.power[pos:pos + frames] = power
+
+            if multi and not per_channel:
+                Sxx[:, pos:pos + frames] = self.combine_channels(
+                    Sxx_part[:, 0:rows])
+            else:
+                Sxx[..., pos:pos + frames] = Sxx_part[..., 0:rows, :]
+            time_list[pos:pos + frames] = time_part + first / sf.Fs
+            pos += frames
+
+        if pos != plan['frames']:
+            self.logger.warning('Expected %d STFT frames but calculated %d',
+                    plan['frames'], pos)
+            Sxx = Sxx[..., 0:pos]
+            time_list = time_list[0:pos]
+            sf.entropy = sf.entropy[0:pos]
+            sf.power = sf.power[0:pos]
+            if multi:
+                sf.channel_entropy = sf.channel_entropy[:, 0:pos]
+                sf.channel_power = sf.channel_power[:, 0:pos]
+
+        self.logger.debug('Size of one STFT: %d bytes', Sxx.nbytes)
+        self.logger.debug('STFT dimensions %s', str(Sxx.shape))
 
-        nperseg = time_window_ms * sf.Fs / 1000
+        sf.time = time_list
+        sf.freq = freq[0:nrows]
 
-        try:
-            min_freq = self.params['min_freq']
-            self.logger.debug('Highpass filter %g Hz applied', min_freq)
-            data = AudioAnalyzer.butter_highpass_filter(
-                sf.data, min_freq, sf.Fs, 5)
-        except KeyError:
-            data = sf.data
-            self.logger.debug('No highpass filter applied')
+        runs = sf.classification_runs
+        if runs is None:
+            sf.classification = LabelRuns.constant(time_list.size)
+        else:
+            self.logger.debug('Size of classes: {0}; size of time: {1}'.format(
+                sf.time.size, runs.size))
+            if runs.size >= sf.time.size:
+                sf.classification = runs.slice(0, sf.time.size)
+            elif runs.size < sf.time.size:
+                difference = sf.time.size - runs.size
+                if difference % 2 == 0:
+                    left = difference // 2
+                    right = difference // 2
+                else:
+                    left = difference // 2 + 1
+                    right = difference // 2
+                sf.classification = runs.pad(left, right)
+
+        return Sxx
+
+    def combine_channels(self, values, power=None):
+        """Combine per-channel values along their first axis
+
+        The channel_combine parameter chooses 'max' (the default) or 'mean'.
+        With 'max', power and spectrograms take their largest value over the
+        channels.  Other values, such as entropy or class probabilities, are
+        not comparable that way: the noisiest channel has the highest
+        entropy.  Given the channels' (channels, frames) power, they are
+        instead taken, frame by frame, from the channel with the highest
+        power.  The result has the dtype of values.
+        """
+        how = self.params.get('channel_combine', 'max')
+        if how == 'max':
+            if power is None:
+                return np.amax(values, axis=0)
+
+            loudest = np.argmax(power, axis=0)
+            loudest = loudest.reshape(
+                (1,) * (np.ndim(values) - loudest.ndim) + loudest.shape)
+            return np.take_along_axis(values, loudest, axis=0)[0]
+        elif how == 'mean':
+            return np.mean(values, axis=0).astype(values.dtype, copy=False)
+
+        self.logger.error('Unknown channel_combine %s', how)
+        raise ValueError('Unknown channel_combine {0}, must be max or '
+                         'mean'.format(how))
+
+    def stft_geometry(self, Fs):
+        """Return (nperseg, noverlap, nfft) in samples for sampling rate Fs
+
+        nfft is increased to the next power of two if it is smaller than the
+        window.
+        """
+        time_window_ms = self.params.get('fft_time_window_ms', 10)
+        time_step_ms = self.params.get('fft_time_step_ms', 2)
+        nfft = self.params.get('nfft', 512)
+
+        nperseg = int(np.round(time_window_ms * Fs / 1000))
+        noverlap = int(np.round((time_window_ms - time_step_ms) * Fs / 1000))
+        noverlap = min(max(noverlap, 0), nperseg - 1)
 
         if nfft < nperseg:
-            nfft = 2**np.ceil(np.log2(nperseg))
             self.logger.warning('NFFT (%d) cannot be less than the number of '
                     'samples in each time_list window (%d).  Temporarily '
                     'increasing nfft to %d, which will require more memory.  '
                     'To avoid this, decrease FFT Time Window in the parameters'
                     ' menu.',
                     nfft, nperseg, 2**np.ceil(np.log2(nperseg)))
+            nfft = int(2**np.ceil(np.log2(nperseg)))
 
-        for i in range(0, split_count):
-            self.logger.info('Processing songfile from %d seconds to %d '
-                    'seconds', i * process_chunk, (i + 1) * process_chunk)
-
-            (freq, time_part, Sxx_part) = signal.spectrogram(
-                data[i * nchunk:(i + 1) * nchunk],
-                fs=sf.Fs,
-                nfft=nfft,  # number of bins; must be 2^z
-                nperseg=nperseg,  # width in time domain
-                noverlap=noverlap,  # overlap in time domain
-                detrend='constant',
-                return_onesided=True,
-                scaling='density',
-                window=('hamming'),
-            )
-
-            if i == 0:
-                time_list = time_part
-                Sxx = Sxx_part
-            else:
-                time_list = np.append(time_list, time_list[-1] + time_part)
-                Sxx = np.hstack((Sxx, Sxx_part))
+        return nperseg, noverlap, int(nfft)
 
-        self.logger.debug('Size of one STFT: %d bytes', sys.getsizeof(Sxx))
-        self.logger.debug('STFT dimensions %s', str(Sxx.shape))
+    def memory_costs(self, Fs, data_itemsize=2, channels=1, spectrograms=1):
+        """Estimated bytes used by processing, per unit of work
 
-        sf.time = time_list
-        sf.freq = freq[0:nfft / 2]
-        sf.entropy = self.calc_entropy(Sxx)
-        sf.power = self.calc_power(Sxx)
+        channels is the number of channels of the signal and spectrograms the
+        number of spectrograms kept (channels for a per-channel process, 1
+        otherwise).
+
+        Returns a dict of:
+            per_sample: the stored signal, per input sample
+            per_frame: the stored spectrogram and features, per STFT frame
+            per_chunk_frame: STFT working memory, per frame of one chunk
+            per_sample_frame: sample building for the classifier, per frame
+        """
+        itemsize = self.processing_dtype().itemsize
+        nperseg, noverlap, nfft = self.stft_geometry(Fs)
+        step = nperseg - noverlap
+        nfreq = nfft // 2 + 1
+        img_rows = self.params.get('img_rows', nfft // 2)
+        img_cols = self.params.get('img_cols', 1)
 
-        if sf.classification is None:
-            sf.classification = np.zeros(time_list.size)
+        # combined power and entropy, plus each channel's
+        features = 2 + (2 * channels if channels > 1 else 0)
+
+        return {
+            'per_sample': data_itemsize * channels,
+            'per_frame': (spectrograms * (nfft // 2) + features) * itemsize + 8,
+            # the chunk's converted and filtered signal, the detrended and
+            # windowed segments, the zero padded FFT input, the complex
+            # spectrum and its squared magnitude, for every channel
+            'per_chunk_frame': channels * itemsize * (
+                2 * step + 2 * nperseg + nfft + 5 * nfreq),
+            # the stacked slices and their scaled copy
+            'per_sample_frame': 2 * img_rows * img_cols * itemsize,
+        }
+
+    def plan_processing(self, sf, per_channel=False):
+        """Choose how process will divide sf into STFT chunks
+
+        Without a memory_budget parameter (in bytes) chunks are
+        process_chunk_s seconds long.  With one, chunks are made as long as
+        the budget allows after the signal, spectrogram and sample building
+        are accounted for, but never shorter than
+        min_chunk_frames frames (256 by default), below which the FFT calls
+        lose efficiency.  Samples for the classifier are built
+        inference_chunk frames at a time (16384 by default), or fewer if the
+        budget requires, but again no fewer than min_chunk_frames.  If the
+        estimated peak still exceeds the budget, a warning suggests the
+        longest song that would fit; load_song splits files to that length.
+
+        A song shorter than one STFT window is transformed as a single
+        window of its own length.  Empty songs raise ValueError.
+
+        Returns the plan as a dict, which is also logged and stored in
+        self.processing_plan.
+        """
+        nperseg, noverlap, nfft = self.stft_geometry(sf.Fs)
+        n = sf.samples.shape[0]
+        if n == 0:
+            self.logger.error('Cannot process %s, it has no samples', str(sf))
+            raise ValueError('Cannot process {0}, it has no samples'.format(
+                str(sf)))
+        elif n < nperseg:
+            self.logger.warning('%s has %d samples, fewer than one STFT '
+                    'window of %d; using a single window of %d samples',
+                    str(sf), n, nperseg, n)
+            nperseg, noverlap = n, n - 1
+
+        step = nperseg - noverlap
+        frames = (n - noverlap) // step
+
+        costs = self.memory_costs(
+            sf.Fs, sf.samples.dtype.itemsize, sf.channels,
+            sf.channels if per_channel else 1)
+        min_chunk_frames = self.params.get('min_chunk_frames', 256)
+
+        sample_frames = self.params.get('inference_chunk', 16384)
+
+        resident = (n * costs['per_sample'] + frames * costs['per_frame'])
+
+        budget = self.params.get('memory_budget')
+        if budget is None:
+            chunk_frames = int(self.params.get('process_chunk_s', 15) *
+                               sf.Fs) // step
         else:
-            self.logger.debug('Size of classes: {0}; size of time: {1}'.format(
-                sf.time.size, sf.classification.size))
-            if sf.classification.size >= sf.time.size:
-                sf.classification = sf.classification[0:sf.time.size]
-            elif sf.classification.size < sf.time.size:
-                difference = sf.time.size - sf.classification.size
-                if difference % 2 == 0:
-                    left = difference / 2
-                    right = difference / 2
-                else:
-                    left = difference / 2 + 1
-                    right = difference / 2
-                sf.classification = np.pad(
-                    sf.classification, (left, right), 'constant')
+            chunk_frames = int(budget - resident) // costs['per_chunk_frame']
+            chunk_frames = max(chunk_frames, min_chunk_frames)
+            sample_frames = min(sample_frames, max(
+                int(budget - resident) // costs['per_sample_frame'],
+                min_chunk_frames))
+
+        sample_frames = max(1, min(sample_frames, frames))
+        samples = sample_frames * costs['per_sample_frame']
+
+        chunk_frames = max(1, min(chunk_frames, frames))
+
+        chunks = []
+        for f0 in range(0, frames, chunk_frames):
+            f1 = min(frames, f0 + chunk_frames)
+            chunks.append((f0 * step, f1 * step + noverlap))
+
+        peak = resident + max(chunk_frames * costs['per_chunk_frame'],
+                              samples)
+        if budget is not None and peak > budget:
+            self.logger.warning('Processing %s is estimated to need %d '
+                    'bytes, more than the memory budget of %d bytes.  Songs '
+                    'of at most %g seconds would fit.', str(sf), peak, budget,
+                    self.max_song_length(sf.Fs, sf.samples.dtype.itemsize,
+                                         sf.channels))
+
+        plan = {
+            'Fs': sf.Fs,
+            'nperseg': nperseg,
+            'noverlap': noverlap,
+            'nfft': nfft,
+            'frames': frames,
+            'chunk_frames': chunk_frames,
+            'chunk_s': chunk_frames * step / float(sf.Fs),
+            'chunks': chunks,
+            'sample_frames': sample_frames,
+            'memory_budget': budget,
+            'estimated_bytes': {
+                'signal': n * costs['per_sample'],
+                'spectrogram': frames * costs['per_frame'],
+                'stft_chunk': chunk_frames * costs['per_chunk_frame'],
+                'samples': samples,
+                'peak': peak,
+            },
+        }
+
+        self.logger.info('Processing plan for %s: %d frames in %d chunks of '
+                '%g s, estimated peak %d bytes (budget %s)', str(sf), frames,
+                len(chunks), plan['chunk_s'], peak, str(budget))
+
+        self.processing_plan = plan
+        return plan
+
+    def max_song_length(self, Fs, data_itemsize=2, channels=1):
+        """The longest song, in seconds, that process fits in memory_budget
+
+        Returns None if there is no memory_budget parameter.
+        """
+        budget = self.params.get('memory_budget')
+        if budget is None:
+            return None
+
+        nperseg, noverlap, _ = self.stft_geometry(Fs)
+        step = nperseg - noverlap
+        costs = self.memory_costs(Fs, data_itemsize, channels)
+        min_chunk_frames = self.params.get('min_chunk_frames', 256)
+
+        per_sample = costs['per_sample'] + float(costs['per_frame']) / step
+        fixed = min_chunk_frames * max(costs['per_chunk_frame'],
+                                       costs['per_sample_frame'])
+
+        return max(0.0, (budget - fixed) / per_sample / Fs)
+
+    def load_song(self, filename, split=600, downsampling=None,
+                  recorded=None, channels=0):
+        """Load a WAV file as SongFiles that fit in the memory budget
+
+        Like SongFile.load, except that with a memory_budget parameter the
+        split length is shortened to max_song_length when needed, and the
+        split_mode and split_tolerance parameters are passed on.
+        """
+        split_mode = self.params.get('split_mode', 'fixed')
+        split_tolerance = self.params.get('split_tolerance', 5.0)
+
+        if os.path.splitext(filename)[1] == BlockAudioFile.EXTENSION:
+            with BlockAudioFile(filename) as blocks:
+                rate, itemsize, available = blocks.Fs, 2, blocks.channels
+        else:
+            rate, data = scipy.io.wavfile.read(filename, mmap=True)
+            itemsize = data.dtype.itemsize
+            available = 1 if data.ndim == 1 else data.shape[1]
+            del data
+        fs = float(rate) / downsampling if downsampling else float(rate)
+
+        if channels is None:
+            count = available
+        else:
+            count = np.size(channels)
+
+        max_length = self.max_song_length(fs, itemsize, count)
+        if max_length is not None:
+            # silence aligned cuts can lengthen a section by the tolerance
+            if split_mode == 'silence':
+                max_length = max(1.0, max_length - split_tolerance)
+
+            if not split or split > max_length:
+                self.logger.info('Splitting %s into sections of %g seconds to'
+                        ' fit the memory budget', filename, max_length)
+                split = max_length
+
+        return SongFile.load(filename, split=split, downsampling=downsampling,
+                             instrumentation=self.instrumentation,
+                             recorded=recorded, split_mode=split_mode,
+                             split_tolerance=split_tolerance,
+                             channels=channels)
+
+    def processing_dtype(self):
+        """The floating point type used by process, from the dtype parameter
+
+        Defaults to float64.  float32 halves the memory and bandwidth of the
+        filter, STFT and sample building.  float16 is not accepted: density
+        scaled spectrogram values routinely fall below its smallest normal
+        number.
+        """
+        dtype = np.dtype(self.params.get('dtype', 'float64'))
+
+        if dtype.kind != 'f' or dtype.itemsize < 4:
+            raise ValueError('Processing dtype must be float32 or float64, '
+                    'not {0}'.format(dtype.name))
 
-        return Sxx[0:nfft / 2, :]
+        return dtype
 
     @staticmethod
     def butter_highpass(cutoff, fs, order=5):
@@ -380,21 +998,61 @@ class AudioAnalyzer():
         return b, a
 
     @staticmethod
-    def butter_highpass_filter(data, cutoff, fs, order=5):
-        b, a = AudioAnalyzer.butter_highpass(cutoff, fs, order=order)
-        y = signal.lfilter(b, a, data)
-        return y
+    def butter_highpass_filter(data, cutoff, fs, order=5, dtype=None,
+                               zi=None):
+        """Apply a Butterworth highpass filter to data
+
+        With no dtype the filter runs in float64 as a single transfer function.
+        Lower precision dtypes use second-order sections, which stay stable
+        when the coefficients are rounded, and return an array of that dtype.
+
+        To filter a long signal block by block, pass zi=0 for the first block
+        and the returned state for each following one; (filtered, state) is
+        then returned instead of the filtered block alone.
+
+        Data is filtered along its first axis, so the columns of a
+        (samples, channels) array are filtered together.
+        """
+        if dtype is None or np.dtype(dtype) == np.float64:
+            b, a = AudioAnalyzer.butter_highpass(cutoff, fs, order=order)
+            if zi is None:
+                return signal.lfilter(b, a, data, axis=0)
+
+            if np.isscalar(zi):
+                zi = np.zeros((max(len(a), len(b)) - 1,) +
+                              np.shape(data)[1:])
+            return signal.lfilter(b, a, data, axis=0, zi=zi)
+
+        nyq = 0.5 * fs
+        sos = signal.butter(order, cutoff / nyq, btype='high', analog=False,
+                            output='sos')
+        data = np.asarray(data, dtype=dtype)
+        if zi is None:
+            y = signal.sosfilt(sos.astype(dtype), data, axis=0)
+            return y.astype(dtype, copy=False)
+
+        if np.isscalar(zi):
+            zi = np.zeros((sos.shape[0], 2) + data.shape[1:], dtype=dtype)
+        y, zf = signal.sosfilt(sos.astype(dtype), data, axis=0, zi=zi)
+        return y.astype(dtype, copy=False), zf
 
     @staticmethod
     def calc_entropy(Sxx):
-        """Calculates the Wiener entropy (0 to 1) for each time slice of Sxx"""
-        n = Sxx.shape[0]
-        return np.exp(np.sum(np.log(Sxx), 0) / n) / (np.sum(Sxx, 0) / n)
+        """Calculates the Wiener entropy (0 to 1) for each time slice of Sxx
+
+        The log-mean and mean are accumulated in float64 whatever the dtype of
+        Sxx; the result has the dtype of Sxx.  Frequency is the second to last
+        axis, so a (channels, frequency, time) spectrogram gives one row of
+        entropy per channel.
+        """
+        log_mean = np.mean(np.log(Sxx), -2, dtype=np.float64)
+        mean = np.mean(Sxx, -2, dtype=np.float64)
+        return (np.exp(log_mean) / mean).astype(Sxx.dtype, copy=False)
 
     @staticmethod
     def calc_power(Sxx):
         """Calculates average signal power"""
-        return np.sum(Sxx, 0) / Sxx.shape[0]
+        return np.mean(Sxx, -2, dtype=np.float64).astype(Sxx.dtype, copy=False)
 
     def classify_active(self):
         """Creates a classification for the active song using classifier
@@ -402,34 +1060,264 @@ class AudioAnalyzer():
         """
         self.logger.info('Classifying {0}'.format(str(self.active_song)))
 
+        prbs = self.predict_active()
+        self.active_song.classification = self.postprocess(
+            prbs, self.active_song)
+
+        if self.region_index is not None:
+            self.region_index.add_song(self.active_song)
+
+    def classify_channels(self, sf):
+        """Make sf active and classify each of its channels and their union
+
+        sf is processed once, with all channels filtered and transformed
+        together.  Each channel is classified from its own spectrogram,
+        power and entropy into sf.channel_classification, a list of
+        LabelRuns.  The channels' class probabilities are then combined with
+        combine_channels, by default from the loudest channel of each frame,
+        and post-processed against the combined power into
+        sf.classification.  self.Sxx is set to the combined spectrogram.
+        """
+        self.logger.info('Classifying the %d channels of %s', sf.channels,
+                str(sf))
+
+        Sxx = self.process(sf, per_channel=sf.samples.ndim > 1)
+        if sf.samples.ndim == 1:
+            self.active_song, self.Sxx = sf, Sxx
+            self.classify_active()
+            sf.channel_classification = [sf.classification_runs]
+            return
+
+        channel_prbs = []
+        channel_classification = []
+        try:
+            for c in range(sf.channels):
+                view = sf.channel(c)
+                self.active_song, self.Sxx = view, Sxx[c]
+                prbs = self.predict_active()
+                channel_prbs.append(prbs)
+                channel_classification.append(LabelRuns.from_dense(
+                    self.postprocess(prbs.copy(), view)))
+        finally:
+            self.active_song = sf
+            self.Sxx = self.combine_channels(Sxx)
+            del Sxx
+
+        sf.channel_classification = channel_classification
+        sf.classification = self.postprocess(
+            self.combine_channels(np.stack(channel_prbs), sf.channel_power),
+            sf)
+
+        if self.region_index is not None:
+            self.region_index.add_song(sf)
+
+    def predict_active(self):
+        """Class probabilities of every frame of the active song
+
+        Returns a (num_classes, frames) array from the classifier, before any
+        smoothing or filtering.
+
+        With a cascade, frames it is confident about take its probabilities
+        and only the rest are sent to the classifier.
+        """
         batch_size = self.params.get('batch_size', 100)
+        settled_prbs, indices = self._settle_active()
+        bounds = None
+
+        # Without corpus statistics each chunk is scaled by the bounds of
+        # the whole song, so chunks are scaled as one request would be
+        chunk = self.plan_processing(self.active_song)['sample_frames']
+        if self.normalization is None and indices.size:
+            bounds = self.sample_bounds()
+
+        prbs_parts = []
+        for start in range(0, indices.size, chunk):
+            input = self.get_data_sample(indices[start:start + chunk],
+                                         bounds=bounds)
+
+            with self.instrumentation.stage('inference', items=input.shape[0]):
+                prbs_parts.append(self.classifier.predict_proba(
+                    input, batch_size=batch_size, verbose=1))
+
+        if settled_prbs is None:
+            return np.concatenate(prbs_parts, axis=0).T
 
-        indices = np.arange(self.active_song.time.size)
-        input = self.get_data_sample(indices)
+        return self._merge_cascade(settled_prbs, indices, prbs_parts).T
 
-        prbs = self.classifier.predict_proba(
-            input, batch_size=batch_size, verbose=1).T
-        # for i in range(prbs.shape[1]):
-        #    print self.active_song.time[i], ':', prbs[:, i]
+    def _settle_active(self):
+        """Run the cascade, if any, over the active song
 
-        #new_prbs = self.probs_to_classes(prbs)
-        # print new_prbs.shape
-#         for i in range(new_prbs.shape[1]):
-#             print self.active_song.time[i], ':', new_prbs[:, i]
+        Returns (probabilities, indices): the cascade's (frames, classes)
+        probabilities, or None without a cascade, and the indices of the
+        frames left for the neural net.
+        """
+        frames = self.active_song.time.size
+        if self.cascade is None:
+            return None, np.arange(frames)
+
+        with self.instrumentation.stage('cascade', items=frames):
+            settled_prbs, settled = self.cascade.settle(
+                self.cascade.features(self.active_song, self.Sxx))
+
+        indices = np.flatnonzero(~settled)
+        self.logger.info('Cascade deferred %d of %d frames to the neural '
+                'net', indices.size, frames)
+
+        return settled_prbs, indices
+
+    def classify_many(self, songfiles):
+        """Classify many SongFiles, sharing inference batches between them
+
+        Each song is processed in turn and its samples are streamed into one
+        buffer of inference_batch samples (4096 by default), which is sent
+        to the classifier whenever it fills, so short songs are classified
+        in batches as large as those of one long song.  Probabilities are
+        scattered back to their songs, and each song is post-processed (and
+        indexed, with a region_index) as soon as all its frames are back.
+
+        Samples are scaled as classify_active would scale them: by
+        self.normalization, or else by the min and max of each song.  With a
+        cascade, only deferred frames are batched.
+
+        The active song and spectrogram are left as they were.
+        """
+        batch = self.params.get('inference_batch', 4096)
+
+        saved = (self.active_song, self.Sxx)
+        buffer = None
+        fill = 0
+        segments = []
+        # per song: [SongFile, (frames, classes) probabilities, frames left]
+        results = []
+
+        try:
+            for sf in songfiles:
+                self.active_song = sf
+                self.Sxx = self.process(sf)
+
+                settled_prbs, indices = self._settle_active()
+                results.append([sf, settled_prbs, indices.size])
+
+                if self.normalization is None and indices.size:
+                    bounds = self.sample_bounds()
+                else:
+                    bounds = None
+
+                pos = 0
+                while pos < indices.size:
+                    take = min(batch - fill, indices.size - pos)
+                    idx = indices[pos:pos + take]
+                    samples = self.get_data_sample(idx, bounds=bounds)
+
+                    if buffer is None:
+                        buffer = np.empty((batch,) + samples.shape[1:],
+                                          dtype=samples.dtype)
+                    buffer[fill:fill + take] = samples
+                    segments.append((len(results) - 1, idx))
+                    fill += take
+                    pos += take
+
+                    if fill == batch:
+                        self._scatter(buffer, segments, results)
+                        fill = 0
+                        segments = []
+
+                self.Sxx = None
+                self._finish_songs(results)
+
+            if fill:
+                self._scatter(buffer[0:fill], segments, results)
+            self._finish_songs(results)
+        finally:
+            self.active_song, self.Sxx = saved
+
+    def _scatter(self, samples, segments, results):
+        """Classify one batch and copy its rows back to their songs"""
+        with self.instrumentation.stage('inference', items=samples.shape[0]):
+            net_prbs = self.classifier.predict_proba(
+                samples, batch_size=samples.shape[0], verbose=0)
+
+        pos = 0
+        for n, idx in segments:
+            result = results[n]
+            part = net_prbs[pos:pos + idx.size]
+            pos += idx.size
+
+            prbs = result[1]
+            if prbs is None:
+                prbs = np.zeros((result[0].time.size, part.shape[1]))
+            elif prbs.shape[1] < part.shape[1]:
+                prbs = np.hstack((prbs, np.zeros(
+                    (prbs.shape[0], part.shape[1] - prbs.shape[1]))))
+
+            prbs[idx] = 0
+            prbs[idx, 0:part.shape[1]] = part
+            result[1] = prbs
+            result[2] -= idx.size
+
+    def _finish_songs(self, results):
+        """Post-process every song whose probabilities are complete"""
+        for result in results:
+            sf, prbs, remaining = result
+            if remaining or sf is None:
+                continue
+
+            if prbs is None:  # a song with no frames
+                sf.classification = LabelRuns.constant(0)
+            else:
+                self.logger.info('Classifying {0}'.format(str(sf)))
+                sf.classification = self.postprocess(prbs.T, sf)
+                if self.region_index is not None:
+                    self.region_index.add_song(sf)
+
+            # release the probabilities; the SongFile is done
+            result[0] = result[1] = None
+
+    @staticmethod
+    def _merge_cascade(settled_prbs, indices, prbs_parts):
+        """Put the net's probabilities for deferred frames into the cascade's
+
+        Returns a (frames, classes) array with as many classes as the wider
+        of the two.
+        """
+        num_classes = settled_prbs.shape[1]
+        if prbs_parts:
+            net_prbs = np.concatenate(prbs_parts, axis=0)
+            num_classes = max(num_classes, net_prbs.shape[1])
+
+        prbs = np.zeros((settled_prbs.shape[0], num_classes))
+        prbs[:, 0:settled_prbs.shape[1]] = settled_prbs
+        if prbs_parts:
+            prbs[indices] = 0
+            prbs[indices, 0:net_prbs.shape[1]] = net_prbs
+
+        return prbs
+
+    def postprocess(self, prbs, sf):
+        """Turn class probabilities for the frames of sf into classes
+
+        The probabilities are smoothed (smooth_time), frames below
+        power_threshold dB are set to class 0, and the result is median
+        filtered (medfilt_time).  Only sf.time and sf.power are used.
+        """
+        frames = prbs.shape[1]
+
+        with self.instrumentation.stage('smoothing', items=frames):
+            unfiltered_classes = self.probs_to_classes(prbs, sf)
 
-        unfiltered_classes = self.probs_to_classes(prbs)
         try:
             power_threshold = self.params['power_threshold']
         except KeyError:
             thresholded_classes = unfiltered_classes
         else:
             self.logger.debug('Thresholding at {0} dB'.format(power_threshold))
-            below_threshold = np.flatnonzero(
-                10 * np.log10(self.active_song.power) < power_threshold)
+            with self.instrumentation.stage('thresholding', items=frames):
+                below_threshold = np.flatnonzero(
+                    10 * np.log10(sf.power) < power_threshold)
+                thresholded_classes = unfiltered_classes
+                thresholded_classes[below_threshold] = 0
             self.logger.debug(
                 '{0} indices found with low power'.format(below_threshold.size))
-            thresholded_classes = unfiltered_classes
-            thresholded_classes[below_threshold] = 0
 
         # no need to be wasteful, filter if there is a filter
         try:
@@ -437,23 +1325,29 @@ class AudioAnalyzer():
         except KeyError:
             filtered_classes = thresholded_classes
         else:
-            dt = self.active_song.time[1] - self.active_song.time[0]
+            dt = sf.time[1] - sf.time[0]
             windowsize = int(np.round(medfilt_time / dt))
             windowsize = windowsize + (windowsize + 1) % 2
 
-            filtered_classes = signal.medfilt(thresholded_classes, windowsize)
+            with self.instrumentation.stage('medfilt', items=frames):
+                filtered_classes = signal.medfilt(
+                    thresholded_classes, windowsize)
 
-        self.active_song.classification = filtered_classes
+        return filtered_classes
 
-    def probs_to_classes(self, probabilities):
+    def probs_to_classes(self, probabilities, sf=None):
         """Takes a likelihood matrix produced by predict_proba and returns
         the classification for each entry
 
         Naive argmax returns a very noisy signal - windowing helps focus on
-        strongly matching areas.
+        strongly matching areas.  The frame times come from sf, or from the
+        active song if sf is not given.
         """
+        if sf is None:
+            sf = self.active_song
+
         smooth_time = self.params.get('smooth_time', 0.1)
-        dt = self.active_song.time[1] - self.active_song.time[0]
+        dt = sf.time[1] - sf.time[0]
         windowsize = np.round(smooth_time / dt)
         window = signal.get_window('hamming', int(windowsize))
         window /= np.sum(window)
@@ -477,34 +1371,111 @@ class SongFile(object):
     Instead, this stores the basic song data: Fs, analog signal data"""
     logger = logging.getLogger('JLAA.SongFile')
 
-    def __init__(self, data, Fs, name='', start=0):
+    # silence mode: the envelope's block and smoothing lengths, and how far
+    # above the file's noise floor a gap may be
+    GAP_BLOCK_MS = 10
+    GAP_SMOOTH_MS = 50
+    GAP_FLOOR_RATIO = 4.0
+
+    def __init__(self, data, Fs, name='', start=0, scale=None):
         """Create a SongFile for storing signal data
 
         Inputs:
             data: a numpy array with time series data.  For use with PyAudio,
                 ensure the format of data is the same as the player
-            Fs: sampling frequency, ideally a float
+            Fs: sampling frequency, ideally a float.  Multi-channel data is
+                shaped (samples, channels).
         Keyword Arguments:
             name: a string identifying where this SongFile came from
             start: a value in seconds indicating that the SongFile's data does
                 not come from the start of a longer signal
+            scale: if given, data holds integer samples (usually the int16
+                samples of a WAV file) and the signal is data * scale
         """
 
-        # Values passed into the init
-        self.data = data
+        # Values passed into the init; integer samples are kept as they are
+        # and only converted to float a block at a time
+        self.samples = data
+        self.scale = scale
         self.Fs = Fs
 
         # Post-processed values (does not include spectrogram)
         self.time = None
         self.freq = None
-        self.classification = None
+        self.classification_runs = None
         self.entropy = None
         self.power = None
 
+        # Per-channel values of multi-channel data; the values above are
+        # their combination
+        self.channel_entropy = None
+        self.channel_power = None
+        self.channel_classification = None
+
         self.name = name
         self.start = start
 
-        self.length = len(self.data) / self.Fs
+        # The file the data was read from, and the absolute time (POSIX
+        # seconds) that start is measured from, when known
+        self.source = None
+        self.recorded = None
+
+        self.length = len(self.samples) / self.Fs
+
+    @property
+    def data(self):
+        """The signal as a float array
+
+        For integer samples this converts the whole signal on every access;
+        use read() for a block of it.
+        """
+        if self.scale is None:
+            return self.samples
+        return self.read()
+
+    @data.setter
+    def data(self, value):
+        self.samples = value
+        self.scale = None
+
+    @property
+    def channels(self):
+        return 1 if self.samples.ndim == 1 else self.samples.shape[1]
+
+    def channel(self, c):
+        """A mono SongFile of channel c
+
+        The samples are a view of this SongFile's, and its time, frequency,
+        power, entropy and classification are those of channel c, once this
+        SongFile has been processed (and classified per channel).
+        """
+        sf = SongFile(self.samples[:, c], self.Fs,
+                      name='{0}_ch{1}'.format(self.name, c), start=self.start,
+                      scale=self.scale)
+        sf.source = self.source
+        sf.recorded = self.recorded
+        sf.time = self.time
+        sf.freq = self.freq
+
+        if self.channel_power is not None:
+            sf.power = self.channel_power[c]
+            sf.entropy = self.channel_entropy[c]
+        if self.channel_classification is not None:
+            sf.classification = self.channel_classification[c]
+        else:
+            sf.classification = self.classification_runs
+
+        return sf
+
+    def read(self, first=0, last=None, dtype=np.float32):
+        """The signal from sample first to last as a float array of dtype"""
+        block = self.samples[first:last]
+        if self.scale is None:
+            return np.asarray(block, dtype=dtype)
+
+        out = block.astype(dtype)
+        out *= np.dtype(dtype).type(self.scale)
+        return out
 
     @property
     def domain(self):
@@ -516,44 +1487,137 @@ class SongFile(object):
 
     @property
     def num_classes(self):
-        return len(np.unique(self.classification))
+        return len(np.unique(self.classification_runs.values))
+
+    @property
+    def classification(self):
+        """The class of each STFT frame as a dense array, or None
+
+        Classifications are stored run-length encoded in classification_runs.
+        Reading this property decodes a new dense array; assigning a dense
+        array or a LabelRuns to it replaces the stored runs.
+        """
+        if self.classification_runs is None:
+            return None
+
+        return self.classification_runs.to_dense()
+
+    @classification.setter
+    def classification(self, value):
+        if value is None or isinstance(value, LabelRuns):
+            self.classification_runs = value
+        else:
+            self.classification_runs = LabelRuns.from_dense(value)
+
+    def label_at(self, t):
+        """The class of the frames at time(s) t, in the SongFile's time"""
+        idx = np.searchsorted(self.time, t, side='right') - 1
+        return self.classification_runs.at(np.clip(idx, 0, self.time.size - 1))
+
+    def runs_between(self, t0, t1):
+        """Classification runs overlapping the time range [t0, t1]
+
+        Returns (start times, end times, labels) arrays; the end time of a run
+        is the time of the first frame after it.
+        """
+        first = np.searchsorted(self.time, t0, side='right') - 1
+        last = np.searchsorted(self.time, t1, side='right')
+        starts, stops, values = self.classification_runs.overlapping(
+            first, last)
+
+        times = np.append(self.time, self.time[-1] + (
+            self.time[-1] - self.time[-2] if self.time.size > 1 else 0))
+        return times[starts], times[stops], values
+
+    def __setstate__(self, state):
+        # SongFiles pickled before run-length encoding store a dense array
+        if 'classification' in state:
+            classification = state.pop('classification')
+            state['classification_runs'] = (
+                None if classification is None
+                else LabelRuns.from_dense(classification))
+
+        state.setdefault('source', None)
+        state.setdefault('recorded', None)
+        state.setdefault('channel_entropy', None)
+        state.setdefault('channel_power', None)
+        state.setdefault('channel_classification', None)
+
+        # and SongFiles pickled before integer storage hold float data
+        if 'data' in state:
+            state['samples'] = state.pop('data')
+            state['scale'] = None
+
+        self.__dict__.update(state)
 
     @classmethod
-    def load(cls, filename, split=600, downsampling=None):
+    def load(cls, filename, split=600, downsampling=None,
+             instrumentation=None, recorded=None, split_mode='fixed',
+             split_tolerance=5.0, channels=0):
         """Loads a file, splitting it into multiple SongFiles if necessary
 
         Inputs: 
-            filename: a .WAV file path in filename
+            filename: a .WAV file path in filename, or a block audio file
+                (see BlockAudioFile)
             split: a length, in seconds, at which the audio file should be split.
                 Defaults to 300 seconds, or 5 minutes, if not specified
             downsampling: the integer ratio by which the song should be sampled
+            instrumentation: an Instrumentation to record the load stage
+            recorded: the time the recording began, in POSIX seconds, or a
+                function of filename returning it (or None), e.g. a parser
+                of timestamps in file names.  Defaults to the 'recorded'
+                entry of a block audio file's header, if there is one, and
+                otherwise is left unknown.  The modification time of the
+                file is not used, since it is when writing the file ended.
+            split_mode: 'fixed' to cut exactly every split seconds, or
+                'silence' to move each cut to the nearest quiet gap within
+                split_tolerance seconds, so sections do not cut through song.
+                A cut with no gap that near stays put, with a warning.
+            split_tolerance: how far, in seconds, a cut may move in silence
+                mode
+            channels: the channel to keep, as an integer, a list of channels
+                to keep together, or None for every channel.  The default
+                keeps only the first channel.  A warning is logged when
+                channels are left out.
+
+        When the file is split, a WAV file is read through a memory map and
+        the integer samples of each section are a view of it, so only the
+        parts of the file that are processed are read into memory.
 
         Returns an array of SongFiles"""
-
-        rate, data = scipy.io.wavfile.read(filename)
-        fs = np.float64(rate)
-        data = np.float32(data) / np.max(data)
-
-        if data.ndim != 1:
-            data = data[:, 0]
+        if instrumentation is None:
+            instrumentation = Instrumentation()
+
+        with instrumentation.stage('load') as record:
+            stored = None
+            if os.path.splitext(filename)[1] == BlockAudioFile.EXTENSION:
+                with BlockAudioFile(filename) as blocks:
+                    rate, data, scale = blocks.Fs, blocks.read(), blocks.scale
+                    stored = blocks.header.get('recorded')
+            else:
+                rate, data = scipy.io.wavfile.read(filename,
+                                                   mmap=bool(split))
+                scale = None
+            fs = np.float64(rate)
+
+            # integer samples stay as they are, scaled so the peak is 1;
+            # float samples are divided by the peak a section at a time
+            peak = np.max(data)
+            if np.issubdtype(data.dtype, np.integer):
+                if scale is None:
+                    scale = 1.0 / peak
+            else:
+                scale = None
+            record['items'] = data.shape[0]
 
         if downsampling:
             fs = fs / downsampling
             data = data[::downsampling]
 
         if split:
-            nperfile = split * fs
-            startidx = 0
-            sections = []
-            while startidx < data.shape[0]:
-                next_section = (startidx, startidx + nperfile)
-                startidx += nperfile
-
-                if (data.shape[0] - startidx) / fs < 1.0:
-                    next_section = (next_section[0], data.shape[0])
-                    startidx = data.shape[0]
-
-                sections.append(next_section)
+            nperfile = int(split * fs)
+            sections = cls._sections(data, fs, nperfile, split_mode,
+                                     int(split_tolerance * fs), channels)
         else:
             nperfile = data.shape[0]
             sections = [(0, nperfile)]
@@ -566,41 +1630,214 @@ class SongFile(object):
                 'enable splitting or use a shorter file for'
                 ' NN training'.format(nperfile / fs))
 
+        recorded = cls._recording_time(filename, recorded, stored)
+
+        cls._warn_dropped(filename, data, channels)
         sfs = []
 
         for (startidx, endidx) in sections:
-            songdata = data[startidx:endidx]
+            songdata = cls._select_channels(data[startidx:endidx], channels)
+            if scale is None:
+                songdata = np.float32(songdata) / peak
             fname = os.path.splitext(os.path.basename(filename))[0]
             next_sf = cls(
-                songdata, fs, name=fname, start=startidx / fs)
+                songdata, fs, name=fname, start=startidx / fs, scale=scale)
+            next_sf.source = os.path.abspath(filename)
+            next_sf.recorded = recorded
 
             sfs.append(next_sf)
 
         return sfs
 
-    def find_motifs(self, **params):
+    @staticmethod
+    def _recording_time(filename, recorded, stored=None):
+        """The start time of a recording from the recorded argument of load
+
+        recorded may be POSIX seconds, a function of the filename returning
+        them or None, or None to use the time stored with the file, if any.
+        """
+        if callable(recorded):
+            recorded = recorded(filename)
+        if recorded is None:
+            return stored
+
+        return float(recorded)
+
+    @staticmethod
+    def _select_channels(data, channels):
+        """The channels of (samples, channels) data chosen as in load"""
+        if channels is None:
+            return data
+        if data.ndim == 1:
+            data = data[:, np.newaxis]
+
+        return data[:, channels]
+
+    @classmethod
+    def _warn_dropped(cls, filename, data, channels):
+        """Log a warning if channels leaves out some channels of data"""
+        available = 1 if data.ndim == 1 else data.shape[1]
+        if channels is None or len(np.unique(channels)) >= available:
+            return
+
+        cls.logger.warning('%s has %d channels; keeping only channel %s.  '
+                'Pass channels=None to keep them all', filename, available,
+                ', '.join(str(c) for c in np.atleast_1d(channels)))
+
+    @classmethod
+    def load_range(cls, filename, t0, t1, recorded=None, channels=0):
+        """Load the time range [t0, t1) seconds of a block audio file
+
+        Only the compressed blocks covering the range are read, so this costs
+        the same for any range of any length of recording.  The SongFile's
+        samples are scaled as SongFile.load would scale them, and channels
+        and the recording time are chosen as in SongFile.load.
+        """
+        with BlockAudioFile(filename) as blocks:
+            first = int(t0 * blocks.Fs)
+            samples = blocks.read(first, int(np.ceil(t1 * blocks.Fs)))
+            fs = np.float64(blocks.Fs)
+            scale = blocks.scale
+            stored = blocks.header.get('recorded')
+
+        cls._warn_dropped(filename, samples, channels)
+        samples = cls._select_channels(samples, channels)
+
+        sf = cls(samples, fs,
+                 name=os.path.splitext(os.path.basename(filename))[0],
+                 start=first / fs, scale=scale)
+        sf.source = os.path.abspath(filename)
+        sf.recorded = cls._recording_time(filename, recorded, stored)
+
+        return sf
+
+    @classmethod
+    def _sections(cls, data, fs, nperfile, split_mode, tolerance,
+                  channels=None):
+        """(start, end) sample indices of the sections of data
+
+        A final section shorter than one second is joined to the one before.
+        Silence is found in the given channels, chosen as in load.  Where
+        there is no quiet gap within tolerance samples of a cut, a warning is
+        logged and the cut stays where it is.
+        """
+        if split_mode not in ('fixed', 'silence'):
+            cls.logger.error('Unknown split mode %s', split_mode)
+            raise ValueError('Unknown split mode {0}, must be fixed or '
+                             'silence'.format(split_mode))
+
+        n = data.shape[0]
+        if split_mode == 'silence' and nperfile < n:
+            block = max(1, int(fs * cls.GAP_BLOCK_MS / 1000))
+            energy = cls._envelope(data, block, channels)
+            smooth = max(1, int(cls.GAP_SMOOTH_MS / cls.GAP_BLOCK_MS))
+            if smooth > 1 and energy.size >= smooth:
+                energy = np.convolve(energy, np.ones(smooth) / smooth, 'same')
+            floor = np.percentile(energy, 10) if energy.size else 0
+
+        sections = []
+        startidx = 0
+        while startidx < n:
+            endidx = startidx + nperfile
+            if split_mode == 'silence' and endidx < n:
+                cut = cls._quiet_cut(
+                    energy, block, endidx,
+                    max(startidx + int(fs), endidx - tolerance),
+                    min(n, endidx + tolerance), floor)
+                if cut is None:
+                    cls.logger.warning('No quiet gap within %g seconds of '
+                            'the cut at %g seconds; cutting there anyway',
+                            tolerance / fs, endidx / fs)
+                else:
+                    endidx = cut
+
+            if (n - endidx) / fs < 1.0:
+                endidx = n
+
+            sections.append((startidx, endidx))
+            startidx = endidx
+
+        return sections
+
+    @staticmethod
+    def _envelope(data, block, channels=None, chunk_blocks=4096):
+        """The mean square of each block of samples of data
+
+        data is read chunk_blocks blocks at a time, so a memory mapped file
+        is streamed rather than read whole.  A final partial block is left
+        out.
+        """
+        nblocks = data.shape[0] // block
+        energy = np.empty(nblocks)
+        for b in range(0, nblocks, chunk_blocks):
+            stop = min(nblocks, b + chunk_blocks)
+            window = np.asarray(SongFile._select_channels(
+                data[b * block:stop * block], channels), dtype=np.float64)
+            energy[b:stop] = np.mean(
+                np.square(window.reshape(stop - b, -1)), axis=1)
+
+        return energy
+
+    @classmethod
+    def _quiet_cut(cls, energy, block, center, first, last, floor):
+        """The sample nearest center, in [first, last), at a quiet gap
+
+        energy is the smoothed envelope of the file from _envelope, in blocks
+        of block samples, and floor its noise level (its 10th percentile).
+        Blocks within 3 dB of the quietest one in the window count as gaps,
+        provided they are also within GAP_FLOOR_RATIO of the floor; a window
+        that is all song has no gap.  The cut is placed in the middle of the
+        gap block closest to center, or None is returned if there is none.
+        """
+        b0 = -(-first // block)
+        b1 = min(energy.size, last // block)
+        if b1 <= b0:
+            return None
+
+        window = energy[b0:b1]
+        limit = min(2 * np.amin(window), cls.GAP_FLOOR_RATIO * floor)
+        gaps = np.flatnonzero(window <= limit)
+        if gaps.size == 0:
+            return None
+
+        mids = (b0 + gaps) * block + block // 2
+
+        return int(mids[np.argmin(np.abs(mids - center))])
+
+    def find_motifs(self, instrumentation=None, **params):
         """Cut motifs from a classified SongFile and build SongFiles from them
 
         This method takes a SongFile, assumes it has already been correctly
         classified and therefore has a classification that is not None, it scans
         through that classification and determines (with some resistance to 
         noise) the regions where there appears to be a motif.
+
+        If an Instrumentation is given, the search is recorded as the motifs
+        stage.
         """
+        if instrumentation is None:
+            instrumentation = Instrumentation()
+
+        with instrumentation.stage('motifs') as record:
+            motifs = self._find_motifs(**params)
+            record['items'] = len(motifs)
+
+        return motifs
+
+    def _find_motifs(self, **params):
 
         min_density = params.get('min_density', 0.80)
         min_dense_time = params.get('min_dense_time', 0.5)
         join_gap = params.get('join_gap', 1.0)
 
-        regions = []
-        noise = True
-        for idx, val in enumerate(self.classification):
-            if val != 0 and noise:
-                start = idx
-                noise = False
+        runs = self.classification_runs
+        starts, stops = runs.regions()
 
-            if val == 0 and not noise:
-                noise = True
-                regions.append((start, idx, 1.0))
+        # a region still open at the end of the track is never closed
+        if stops.size and stops[-1] == runs.size and runs.values[-1] != 0:
+            starts, stops = starts[:-1], stops[:-1]
+
+        regions = [(start, stop, 1.0) for start, stop in zip(starts, stops)]
 
         # time of first idx, time of last idx, density
         regions = [(self.time[reg[0]], self.time[reg[1]], reg[2])
@@ -652,17 +1889,23 @@ class SongFile(object):
             r = (r[0] - 1.0, r[1] + 1.0)
             left, right = self.time_to_idx(r[0]), self.time_to_idx(r[1])
 
-            data = self.data[left:right]
+            data = self.samples[left:right]
             Fs = self.Fs
 
             indices = np.searchsorted(self.time, np.asarray(r))
 
-            classification = self.classification[indices[0]:indices[1]]
+            classification = runs.slice(indices[0], indices[1])
 
             sf = SongFile(
-                data, Fs, name=self.name, start=self.time[indices[0]])
+                data, Fs, name=self.name, start=self.time[indices[0]],
+                scale=self.scale)
             sf.classification = classification
 
+            # motif starts are measured from the start of this SongFile
+            sf.source = self.source
+            if self.recorded is not None:
+                sf.recorded = self.recorded + self.start
+
             motifs.append(sf)
 
         self.logger.info(
@@ -679,29 +1922,32 @@ class SongFile(object):
         return '{:s}_{:03d}_{:03d}'.format(
             self.name, int(self.start), int(self.length + self.start))
 
+    def output_filename(self, filename=None, extension='.wav'):
+        """The name of a file written from this SongFile
+
+        Defaults to str(self); extension is added unless filename already
+        ends with it.
+        """
+        if filename is None:
+            return str(self) + extension
+        elif os.path.splitext(filename)[1] != extension:
+            return filename + extension
+
+        return filename
+
     def export(self, destination, filename=None):
         """Exports data in WAV format
 
         Not useful for SongFiles you just loaded, but possibly quite useful for
-        generated SongFiles.
+        generated SongFiles.  Integer samples are written as they are.
         """
+        fullpath = os.path.join(destination, self.output_filename(filename))
 
-        if filename is None:
-            filename = str(self) + '.wav'
-        elif os.path.splitext(filename)[1] is not '.wav':
-            filename = filename + '.wav'
-
-        fullpath = os.path.join(destination, filename)
-
-        scipy.io.wavfile.write(fullpath, int(self.Fs), self.data)
+        scipy.io.wavfile.write(fullpath, int(self.Fs), self.samples)
 
     def serialize(self, destination, filename=None):
-        if filename is None:
-            filename = str(self) + '.pkl'
-        elif os.path.splitext(filename)[1] != '.pkl':
-            filename = filename + '.pkl'
-
-        fullpath = os.path.join(destination, filename)
+        fullpath = os.path.join(destination,
+                                self.output_filename(filename, '.pkl'))
         self.logger.info('Serializing to %s', fullpath)
         with open(fullpath, 'w') as outputfile:
             pickle.dump(self, outputfile)
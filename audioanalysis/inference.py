@@ -0,0 +1,365 @@
+"""
+Local batched inference server sharing one loaded neural net between processes
+
+Copyright 2015 Justin Palpant
+
+This file is part of the Jarvis Lab Audio Analysis program.
+
+Audio Analysis is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+Audio Analysis is distributed in the hope that it will be useful, but WITHOUT
+ANYWARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Audio Analysis. If not, see http://www.gnu.org/licenses/.
+"""
+import os
+import sys
+import time
+import logging
+import tempfile
+import threading
+from multiprocessing.connection import Listener, Client
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import numpy as np
+
+from audioanalysis.freqanalysis import AudioAnalyzer
+
+
+# Sample buffers are shared through files here, which are memory backed on
+# Linux; elsewhere they fall back to the ordinary temporary directory
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+DEFAULT_ADDRESS = os.path.join(tempfile.gettempdir(), 'jlaa-inference.sock')
+
+
+def _family(address):
+    """The multiprocessing.connection family for an address
+
+    A string is a Unix socket path; a (host, port) tuple is a TCP address.
+    """
+    if isinstance(address, tuple):
+        return 'AF_INET'
+    return 'AF_UNIX'
+
+
+class InferenceServer(object):
+    """Serves predict_proba calls for one exported neural net
+
+    The model is loaded once with AudioAnalyzer.load_neural_net.  Clients
+    connect over a Unix socket or a localhost TCP port, write their samples
+    to a shared memory file and send only its location.  Requests arriving
+    together are merged into micro-batches of up to max_batch samples; a
+    batch is run as soon as it is full or when the oldest request in it has
+    waited max_latency_ms.  Results go back to each client over its
+    connection.
+
+    All calls to the model come from a single thread.
+    """
+    logger = logging.getLogger('JLAA.InferenceServer')
+
+    def __init__(self, folder, address=DEFAULT_ADDRESS, authkey=None,
+                 max_batch=4096, max_latency_ms=5, batch_size=None):
+        """Load the model exported to folder and listen on address
+
+        Inputs:
+            folder: a folder written by AudioAnalyzer.export_neural_net
+        Keyword Arguments:
+            address: a Unix socket path or a (host, port) tuple
+            authkey: bytes clients must present to connect
+            max_batch: the number of samples at which a batch is run without
+                waiting any longer
+            max_latency_ms: the longest a request waits for others to join
+                its batch
+            batch_size: the batch size passed to the model; defaults to
+                max_batch
+        """
+        self.folder = os.path.abspath(folder)
+        self.address = address
+        self.max_batch = max_batch
+        self.max_latency = max_latency_ms / 1000.0
+        self.batch_size = batch_size or max_batch
+
+        self.classifier = AudioAnalyzer().load_neural_net(folder)
+
+        if _family(address) == 'AF_UNIX' and os.path.exists(address):
+            os.unlink(address)
+        self._authkey = authkey
+        self._listener = Listener(address, family=_family(address),
+                                  authkey=authkey)
+        self._requests = queue.Queue()
+        self._running = True
+
+        # counters for the log, updated only by the batching thread
+        self.batches = 0
+        self.requests = 0
+
+        self.logger.info('Serving %s on %s', self.folder, str(address))
+
+    def serve_forever(self):
+        """Accept clients until close() is called or a client asks to stop"""
+        batcher = threading.Thread(target=self._batch_loop)
+        batcher.daemon = True
+        batcher.start()
+
+        try:
+            while self._running:
+                try:
+                    conn = self._listener.accept()
+                except (IOError, OSError, EOFError):
+                    if not self._running:
+                        break
+                    self.logger.warning('Failed to accept a client',
+                                        exc_info=True)
+                    continue
+
+                if not self._running:
+                    conn.close()
+                    break
+
+                t = threading.Thread(target=self._handle, args=(conn,))
+                t.daemon = True
+                t.start()
+        finally:
+            self._running = False
+            self._requests.put(None)
+            batcher.join()
+
+    def close(self):
+        """Stop accepting clients and remove the socket"""
+        if not self._running:
+            return
+
+        self._running = False
+        try:
+            # wake a blocked accept() so serve_forever sees the flag
+            Client(self.address, family=_family(self.address),
+                   authkey=self._authkey).close()
+        except Exception:
+            pass
+
+        try:
+            self._listener.close()
+        finally:
+            if (_family(self.address) == 'AF_UNIX' and
+                    os.path.exists(self.address)):
+                os.unlink(self.address)
+
+    def _handle(self, conn):
+        """Read requests from one client; runs in its own thread"""
+        conn.send({'folder': self.folder, 'max_batch': self.max_batch})
+        done = threading.Event()
+
+        try:
+            while self._running:
+                try:
+                    message = conn.recv()
+                except (EOFError, IOError, OSError):
+                    break
+
+                if message[0] == 'predict':
+                    _, path, shape, dtype = message
+                    try:
+                        if np.prod(shape) == 0:
+                            X = np.zeros(shape, dtype=dtype)
+                        else:
+                            X = np.memmap(path, dtype=dtype, mode='r',
+                                          shape=tuple(shape))
+                    except Exception as e:
+                        conn.send(('error', str(e)))
+                        continue
+
+                    done.clear()
+                    self._requests.put((conn, X, done, time.time()))
+                    # the client waits for its reply before reusing the
+                    # buffer, so one request per connection is in flight
+                    done.wait()
+                elif message[0] == 'shutdown':
+                    self.logger.info('Shutdown requested by a client')
+                    self.close()
+                    break
+                else:
+                    conn.send(('error', 'Unknown request {0}'.format(
+                        message[0])))
+        finally:
+            conn.close()
+
+    def _batch_loop(self):
+        """Gather queued requests into micro-batches and run them"""
+        while True:
+            first = self._requests.get()
+            if first is None:
+                return
+
+            batch = [first]
+            count = first[1].shape[0]
+            deadline = first[3] + self.max_latency
+
+            while count < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._requests.put(None)
+                    break
+                batch.append(item)
+                count += item[1].shape[0]
+
+            self._run(batch)
+
+    def _run(self, batch):
+        """Predict one micro-batch and reply to each of its requests"""
+        try:
+            if len(batch) == 1:
+                X = batch[0][1]
+            else:
+                X = np.concatenate([item[1] for item in batch], axis=0)
+
+            prbs = self.classifier.predict_proba(
+                X, batch_size=self.batch_size, verbose=0)
+        except Exception as e:
+            self.logger.error('Inference failed for a batch of %d requests: '
+                    '%s', len(batch), e)
+            replies = [('error', str(e))] * len(batch)
+        else:
+            bounds = np.cumsum([0] + [item[1].shape[0] for item in batch])
+            replies = [('ok', prbs[bounds[i]:bounds[i + 1]])
+                       for i in range(len(batch))]
+
+        self.batches += 1
+        self.requests += len(batch)
+        self.logger.debug('Ran a batch of %d samples from %d requests',
+                sum(item[1].shape[0] for item in batch), len(batch))
+
+        for (conn, _, done, _), reply in zip(batch, replies):
+            try:
+                conn.send(reply)
+            except (IOError, OSError):
+                self.logger.warning('Lost a client before replying')
+            finally:
+                done.set()
+
+
+class InferenceClient(object):
+    """A classifier backend that forwards predict_proba to an InferenceServer
+
+    Use in place of a Keras model as AudioAnalyzer.classifier; see
+    AudioAnalyzer.connect_inference_server.  Samples are written to a shared
+    memory file owned by this client, which grows as needed and is removed
+    by close().  A client may be shared between threads, whose calls are
+    then serialized.
+    """
+    logger = logging.getLogger('JLAA.InferenceClient')
+
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None):
+        """Connect to the InferenceServer listening on address"""
+        self.address = address
+        self._conn = Client(address, family=_family(address), authkey=authkey)
+        self.info = self._conn.recv()
+        self._lock = threading.Lock()
+
+        fd, self._path = tempfile.mkstemp(prefix='jlaa-samples-', dir=SHM_DIR)
+        os.close(fd)
+        self._capacity = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def folder(self):
+        """The model folder of the server"""
+        return self.info['folder']
+
+    def predict_proba(self, X, batch_size=None, verbose=0):
+        """Class probabilities of the samples in X
+
+        The signature matches the Keras model method; batch_size and verbose
+        are ignored, since the server chooses its own batches.
+        """
+        X = np.ascontiguousarray(X)
+
+        with self._lock:
+            if self._conn is None:
+                raise ValueError('Cannot predict with a closed '
+                                 'InferenceClient')
+
+            if X.nbytes > self._capacity:
+                with open(self._path, 'r+b') as f:
+                    f.truncate(X.nbytes)
+                self._capacity = X.nbytes
+
+            if X.size:
+                shared = np.memmap(self._path, dtype=X.dtype, mode='r+',
+                                   shape=X.shape)
+                shared[...] = X
+                del shared
+
+            self._conn.send(('predict', self._path, X.shape, X.dtype.str))
+            status, result = self._conn.recv()
+
+        if status != 'ok':
+            self.logger.error('Inference server error: %s', result)
+            raise ValueError('Inference server error: {0}'.format(result))
+
+        return result
+
+    def shutdown(self):
+        """Ask the server to stop, then close this client"""
+        with self._lock:
+            self._conn.send(('shutdown',))
+        self.close()
+
+    def close(self):
+        """Disconnect and remove the shared memory file"""
+        if self._conn is None:
+            return
+
+        self._conn.close()
+        self._conn = None
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def serve(folder, address=DEFAULT_ADDRESS, **kwargs):
+    """Run an InferenceServer until it is shut down
+
+    Suitable as the target of a multiprocessing.Process.  Keyword arguments
+    are passed to InferenceServer.
+    """
+    server = InferenceServer(folder, address=address, **kwargs)
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    if len(sys.argv) not in (2, 3):
+        sys.exit('Usage: python -m audioanalysis.inference MODEL_FOLDER '
+                 '[SOCKET_PATH]')
+
+    serve(*sys.argv[1:])
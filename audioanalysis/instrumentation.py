@@ -0,0 +1,248 @@
+"""
+Stage timing and memory instrumentation for the audio analysis pipeline
+
+Copyright 2015 Justin Palpant
+
+This file is part of the Jarvis Lab Audio Analysis program.
+
+Audio Analysis is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+Audio Analysis is distributed in the hope that it will be useful, but WITHOUT
+ANYWARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Audio Analysis. If not, see http://www.gnu.org/licenses/.
+"""
+import sys
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    process_time = time.process_time
+except AttributeError:
+    process_time = time.clock
+
+
+class Instrumentation(object):
+    """Records wall time, CPU time and memory for each stage of the pipeline
+
+    Stages are wrapped in the stage() context manager.  When the stage exits a
+    record (a plain dict) is handed to every registered sink.  A sink is any
+    callable taking one record, such as JSONLinesSink or AggregateSink.
+
+    Each record contains:
+        stage: the name of the stage
+        wall_s: elapsed wall clock time in seconds
+        cpu_s: elapsed process CPU time in seconds
+        peak_bytes: peak bytes allocated above the level at stage entry, or
+            None if memory tracing is unavailable or disabled
+        maxrss_bytes: peak resident set size of the process so far, or None
+        items: a stage-specific count (samples, frames, motifs...)
+    plus any keyword tags given to stage().
+
+    With no sinks registered stage() costs next to nothing, so every
+    AudioAnalyzer carries an Instrumentation whether or not it is used.
+    """
+    logger = logging.getLogger('JLAA.Instrumentation')
+
+    def __init__(self, sinks=None, trace_memory=False):
+        """Create an Instrumentation
+
+        Keyword Arguments:
+            sinks: a list of callables that receive each finished record
+            trace_memory: if True, start tracemalloc so that peak_bytes can be
+                reported.  Tracing slows allocation-heavy code noticeably, so
+                it is off by default.  Requires Python 3.9 or newer.
+        """
+        self.sinks = list(sinks) if sinks else []
+        self.trace_memory = False
+        self._local = threading.local()
+
+        if trace_memory:
+            if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak'):
+                self.logger.warning('Memory tracing requested, but tracemalloc'
+                        ' with reset_peak is not available.  peak_bytes will '
+                        'not be reported.')
+            else:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                self.trace_memory = True
+
+    @property
+    def enabled(self):
+        return bool(self.sinks)
+
+    def add_sink(self, sink):
+        """Register a callable to receive finished records"""
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def emit(self, record):
+        """Send a record to every sink"""
+        for sink in self.sinks:
+            sink(record)
+
+    @contextmanager
+    def stage(self, name, items=None, **tags):
+        """Time the enclosed block as the named stage
+
+        The yielded record may be modified inside the block, most commonly to
+        fill in items once the count is known.  Stages may be nested; each
+        stage reports its own peak allocation.
+        """
+        record = dict(tags)
+        record['stage'] = name
+        record['items'] = items
+
+        if not self.sinks:
+            yield record
+            return
+
+        frame = self._enter()
+        wall_start = time.time()
+        cpu_start = process_time()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = time.time() - wall_start
+            record['cpu_s'] = process_time() - cpu_start
+            record['peak_bytes'] = self._exit(frame)
+            record['maxrss_bytes'] = self.maxrss()
+            self.emit(record)
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def _enter(self):
+        """Push a memory frame, folding the current peak into open stages"""
+        if not self.trace_memory:
+            return None
+
+        current, peak = tracemalloc.get_traced_memory()
+        stack = self._stack()
+        for frame in stack:
+            frame['peak'] = max(frame['peak'], peak)
+        tracemalloc.reset_peak()
+
+        frame = {'base': current, 'peak': current}
+        stack.append(frame)
+        return frame
+
+    def _exit(self, frame):
+        """Pop a memory frame and return its peak allocation in bytes"""
+        if frame is None:
+            return None
+
+        _, peak = tracemalloc.get_traced_memory()
+        stack = self._stack()
+        for f in stack:
+            f['peak'] = max(f['peak'], peak)
+        # frames are dicts, so remove() would match an equal outer frame
+        assert stack[-1] is frame, 'Stages must exit in reverse order'
+        stack.pop()
+
+        return frame['peak'] - frame['base']
+
+    @staticmethod
+    def maxrss():
+        """Peak resident set size of this process in bytes, if known"""
+        if resource is None:
+            return None
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, OS X reports bytes
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class JSONLinesSink(object):
+    """Sink that writes each record as one line of JSON"""
+
+    def __init__(self, target):
+        """Create a JSONLinesSink
+
+        Inputs:
+            target: a file path (opened for appending) or an open file-like
+                object
+        """
+        if hasattr(target, 'write'):
+            self.outfile = target
+            self._owned = False
+        else:
+            self.outfile = open(target, 'a')
+            self._owned = True
+
+    def __call__(self, record):
+        self.outfile.write(json.dumps(record, sort_keys=True) + '\n')
+        self.outfile.flush()
+
+    def close(self):
+        if self._owned:
+            self.outfile.close()
+
+
+class AggregateSink(object):
+    """Sink that accumulates per-stage totals in memory"""
+
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    def __call__(self, record):
+        totals = self.stages.setdefault(record['stage'], {
+            'stage': record['stage'],
+            'count': 0,
+            'wall_s': 0.0,
+            'cpu_s': 0.0,
+            'items': 0,
+            'peak_bytes': None,
+        })
+
+        totals['count'] += 1
+        totals['wall_s'] += record['wall_s']
+        totals['cpu_s'] += record['cpu_s']
+        if record.get('items') is not None:
+            totals['items'] += record['items']
+        if record.get('peak_bytes') is not None:
+            totals['peak_bytes'] = max(totals['peak_bytes'] or 0,
+                                       record['peak_bytes'])
+
+    def summary(self):
+        """Return the per-stage totals, slowest stage first"""
+        return sorted(self.stages.values(),
+                      key=lambda s: s['wall_s'], reverse=True)
+
+    def reset(self):
+        self.stages.clear()
+
+    def __str__(self):
+        lines = ['{:<14s}{:>8s}{:>12s}{:>12s}{:>14s}{:>16s}'.format(
+            'stage', 'count', 'wall (s)', 'cpu (s)', 'items', 'peak (bytes)')]
+        for s in self.summary():
+            lines.append('{:<14s}{:>8d}{:>12.3f}{:>12.3f}{:>14d}{:>16s}'.format(
+                s['stage'], s['count'], s['wall_s'], s['cpu_s'], s['items'],
+                str(s['peak_bytes'])))
+
+        return '\n'.join(lines)
@@ -0,0 +1,394 @@
+"""
+Similarity search over motifs extracted from many recordings
+
+Copyright 2015 Justin Palpant
+
+This file is part of the Jarvis Lab Audio Analysis program.
+
+Audio Analysis is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+Audio Analysis is distributed in the hope that it will be useful, but WITHOUT
+ANYWARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Audio Analysis. If not, see http://www.gnu.org/licenses/.
+"""
+import os
+import json
+import logging
+
+import numpy as np
+
+from audioanalysis.normalization import NormalizationStats
+
+
+class MotifIndex(object):
+    """On-disk index of motif embeddings answering nearest neighbour queries
+
+    Every motif is reduced to two fixed-length descriptions:
+        embedding: the log spectrogram mean-pooled to freq_bands x time_bins,
+            centered and scaled to unit length
+        contour: the power (dB) and entropy tracks resampled to
+            contour_length points, each z-normalized
+    Both are appended to flat float32 files in the index folder and read back
+    as memory maps, with one JSON line of metadata per motif and a table of
+    the byte offsets of those lines.
+
+    A query ranks every stored embedding by Euclidean distance in a single
+    blocked matrix product, keeps the closest candidates, and re-ranks those
+    by exact banded DTW distance between contours.  Candidates are visited in
+    order of their LB_Keogh lower bound and DTW is skipped for any whose bound
+    already exceeds the k-th best distance found.
+    """
+    logger = logging.getLogger('JLAA.MotifIndex')
+
+    HEADER = 'index.json'
+    EMBEDDINGS = 'embeddings.f32'
+    CONTOURS = 'contours.f32'
+    METADATA = 'motifs.jsonl'
+    OFFSETS = 'motifs.offsets'
+
+    # stored embeddings compared with the query per block
+    block_rows = 65536
+
+    def __init__(self, folder, freq_bands=8, time_bins=16, contour_length=64,
+                 warping_window=0.1):
+        """Open the index in folder, creating it if it does not exist
+
+        The keyword arguments only apply to a new index; an existing index
+        keeps the layout it was created with.
+
+        Keyword Arguments:
+            freq_bands: frequency bands in the pooled spectrogram embedding
+            time_bins: time bins in the pooled spectrogram embedding
+            contour_length: points in each resampled power/entropy contour
+            warping_window: the DTW band half-width, as a fraction of
+                contour_length
+        """
+        self.folder = folder
+
+        header_path = os.path.join(folder, self.HEADER)
+        if os.path.exists(header_path):
+            with open(header_path, 'r') as f:
+                self.header = json.load(f)
+            self._truncate_to_count()
+        else:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+
+            self.header = {
+                'count': 0,
+                'freq_bands': freq_bands,
+                'time_bins': time_bins,
+                'contour_length': contour_length,
+                'warping_window': warping_window,
+            }
+            self._write_header()
+
+        self._maps = None
+
+    def __len__(self):
+        return self.header['count']
+
+    @property
+    def dim(self):
+        return self.header['freq_bands'] * self.header['time_bins']
+
+    @property
+    def contour_shape(self):
+        return (2, self.header['contour_length'])
+
+    @property
+    def window(self):
+        return max(1, int(np.round(
+            self.header['warping_window'] * self.header['contour_length'])))
+
+    def _truncate_to_count(self):
+        """Drop rows written after the last completed add_many
+
+        The header count is written after the data files, so an add_many
+        interrupted part way leaves extra rows that would misalign later
+        appends.
+        """
+        n = self.header['count']
+        sizes = [
+            (self.EMBEDDINGS, n * self.dim * 4),
+            (self.CONTOURS, n * int(np.prod(self.contour_shape)) * 4),
+            (self.OFFSETS, n * 8),
+        ]
+
+        metadata = os.path.join(self.folder, self.METADATA)
+        if n == 0:
+            sizes.append((self.METADATA, 0))
+        elif os.path.exists(metadata):
+            last = np.memmap(os.path.join(self.folder, self.OFFSETS),
+                             dtype=np.int64, mode='r', shape=(n,))[n - 1]
+            with open(metadata, 'rb') as f:
+                f.seek(int(last))
+                f.readline()
+                sizes.append((self.METADATA, f.tell()))
+
+        for name, size in sizes:
+            path = os.path.join(self.folder, name)
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                self.logger.warning('Discarding %d bytes of %s written by an '
+                        'interrupted add', os.path.getsize(path) - size, name)
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+
+    def _write_header(self):
+        with open(os.path.join(self.folder, self.HEADER), 'w') as f:
+            json.dump(self.header, f, indent=1)
+
+    def embed(self, sf, Sxx):
+        """Compute the (embedding, contour) pair for a processed SongFile
+
+        Inputs:
+            sf: a SongFile processed by AudioAnalyzer.process
+            Sxx: the spectrogram returned by that call
+        """
+        log_power = NormalizationStats.log_power
+        logS = log_power(Sxx)
+
+        bands = np.stack([np.mean(rows, axis=0) for rows in
+                          np.array_split(logS, self.header['freq_bands'])])
+        pooled = self._resample(bands, self.header['time_bins'], pool=True)
+
+        embedding = pooled.ravel() - np.mean(pooled)
+        norm = np.linalg.norm(embedding)
+        if norm > 0:
+            embedding /= norm
+
+        tracks = np.stack([10 * log_power(np.asarray(sf.power)),
+                           np.asarray(sf.entropy, dtype=np.float64)])
+        contour = self._resample(tracks, self.header['contour_length'])
+        contour -= np.mean(contour, axis=1)[:, np.newaxis]
+        std = np.std(contour, axis=1)
+        contour /= np.where(std > 0, std, 1.0)[:, np.newaxis]
+
+        return embedding.astype(np.float32), contour.astype(np.float32)
+
+    @staticmethod
+    def _resample(tracks, n, pool=False):
+        """Resample the rows of tracks to n columns
+
+        With pool, columns are averaged into n bins when there are enough of
+        them; otherwise the rows are linearly interpolated.
+        """
+        tracks = np.asarray(tracks, dtype=np.float64)
+        if pool and tracks.shape[1] >= n:
+            return np.stack([np.mean(cols, axis=1) for cols in
+                             np.array_split(tracks, n, axis=1)], axis=1)
+
+        x = np.linspace(0, tracks.shape[1] - 1, n)
+        return np.stack([np.interp(x, np.arange(tracks.shape[1]), row)
+                         for row in tracks])
+
+    def add(self, sf, Sxx):
+        """Add one processed motif SongFile to the index, returning its id"""
+        return self.add_many([(sf, Sxx)])[0]
+
+    def add_motifs(self, motifs, analyzer):
+        """Process motif SongFiles with analyzer and add them to the index
+
+        Returns the ids of the added motifs
+        """
+        return self.add_many([(sf, analyzer.process(sf)) for sf in motifs])
+
+    def add_many(self, pairs):
+        """Add (SongFile, spectrogram) pairs to the index, returning their ids"""
+        first = self.header['count']
+        embeddings, contours, meta = [], [], []
+
+        for n, (sf, Sxx) in enumerate(pairs):
+            embedding, contour = self.embed(sf, Sxx)
+            embeddings.append(embedding)
+            contours.append(contour)
+            meta.append({'id': first + n, 'name': sf.name,
+                         'start': float(sf.start),
+                         'length': float(sf.length)})
+
+        if not meta:
+            return []
+
+        with open(os.path.join(self.folder, self.EMBEDDINGS), 'ab') as f:
+            np.stack(embeddings).tofile(f)
+        with open(os.path.join(self.folder, self.CONTOURS), 'ab') as f:
+            np.stack(contours).tofile(f)
+        offsets = []
+        with open(os.path.join(self.folder, self.METADATA), 'ab') as f:
+            for m in meta:
+                offsets.append(f.tell())
+                f.write((json.dumps(m) + '\n').encode('utf-8'))
+        with open(os.path.join(self.folder, self.OFFSETS), 'ab') as f:
+            np.array(offsets, dtype=np.int64).tofile(f)
+
+        self.header['count'] += len(meta)
+        self._write_header()
+        self._maps = None
+
+        self.logger.info('Added %d motifs to the index, %d total',
+                len(meta), self.header['count'])
+
+        return [m['id'] for m in meta]
+
+    def _arrays(self):
+        """Memory maps of the stored embeddings and contours"""
+        if self._maps is None:
+            n = self.header['count']
+            embeddings = np.memmap(os.path.join(self.folder, self.EMBEDDINGS),
+                                   dtype=np.float32, mode='r',
+                                   shape=(n, self.dim))
+            contours = np.memmap(os.path.join(self.folder, self.CONTOURS),
+                                 dtype=np.float32, mode='r',
+                                 shape=(n,) + self.contour_shape)
+            self._maps = (embeddings, contours)
+
+        return self._maps
+
+    def metadata(self, ids):
+        """Return the metadata dicts of the given motif ids, in that order"""
+        offsets = np.memmap(os.path.join(self.folder, self.OFFSETS),
+                            dtype=np.int64, mode='r',
+                            shape=(self.header['count'],))
+
+        results = []
+        with open(os.path.join(self.folder, self.METADATA), 'rb') as f:
+            for i in ids:
+                f.seek(offsets[int(i)])
+                results.append(json.loads(f.readline().decode('utf-8')))
+
+        return results
+
+    def query(self, sf, Sxx, k=10, candidates=200, rerank=True):
+        """Find the k stored motifs most similar to a processed SongFile
+
+        Inputs:
+            sf, Sxx: the query motif and its spectrogram, as for embed
+        Keyword Arguments:
+            k: the number of neighbours to return
+            candidates: the number of embedding neighbours re-ranked by DTW
+            rerank: if False, return the embedding neighbours directly
+
+        Returns a list of metadata dicts, nearest first, each with an added
+        distance entry
+        """
+        if len(self) == 0:
+            return []
+
+        embedding, contour = self.embed(sf, Sxx)
+        embeddings, contours = self._arrays()
+
+        # embeddings have unit length, so |e - q|^2 = 2 - 2 e.q
+        n_cand = min(len(self), max(k, candidates if rerank else k))
+        dist = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), self.block_rows):
+            block = embeddings[start:start + self.block_rows]
+            dist[start:start + block.shape[0]] = block.dot(embedding)
+        dist *= -2
+        dist += 2
+
+        cand = np.argpartition(dist, n_cand - 1)[:n_cand]
+
+        if rerank:
+            ids, distances = self._rerank(contour, np.sort(cand), contours, k)
+        else:
+            order = np.argsort(dist[cand])[:k]
+            ids = cand[order]
+            distances = np.sqrt(np.maximum(dist[ids], 0))
+
+        results = self.metadata(ids)
+        for m, d in zip(results, distances):
+            m['distance'] = float(d)
+
+        return results
+
+    def _rerank(self, query, cand, contours, k):
+        """Exact DTW k nearest neighbours among cand, pruned by LB_Keogh"""
+        r = self.window
+        C = np.asarray(contours[cand], dtype=np.float64)
+        q = np.asarray(query, dtype=np.float64)
+
+        lower, upper = self._envelope(q, r)
+        lb = np.sum(np.square(np.maximum(C - upper, 0)) +
+                    np.square(np.maximum(lower - C, 0)), axis=(1, 2))
+
+        # DTW is run on a few candidates at a time; fewer is more pruning,
+        # more is less Python overhead
+        step = max(k, 16)
+
+        order = np.argsort(lb)
+        best_ids = np.empty(0, dtype=np.int64)
+        best_dist = np.empty(0)
+        threshold = np.inf
+        pos = 0
+        pruned = 0
+
+        while pos < order.size:
+            batch = order[pos:pos + step]
+            pos += batch.size
+
+            keep = lb[batch] < threshold
+            pruned += batch.size - np.count_nonzero(keep)
+            batch = batch[keep]
+            if batch.size == 0:
+                # bounds are sorted, so nothing later can do better either
+                pruned += order.size - pos
+                break
+
+            d = self.dtw(q, C[batch], r)
+            best_ids = np.concatenate((best_ids, cand[batch]))
+            best_dist = np.concatenate((best_dist, d))
+
+            top = np.argsort(best_dist)[:k]
+            best_ids, best_dist = best_ids[top], best_dist[top]
+            if best_dist.size == k:
+                threshold = best_dist[-1]
+
+        self.logger.debug('DTW re-ranking pruned %d of %d candidates',
+                pruned, cand.size)
+
+        return best_ids, np.sqrt(best_dist)
+
+    @staticmethod
+    def _envelope(q, r):
+        """Running min and max of each contour channel over +/- r points"""
+        n = q.shape[1]
+        padded = np.pad(q, ((0, 0), (r, r)), 'edge')
+        windows = np.stack([padded[:, i:i + n] for i in range(2 * r + 1)])
+        return np.amin(windows, axis=0), np.amax(windows, axis=0)
+
+    @staticmethod
+    def dtw(q, C, r):
+        """Squared DTW distance between contour q and each contour in C
+
+        The warping path is restricted to |i - j| <= r.  The recurrence is
+        evaluated one anti-diagonal at a time, so the Python loop runs
+        2 * length times regardless of how many contours are compared, and
+        only the cells inside the band are touched.
+
+        Inputs:
+            q: a (channels, length) contour
+            C: a (count, channels, length) array of contours
+        """
+        count, _, n = C.shape
+
+        cost = np.sum(np.square(q[np.newaxis, :, :, np.newaxis] -
+                                C[:, :, np.newaxis, :]), axis=1)
+
+        D = np.full((count, n + 1, n + 1), np.inf)
+        D[:, 0, 0] = 0
+
+        for diag in range(2, 2 * n + 1):
+            # cells of this anti-diagonal inside the band
+            i = np.arange(max(1, diag - n, (diag - r + 1) // 2),
+                          min(n, diag - 1, (diag + r) // 2) + 1)
+            j = diag - i
+            D[:, i, j] = cost[:, i - 1, j - 1] + np.minimum(
+                D[:, i - 1, j - 1], np.minimum(D[:, i - 1, j], D[:, i, j - 1]))
+
+        return D[:, n, n]
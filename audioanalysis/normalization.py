@@ -0,0 +1,163 @@
+"""
+Corpus-wide normalization statistics for spectrogram samples
+
+Copyright 2015 Justin Palpant
+
+This file is part of the Jarvis Lab Audio Analysis program.
+
+Audio Analysis is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+Audio Analysis is distributed in the hope that it will be useful, but WITHOUT
+ANYWARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Audio Analysis. If not, see http://www.gnu.org/licenses/.
+"""
+import os
+import logging
+
+import numpy as np
+
+
+class NormalizationStats(object):
+    """Per-frequency statistics of log10 spectrogram power
+
+    Statistics are accumulated in a single streaming pass with update(), one
+    spectrogram at a time, and partial results from several processes can be
+    combined with merge().  Once gathered, apply() scales log power with a
+    fixed affine transform per frequency row, so a frame is given the same
+    value whether it is part of a whole song, a batch or a stream.
+
+    Two modes are supported:
+        minmax: scale each row's log power to [0, 1] using its corpus min/max
+        standard: subtract each row's mean and divide by its standard deviation
+    """
+    logger = logging.getLogger('JLAA.NormalizationStats')
+
+    FILENAME = 'norm_stats.npz'
+    MODES = ('minmax', 'standard')
+
+    # columns of a spectrogram converted to log power at a time in update()
+    chunk_cols = 8192
+
+    def __init__(self, mode='minmax'):
+        if mode not in self.MODES:
+            raise ValueError('Unknown normalization mode {0}, must be one of '
+                    '{1}'.format(mode, ', '.join(self.MODES)))
+
+        self.mode = mode
+        self.count = 0
+        self.minimum = None
+        self.maximum = None
+        self.total = None
+        self.total_sq = None
+
+    @staticmethod
+    def log_power(Sxx):
+        """log10 of Sxx, with zeros clamped to the smallest normal number"""
+        tiny = np.finfo(Sxx.dtype).tiny
+        return np.log10(np.maximum(Sxx, tiny))
+
+    def update(self, Sxx):
+        """Add the columns of a (frequency, time) spectrogram to the stats"""
+        for start in range(0, Sxx.shape[1], self.chunk_cols):
+            logS = self.log_power(Sxx[:, start:start + self.chunk_cols])
+
+            self._combine(logS.shape[1],
+                          np.amin(logS, 1), np.amax(logS, 1),
+                          np.sum(logS, 1, dtype=np.float64),
+                          np.sum(np.square(logS, dtype=np.float64), 1))
+
+    def merge(self, other):
+        """Fold the statistics of another NormalizationStats into these"""
+        if other.count:
+            self._combine(other.count, other.minimum, other.maximum,
+                          other.total, other.total_sq)
+
+    def _combine(self, count, minimum, maximum, total, total_sq):
+        if self.count == 0:
+            self.minimum = np.array(minimum, dtype=np.float64)
+            self.maximum = np.array(maximum, dtype=np.float64)
+            self.total = np.array(total, dtype=np.float64)
+            self.total_sq = np.array(total_sq, dtype=np.float64)
+        else:
+            if minimum.shape != self.minimum.shape:
+                raise ValueError('Cannot combine statistics of {0} and {1} '
+                        'frequency rows'.format(self.minimum.size, minimum.size))
+
+            np.minimum(self.minimum, minimum, out=self.minimum)
+            np.maximum(self.maximum, maximum, out=self.maximum)
+            self.total += total
+            self.total_sq += total_sq
+
+        self.count += count
+
+    @property
+    def mean(self):
+        return self.total / self.count
+
+    @property
+    def std(self):
+        return np.sqrt(np.maximum(
+            self.total_sq / self.count - np.square(self.mean), 0))
+
+    def affine(self, rows=None):
+        """Return (offset, scale) so that normalized = (log - offset) * scale
+
+        Rows with no spread are given a scale of 1.
+        """
+        if self.count == 0:
+            raise ValueError('No statistics have been gathered')
+
+        if self.mode == 'minmax':
+            offset, spread = self.minimum, self.maximum - self.minimum
+        else:
+            offset, spread = self.mean, self.std
+
+        spread = np.where(spread > 0, spread, 1.0)
+
+        if rows is not None:
+            offset, spread = offset[0:rows], spread[0:rows]
+
+        return offset, 1.0 / spread
+
+    def apply(self, Sxx):
+        """Normalize the log power of a (frequency, time) spectrogram slice
+
+        Only as many rows as Sxx has are used, so a slice of the first img_rows
+        frequencies can be given directly.  The result has Sxx's dtype.
+        """
+        offset, scale = self.affine(Sxx.shape[0])
+
+        logS = self.log_power(Sxx)
+        logS -= offset[:, np.newaxis].astype(logS.dtype)
+        logS *= scale[:, np.newaxis].astype(logS.dtype)
+
+        return logS
+
+    def save(self, folder):
+        """Write the statistics to folder, next to an exported model"""
+        np.savez(os.path.join(folder, self.FILENAME),
+                 mode=np.array(self.mode), count=np.array(self.count),
+                 minimum=self.minimum, maximum=self.maximum,
+                 total=self.total, total_sq=self.total_sq)
+
+    @classmethod
+    def load(cls, folder):
+        """Read statistics saved with save, or return None if there are none"""
+        path = os.path.join(folder, cls.FILENAME)
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as f:
+            stats = cls(str(f['mode']))
+            stats._combine(int(f['count']), f['minimum'], f['maximum'],
+                           f['total'], f['total_sq'])
+
+        cls.logger.info('Loaded %s normalization statistics from %s',
+                stats.mode, path)
+        return stats
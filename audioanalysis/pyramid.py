@@ -0,0 +1,256 @@
+"""
+Multi-resolution spectrogram pyramid for displaying long recordings
+
+Copyright 2015 Justin Palpant
+
+This file is part of the Jarvis Lab Audio Analysis program.
+
+Audio Analysis is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+Audio Analysis is distributed in the hope that it will be useful, but WITHOUT
+ANYWARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Audio Analysis. If not, see http://www.gnu.org/licenses/.
+"""
+import os
+import json
+import logging
+
+import numpy as np
+
+from audioanalysis.normalization import NormalizationStats
+
+
+class SpectrogramPyramid(object):
+    """Precomputed time-decimated copies of a spectrogram and its tracks
+
+    Level 0 holds the log10 spectrogram of a processed SongFile.  Each
+    following level halves the number of time columns by pooling pairs of
+    columns from the level below, keeping both the mean and the max.  The
+    power and entropy tracks are pooled alongside, and so is whether any
+    frame has a label other than background (class 0).
+
+    Every level is an .npy file stored time-major, so any time range of any
+    level is one contiguous read from a memory map.  query() picks the
+    coarsest level that still gives at least one column per pixel, so the
+    amount of data read depends only on the requested width, never on the
+    length of the recording.
+    """
+    logger = logging.getLogger('JLAA.SpectrogramPyramid')
+
+    HEADER = 'pyramid.json'
+    TIMES = 'times.npy'
+    FREQS = 'freqs.npy'
+
+    # level columns pooled per block while building
+    block_cols = 65536
+
+    # columns of the tracks array at every level
+    TRACKS = ('power_mean', 'power_max', 'entropy_mean', 'labeled_any')
+
+    def __init__(self, folder):
+        """Open a pyramid written by build"""
+        self.folder = folder
+
+        with open(os.path.join(folder, self.HEADER), 'r') as f:
+            self.header = json.load(f)
+
+        self.times = np.load(os.path.join(folder, self.TIMES), mmap_mode='r')
+        self.freqs = np.load(os.path.join(folder, self.FREQS))
+        self._maps = {}
+
+    @property
+    def levels(self):
+        return self.header['levels']
+
+    @staticmethod
+    def _level_name(level, kind):
+        return 'L{0:02d}_{1}.npy'.format(level, kind)
+
+    @classmethod
+    def build(cls, folder, sf, Sxx, min_columns=512, dtype='float16'):
+        """Write the pyramid of a processed SongFile to folder
+
+        Inputs:
+            folder: the destination folder, created if necessary
+            sf: a SongFile processed by AudioAnalyzer.process
+            Sxx: the spectrogram returned by that call
+        Keyword Arguments:
+            min_columns: levels are added until one has at most this many
+                columns
+            dtype: the storage type of the log spectrogram levels.  float16
+                steps by 2**-7 in log10 power where |log10 P| is between 8
+                and 16, about 0.08 dB, which is fine for display; use float32
+                where exact values matter.
+
+        Returns the opened SpectrogramPyramid
+        """
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        n = Sxx.shape[1]
+
+        np.save(os.path.join(folder, cls.TIMES), np.asarray(sf.time))
+        np.save(os.path.join(folder, cls.FREQS),
+                np.asarray(sf.freq)[0:Sxx.shape[0]])
+
+        # level 0: mean and max are the same array
+        level0 = np.lib.format.open_memmap(
+            os.path.join(folder, cls._level_name(0, 'mean')), mode='w+',
+            dtype=dtype, shape=(n, Sxx.shape[0]))
+        for start in range(0, n, cls.block_cols):
+            block = Sxx[:, start:start + cls.block_cols]
+            level0[start:start + block.shape[1]] = \
+                NormalizationStats.log_power(block).T
+        level0.flush()
+
+        classification = sf.classification
+        if classification is None:
+            classification = np.zeros(n)
+
+        tracks = np.lib.format.open_memmap(
+            os.path.join(folder, cls._level_name(0, 'tracks')), mode='w+',
+            dtype=np.float32, shape=(n, len(cls.TRACKS)))
+        tracks[:, 0] = sf.power[0:n]
+        tracks[:, 1] = sf.power[0:n]
+        tracks[:, 2] = sf.entropy[0:n]
+        tracks[:, 3] = np.asarray(classification[0:n]) != 0
+        tracks.flush()
+
+        levels = 1
+        prev_mean, prev_max, prev_tracks = level0, level0, tracks
+        while prev_mean.shape[0] > min_columns:
+            prev_mean, prev_max, prev_tracks = cls._build_level(
+                folder, levels, prev_mean, prev_max, prev_tracks)
+            levels += 1
+
+        header = {
+            'levels': levels,
+            'columns': n,
+            'name': str(sf),
+        }
+        with open(os.path.join(folder, cls.HEADER), 'w') as f:
+            json.dump(header, f, indent=1)
+
+        cls.logger.info('Built a %d level spectrogram pyramid of %s',
+                levels, str(sf))
+
+        return cls(folder)
+
+    @classmethod
+    def _build_level(cls, folder, level, prev_mean, prev_max, prev_tracks):
+        """Pool pairs of columns of the previous level into a new level"""
+        n = (prev_mean.shape[0] + 1) // 2
+
+        def create(kind, like):
+            return np.lib.format.open_memmap(
+                os.path.join(folder, cls._level_name(level, kind)),
+                mode='w+', dtype=like.dtype, shape=(n,) + like.shape[1:])
+
+        new_mean = create('mean', prev_mean)
+        new_max = create('max', prev_max)
+        new_tracks = create('tracks', prev_tracks)
+
+        for start in range(0, n, cls.block_cols):
+            stop = min(n, start + cls.block_cols)
+
+            mean = cls._pairs(prev_mean, start, stop)
+            new_mean[start:stop] = np.mean(mean, axis=1, dtype=np.float32)
+            new_max[start:stop] = np.amax(
+                cls._pairs(prev_max, start, stop), axis=1)
+
+            tracks = cls._pairs(prev_tracks, start, stop)
+            new_tracks[start:stop, 0] = np.mean(tracks[:, :, 0], axis=1)
+            new_tracks[start:stop, 1] = np.amax(tracks[:, :, 1], axis=1)
+            new_tracks[start:stop, 2] = np.mean(tracks[:, :, 2], axis=1)
+            new_tracks[start:stop, 3] = np.amax(tracks[:, :, 3], axis=1)
+
+        for a in (new_mean, new_max, new_tracks):
+            a.flush()
+
+        return new_mean, new_max, new_tracks
+
+    @staticmethod
+    def _pairs(prev, start, stop):
+        """Rows 2*start to 2*stop of prev, shaped (stop - start, 2, ...)
+
+        An odd final row is paired with itself.
+        """
+        block = np.asarray(prev[2 * start:2 * stop])
+        if block.shape[0] % 2:
+            block = np.concatenate((block, block[-1:]))
+
+        return block.reshape((stop - start, 2) + block.shape[1:])
+
+    def _level(self, level):
+        try:
+            return self._maps[level]
+        except KeyError:
+            def load(kind):
+                return np.load(os.path.join(
+                    self.folder, self._level_name(level, kind)), mmap_mode='r')
+
+            mean = load('mean')
+            arrays = (mean, mean if level == 0 else load('max'),
+                      load('tracks'))
+            self._maps[level] = arrays
+            return arrays
+
+    def query(self, t0, t1, f0, f1, width_px):
+        """Return the pyramid data covering a time and frequency window
+
+        Inputs:
+            t0, t1: the time range, in the SongFile's time coordinates
+            f0, f1: the frequency range in Hz
+            width_px: the number of horizontal pixels to be drawn
+
+        Returns a dict with entries:
+            level: the pyramid level used; one column is 2**level frames
+            time: the time of the first frame of each column
+            freq: the frequency of each row
+            mean, max: (freq, time) arrays of pooled log10 power
+            power, power_max, entropy: pooled tracks
+            labeled: 1 where any frame of the column has a non-zero label
+        """
+        c0 = int(np.searchsorted(self.times, t0, side='left'))
+        c1 = int(np.searchsorted(self.times, t1, side='right'))
+        r0 = int(np.searchsorted(self.freqs, f0, side='left'))
+        r1 = int(np.searchsorted(self.freqs, f1, side='right'))
+
+        def columns(level):
+            scale = 2 ** level
+            return c0 // scale, -(-c1 // scale)
+
+        # each level has at least half the columns of the one below, so the
+        # coarsest level with width_px columns has fewer than 2 * width_px
+        width_px = max(1, int(width_px))
+        level = 0
+        while level < self.levels - 1:
+            l0, l1 = columns(level + 1)
+            if l1 - l0 < width_px:
+                break
+            level += 1
+
+        scale = 2 ** level
+        l0, l1 = columns(level)
+        mean, maximum, tracks = self._level(level)
+
+        tracks = np.asarray(tracks[l0:l1])
+        frames = np.minimum(np.arange(l0, l1) * scale, self.times.shape[0] - 1)
+
+        return {
+            'level': level,
+            'time': np.asarray(self.times[frames]),
+            'freq': self.freqs[r0:r1],
+            'mean': np.asarray(mean[l0:l1, r0:r1]).T,
+            'max': np.asarray(maximum[l0:l1, r0:r1]).T,
+            'power': tracks[:, 0],
+            'power_max': tracks[:, 1],
+            'entropy': tracks[:, 2],
+            'labeled': tracks[:, 3],
+        }
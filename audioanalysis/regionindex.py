@@ -0,0 +1,333 @@
+"""
+SQLite index of classified regions across a corpus of recordings
+
+Copyright 2015 Justin Palpant
+
+This file is part of the Jarvis Lab Audio Analysis program.
+
+Audio Analysis is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+Audio Analysis is distributed in the hope that it will be useful, but WITHOUT
+ANYWARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Audio Analysis. If not, see http://www.gnu.org/licenses/.
+"""
+import time
+import logging
+import sqlite3
+
+import numpy as np
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS songs (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    section REAL NOT NULL,
+    subject TEXT,
+    added REAL NOT NULL,
+    UNIQUE (source, section)
+);
+CREATE TABLE IF NOT EXISTS regions (
+    id INTEGER PRIMARY KEY,
+    song INTEGER NOT NULL REFERENCES songs (id) ON DELETE CASCADE,
+    kind TEXT NOT NULL,
+    label INTEGER NOT NULL,
+    start REAL NOT NULL,
+    end REAL NOT NULL,
+    duration REAL NOT NULL,
+    day_seconds REAL NOT NULL,
+    power REAL,
+    entropy REAL
+);
+CREATE INDEX IF NOT EXISTS regions_label_start ON regions (label, start);
+CREATE INDEX IF NOT EXISTS regions_start ON regions (start);
+CREATE INDEX IF NOT EXISTS regions_duration ON regions (duration);
+CREATE INDEX IF NOT EXISTS regions_song ON regions (song);
+CREATE INDEX IF NOT EXISTS songs_subject ON songs (subject);
+"""
+
+COLUMNS = ('source', 'subject', 'kind', 'label', 'start', 'end', 'duration',
+           'power', 'entropy')
+
+
+def _day_seconds(t):
+    """Seconds since local midnight of each POSIX time in t"""
+    out = []
+    for ti in t:
+        lt = time.localtime(ti)
+        out.append(lt.tm_hour * 3600 + lt.tm_min * 60 + lt.tm_sec +
+                   (ti - np.floor(ti)))
+    return out
+
+
+def _parse_clock(value):
+    """Seconds since midnight from a number or an 'HH:MM[:SS]' string"""
+    if hasattr(value, 'split'):
+        parts = [float(p) for p in value.split(':')]
+        return sum(p * 60 ** (2 - i) for i, p in enumerate(parts))
+    return float(value)
+
+
+class RegionIndex(object):
+    """A persistent, incrementally updated table of classified regions
+
+    Every run of a non-background label in a classified SongFile becomes one
+    row, holding the source file, the absolute start and end times (the
+    SongFile's recorded time plus its start plus the frame time), the label,
+    the duration and the mean power and entropy of the run's frames.  Motifs
+    from find_motifs can be added as rows of kind 'motif'.
+
+    Adding a song replaces any rows previously added for the same source and
+    section, so songs can be re-classified without rebuilding the index.
+    Range queries use the start time indexes; a query for regions
+    overlapping [t0, t1] bounds the start time from below by t0 minus the
+    longest indexed duration, so it stays an index range scan.
+    """
+    logger = logging.getLogger('JLAA.RegionIndex')
+
+    def __init__(self, filename):
+        """Open or create the index database at filename"""
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        # readers are not blocked while songs are being added
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM regions').fetchone()[0]
+
+    @staticmethod
+    def _song_key(sf):
+        return (sf.source or sf.name, float(sf.start))
+
+    def _replace_song(self, sf, subject):
+        """Delete the rows of sf and return a fresh songs id for it"""
+        source, section = self._song_key(sf)
+        self.db.execute('DELETE FROM songs WHERE source = ? AND section = ?',
+                        (source, section))
+        cursor = self.db.execute(
+            'INSERT INTO songs (source, section, subject, added) '
+            'VALUES (?, ?, ?, ?)', (source, section, subject, time.time()))
+        return cursor.lastrowid
+
+    def _origin(self, sf):
+        if sf.recorded is None:
+            self.logger.warning('%s has no recording time; indexing its '
+                    'regions relative to the start of the file', str(sf))
+            return float(sf.start)
+        return float(sf.recorded) + float(sf.start)
+
+    def add_song(self, sf, subject=None, background=0):
+        """Index the classified runs of a processed SongFile
+
+        Inputs:
+            sf: a SongFile with time, power, entropy and a classification
+        Keyword Arguments:
+            subject: an identifier, such as the bird, stored with the song
+            background: the label that is not indexed
+
+        Any rows of an earlier add_song or add_motifs for the same source and
+        section are replaced.
+
+        Returns the number of regions indexed
+        """
+        runs = sf.classification_runs
+        if runs is None or sf.time is None:
+            raise ValueError('SongFile {0} must be processed and classified '
+                             'before it is indexed'.format(str(sf)))
+
+        keep = runs.values != background
+        starts, stops = runs.starts[keep], runs.stops[keep]
+
+        times = np.append(sf.time, sf.time[-1] + (
+            sf.time[-1] - sf.time[-2] if sf.time.size > 1 else 0))
+        origin = self._origin(sf)
+        t0 = origin + times[starts]
+        t1 = origin + times[stops]
+
+        power = self._run_means(sf.power, runs)[keep]
+        entropy = self._run_means(sf.entropy, runs)[keep]
+
+        with self.db:
+            song = self._replace_song(sf, subject)
+            self._insert_rows([
+                (song, 'run', int(l), float(a), float(b), float(b - a),
+                 float(p), float(e))
+                for l, a, b, p, e in zip(runs.values[keep], t0, t1, power,
+                                         entropy)])
+
+        self.logger.info('Indexed %d regions of %s', starts.size, str(sf))
+        return int(starts.size)
+
+    @staticmethod
+    def _run_means(track, runs):
+        """The mean of track over each run"""
+        if not runs.starts.size:
+            return np.zeros(0)
+
+        sums = np.add.reduceat(np.asarray(track, dtype=np.float64),
+                               runs.starts)
+        return sums / runs.lengths
+
+    def add_motifs(self, sf, motifs, subject=None, background=0):
+        """Index the motifs found in sf, replacing sf's motif rows
+
+        Each motif is labeled with the most common non-background label of
+        its classification.  The regions of sf itself are kept.
+        """
+        source, section = self._song_key(sf)
+        row = self.db.execute('SELECT id FROM songs WHERE source = ? AND '
+                              'section = ?', (source, section)).fetchone()
+
+        with self.db:
+            if row is None:
+                song = self._replace_song(sf, subject)
+            else:
+                song = row[0]
+                self.db.execute('DELETE FROM regions WHERE song = ? AND '
+                                "kind = 'motif'", (song,))
+
+            origin = self._origin(sf)
+            rows = []
+            for m in motifs:
+                runs = m.classification_runs
+                fg = runs.values != background
+                if np.any(fg):
+                    lengths = runs.lengths[fg]
+                    values = runs.values[fg]
+                    totals = [lengths[values == v].sum()
+                              for v in np.unique(values)]
+                    label = np.unique(values)[int(np.argmax(totals))]
+                else:
+                    label = background
+
+                start = origin + float(m.start)
+                rows.append((song, 'motif', int(label), start,
+                             start + m.length, m.length, None, None))
+
+            self._insert_rows(rows)
+
+        return len(rows)
+
+    def _insert_rows(self, rows):
+        days = _day_seconds([r[3] for r in rows])
+        self.db.executemany(
+            'INSERT INTO regions (song, kind, label, start, end, duration, '
+            'day_seconds, power, entropy) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [r[:6] + (d,) + r[6:] for r, d in zip(rows, days)])
+
+    def remove_source(self, source):
+        """Delete every row of a source file"""
+        with self.db:
+            self.db.execute('DELETE FROM songs WHERE source = ?', (source,))
+
+    def _where(self, start, end, label, source, subject, clock, kind):
+        clauses = ['r.kind = ?']
+        args = [kind]
+
+        if label is not None:
+            clauses.append('r.label = ?')
+            args.append(int(label))
+        if end is not None:
+            clauses.append('r.start < ?')
+            args.append(float(end))
+        if start is not None:
+            longest = self.db.execute(
+                'SELECT MAX(duration) FROM regions').fetchone()[0] or 0.0
+            clauses.append('r.start >= ? AND r.end > ?')
+            args.extend((float(start) - longest, float(start)))
+        if source is not None:
+            clauses.append('s.source = ?')
+            args.append(source)
+        if subject is not None:
+            clauses.append('s.subject = ?')
+            args.append(subject)
+        if clock is not None:
+            c0, c1 = _parse_clock(clock[0]), _parse_clock(clock[1])
+            if c0 <= c1:
+                clauses.append('r.day_seconds >= ? AND r.day_seconds < ?')
+            else:  # the window wraps past midnight
+                clauses.append('(r.day_seconds >= ? OR r.day_seconds < ?)')
+            args.extend((c0, c1))
+
+        return ' AND '.join(clauses), args
+
+    def query(self, start=None, end=None, label=None, source=None,
+              subject=None, clock=None, kind='run', limit=None):
+        """Regions overlapping the absolute time range [start, end)
+
+        Keyword Arguments:
+            start, end: POSIX times; either may be None for an open range
+            label: only regions of this label
+            source: only regions from this file
+            subject: only regions of songs added with this subject
+            clock: a (from, to) pair of times of day, as seconds after
+                midnight or 'HH:MM' strings, matched against each region's
+                local start time.  A pair such as ('23:00', '01:00') wraps
+                past midnight.
+            kind: 'run' for classified runs, 'motif' for motifs
+            limit: the maximum number of rows
+
+        Returns a list of dicts with the entries of COLUMNS, ordered by start
+        """
+        where, args = self._where(start, end, label, source, subject, clock,
+                                  kind)
+        sql = ('SELECT s.source, s.subject, r.kind, r.label, r.start, r.end, '
+               'r.duration, r.power, r.entropy FROM regions r JOIN songs s '
+               'ON r.song = s.id WHERE ' + where + ' ORDER BY r.start')
+        if limit is not None:
+            sql += ' LIMIT {0:d}'.format(int(limit))
+
+        return [dict(zip(COLUMNS, row)) for row in self.db.execute(sql, args)]
+
+    def aggregate(self, by='label', start=None, end=None, label=None,
+                  source=None, subject=None, clock=None, kind='run'):
+        """Summaries of the regions matching the filters of query
+
+        Keyword Arguments:
+            by: group by 'label', 'source', 'subject' or 'day' (local date)
+
+        Returns a list of dicts with the group value ('key'), the number of
+        regions, their total and mean duration and their mean power and
+        entropy
+        """
+        groups = {
+            'label': 'r.label',
+            'source': 's.source',
+            'subject': 's.subject',
+            'day': "date(r.start, 'unixepoch', 'localtime')",
+        }
+        try:
+            key = groups[by]
+        except KeyError:
+            self.logger.error('Cannot aggregate by %s', by)
+            raise ValueError('Cannot aggregate by {0}; choose one of {1}'
+                             .format(by, ', '.join(sorted(groups))))
+
+        where, args = self._where(start, end, label, source, subject, clock,
+                                  kind)
+        sql = ('SELECT ' + key + ', COUNT(*), SUM(r.duration), '
+               'AVG(r.duration), AVG(r.power), AVG(r.entropy) FROM regions r '
+               'JOIN songs s ON r.song = s.id WHERE ' + where +
+               ' GROUP BY 1 ORDER BY 1')
+
+        names = ('key', 'count', 'total_duration', 'mean_duration', 'power',
+                 'entropy')
+        return [dict(zip(names, row)) for row in self.db.execute(sql, args)]
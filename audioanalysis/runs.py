@@ -0,0 +1,163 @@
+"""
+Run-length encoded label tracks
+
+Copyright 2015 Justin Palpant
+
+This file is part of the Jarvis Lab Audio Analysis program.
+
+Audio Analysis is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+Audio Analysis is distributed in the hope that it will be useful, but WITHOUT
+ANYWARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Audio Analysis. If not, see http://www.gnu.org/licenses/.
+"""
+import numpy as np
+
+
+class LabelRuns(object):
+    """A per-frame label track stored as runs of constant value
+
+    A run starts at frame starts[i], has label values[i] and lasts until the
+    next run starts, or until frame size for the last run.  Classifications
+    come in long constant stretches, so this costs a few bytes per run where
+    the dense track costs 8 bytes per STFT frame.
+
+    All lookups are vectorized binary searches over the run starts.
+    """
+
+    def __init__(self, starts, values, size):
+        """Create LabelRuns from run starts (frame indices), run labels and
+        the total number of frames.  starts must begin at 0 and increase."""
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.values = np.asarray(values)
+        self.size = int(size)
+
+    @classmethod
+    def from_dense(cls, labels):
+        """Encode a dense 1-D label array"""
+        labels = np.asarray(labels)
+        if labels.size == 0:
+            return cls([], labels[:0], 0)
+
+        change = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+        starts = np.concatenate(([0], change))
+
+        return cls(starts, labels[starts], labels.size)
+
+    @classmethod
+    def constant(cls, size, value=0, dtype=np.float64):
+        """A track of size frames all labeled value"""
+        if size == 0:
+            return cls([], np.zeros(0, dtype=dtype), 0)
+
+        return cls([0], np.array([value], dtype=dtype), size)
+
+    def to_dense(self):
+        """Decode to a dense 1-D array with one label per frame"""
+        return np.repeat(self.values, self.lengths)
+
+    @property
+    def stops(self):
+        """The frame after the last frame of each run"""
+        return np.append(self.starts[1:], self.size)
+
+    @property
+    def lengths(self):
+        return self.stops - self.starts
+
+    @property
+    def nbytes(self):
+        return self.starts.nbytes + self.values.nbytes
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return 'LabelRuns({0} frames in {1} runs)'.format(
+            self.size, self.starts.size)
+
+    def run_index(self, idx):
+        """The index of the run containing each frame in idx"""
+        idx = np.asarray(idx)
+        if np.any(idx < 0) or np.any(idx >= self.size):
+            raise IndexError('Frame index out of bounds for a track of {0} '
+                    'frames'.format(self.size))
+
+        return np.searchsorted(self.starts, idx, side='right') - 1
+
+    def at(self, idx):
+        """The label of each frame in idx (an integer or integer array)"""
+        return self.values[self.run_index(idx)]
+
+    def overlapping(self, first, last):
+        """Runs overlapping frames [first, last)
+
+        Returns (starts, stops, values) arrays, with the first and last run
+        clipped to the requested range.
+        """
+        first = max(0, first)
+        last = min(self.size, last)
+        if last <= first:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, self.values[:0]
+
+        i0 = np.searchsorted(self.starts, first, side='right') - 1
+        i1 = np.searchsorted(self.starts, last, side='left')
+
+        starts = self.starts[i0:i1].copy()
+        stops = self.stops[i0:i1]
+        starts[0] = first
+        stops[-1] = last
+
+        return starts, stops, self.values[i0:i1]
+
+    def slice(self, first, last):
+        """A new LabelRuns for frames [first, last), renumbered from 0"""
+        starts, stops, values = self.overlapping(first, last)
+
+        return LabelRuns(starts - max(0, first), values,
+                         max(0, min(self.size, last) - max(0, first)))
+
+    def pad(self, left, right, value=0):
+        """A new LabelRuns with left and right frames of value added"""
+        starts = self.starts + left
+        values = self.values
+
+        if left:
+            starts = np.concatenate(([0], starts))
+            values = np.concatenate(([value], values)).astype(
+                self.values.dtype)
+        if right:
+            starts = np.append(starts, self.size + left)
+            values = np.append(values, value).astype(self.values.dtype)
+
+        return LabelRuns(starts, values, self.size + left + right).merged()
+
+    def merged(self):
+        """A new LabelRuns with adjacent runs of equal value joined"""
+        if self.starts.size < 2:
+            return self
+
+        keep = np.concatenate(([True], self.values[1:] != self.values[:-1]))
+        return LabelRuns(self.starts[keep], self.values[keep], self.size)
+
+    def regions(self, background=0):
+        """Stretches of frames that are not labeled background
+
+        Neighbouring runs with different non-background labels form one
+        region.  Returns (starts, stops) arrays of frame indices.
+        """
+        fg = self.values != background
+        prev = np.concatenate(([False], fg[:-1]))
+
+        starts = self.starts[fg & ~prev]
+        stops = np.append(self.starts[~fg & prev],
+                          [self.size] if fg.size and fg[-1] else [])
+
+        return starts, stops.astype(np.int64)
@@ -0,0 +1,312 @@
+"""
+Parameter sweeps that share intermediate results between configurations
+
+Copyright 2015 Justin Palpant
+
+This file is part of the Jarvis Lab Audio Analysis program.
+
+Audio Analysis is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+Audio Analysis is distributed in the hope that it will be useful, but WITHOUT
+ANYWARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Audio Analysis. If not, see http://www.gnu.org/licenses/.
+"""
+import csv
+import copy
+import logging
+import itertools
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+
+from audioanalysis.freqanalysis import AudioAnalyzer, SongFile
+
+
+# The stages of the pipeline, in dependency order, and the parameters each
+# one reads.  A stage's result depends on its own parameters and those of
+# every stage before it.  Features (power and entropy) are calculated with
+# the STFT.  Parameters that only change how work is divided, such as
+# process_chunk_s, batch_size and inference_chunk, give identical results
+# and are not listed.
+STAGES = (
+    ('highpass', ('min_freq', 'dtype')),
+    ('stft', ('fft_time_window_ms', 'fft_time_step_ms', 'nfft')),
+    ('inference', ('img_rows', 'img_cols')),
+    ('postprocess', ('smooth_time', 'power_threshold', 'medfilt_time')),
+)
+
+
+def score(classes, reference):
+    """Compare predicted and reference classes for the same frames
+
+    Returns a dict with the frame accuracy and the precision, recall and F1
+    score of detecting any non-zero class.
+    """
+    classes = np.asarray(classes)
+    reference = np.asarray(reference)
+
+    detected = classes != 0
+    actual = reference != 0
+    hits = np.count_nonzero(detected & actual)
+
+    precision = hits / float(max(1, np.count_nonzero(detected)))
+    recall = hits / float(max(1, np.count_nonzero(actual)))
+    f1 = (2 * precision * recall / (precision + recall)
+          if precision + recall > 0 else 0.0)
+
+    return {
+        'frames': int(classes.size),
+        'accuracy': float(np.count_nonzero(classes == reference)) /
+                    max(1, classes.size),
+        'precision': float(precision),
+        'recall': float(recall),
+        'f1': float(f1),
+    }
+
+
+def _postprocess_variants(task):
+    """Post-process one set of probabilities under several configurations
+
+    Runs in a worker process.  Returns one scored row per configuration.
+    """
+    configs, prbs, time, power, reference = task
+
+    sf = SongFile(np.zeros(0), 1.0)
+    sf.time = time
+    sf.power = power
+
+    rows = []
+    for config in configs:
+        classes = AudioAnalyzer(**config).postprocess(prbs, sf)
+        rows.append(score(classes, reference))
+
+    return rows
+
+
+class ParameterSweep(object):
+    """Evaluates a grid of AudioAnalyzer parameters against reference labels
+
+    The grid is arranged as a tree following STAGES: highpass, then STFT and
+    features, then inference, then post-processing.  Each distinct upstream
+    result is computed once and shared by every configuration below it, so a
+    grid over only the post-processing parameters runs the filter, STFT and
+    neural net once per song.  The filtered signal is the exception: it is a
+    full-length float copy of the song, so it is only kept for several STFT
+    configurations when it fits the memory_budget parameter (see
+    _keep_filtered); otherwise each STFT configuration filters the song
+    again, block by block.  Inference runs in this process with the
+    analyzer's classifier; post-processing variants fan out across a process
+    pool while the next upstream result is computed.
+
+    Parameters that change the spectrogram size (nfft, img_rows) must still
+    match the input shape of the classifier.
+    """
+    logger = logging.getLogger('JLAA.ParameterSweep')
+
+    def __init__(self, analyzer, grid):
+        """Create a ParameterSweep
+
+        Inputs:
+            analyzer: an AudioAnalyzer with a classifier.  Its params are the
+                defaults for every configuration.
+            grid: a dict mapping parameter names to lists of values
+        """
+        self.analyzer = analyzer
+        self.grid = OrderedDict(sorted(grid.items()))
+
+        known = set(k for _, keys in STAGES for k in keys)
+        unknown = set(self.grid) - known
+        if unknown:
+            raise ValueError('Cannot sweep parameters {0}; sweepable '
+                    'parameters are {1}'.format(', '.join(sorted(unknown)),
+                                                ', '.join(sorted(known))))
+
+    def configs(self):
+        """Every combination of grid values, as (grid values, params) pairs"""
+        names = list(self.grid)
+        for values in itertools.product(*self.grid.values()):
+            point = OrderedDict(zip(names, values))
+            params = dict(self.analyzer.params)
+            params.update(point)
+            yield point, params
+
+    @staticmethod
+    def _key(params, depth):
+        """The parameters of the first depth stages, as a hashable key"""
+        return tuple((k, repr(params[k]))
+                     for _, keys in STAGES[:depth] for k in keys
+                     if k in params)
+
+    def run(self, songfiles, references=None, processes=None):
+        """Run every configuration over songfiles
+
+        Inputs:
+            songfiles: the SongFiles to classify
+        Keyword Arguments:
+            references: processed SongFiles holding reference classifications
+                of the same recordings, in the same order.  Defaults to
+                songfiles themselves, which must then be processed and
+                labeled.  Reference labels are looked up by frame time, so
+                configurations with different time steps are scored fairly.
+            processes: the size of the post-processing pool
+
+        Returns a list of result rows (dicts), one per song and
+        configuration, holding the grid values, the song name and the scores
+        from score().  The songfiles are not modified.
+        """
+        if references is None:
+            references = songfiles
+
+        configs = list(self.configs())
+        self.logger.info('Sweeping %d configurations over %d songs',
+                len(configs), len(songfiles))
+
+        pool = multiprocessing.Pool(processes)
+        pending = []
+        counts = dict((name, 0) for name, _ in STAGES)
+
+        try:
+            for sf, ref in zip(songfiles, references):
+                if ref.time is None or ref.classification_runs is None:
+                    raise TypeError('Reference SongFile {0} has not been '
+                            'processed and labeled'.format(str(ref)))
+
+                for hp_group in self._group(configs, 1):
+                    stft_groups = self._group(hp_group, 2)
+
+                    data = None
+                    if self._keep_filtered(sf, stft_groups):
+                        data = AudioAnalyzer(**hp_group[0][1]).highpass(sf)
+                        counts['highpass'] += 1
+
+                    for stft_group in stft_groups:
+                        song = copy.copy(sf)
+                        song.classification_runs = None
+                        Sxx = AudioAnalyzer(**stft_group[0][1]).process(
+                            song, data=data)
+                        reference = ref.label_at(song.time)
+                        counts['stft'] += 1
+                        if data is None:
+                            counts['highpass'] += 1
+
+                        for inf_group in self._group(stft_group, 3):
+                            prbs = self._predict(song, Sxx, inf_group[0][1])
+                            counts['inference'] += 1
+                            counts['postprocess'] += len(inf_group)
+
+                            task = ([params for _, params in inf_group],
+                                    prbs, song.time, song.power, reference)
+                            pending.append((
+                                [point for point, _ in inf_group], str(sf),
+                                pool.apply_async(_postprocess_variants,
+                                                 (task,))))
+                    del data
+
+            rows = []
+            for points, name, result in pending:
+                for point, scores in zip(points, result.get()):
+                    row = OrderedDict(point)
+                    row['song'] = name
+                    row.update(scores)
+                    rows.append(row)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.logger.info('Computed %s', ', '.join(
+            '{0} {1} results'.format(counts[name], name)
+            for name, _ in STAGES))
+
+        return rows
+
+    def _keep_filtered(self, sf, stft_groups):
+        """Whether to filter sf once for all of stft_groups
+
+        Worth it only for more than one STFT configuration, and only if the
+        filtered copy fits the memory_budget parameter next to the peak that
+        process plans for each configuration.  Without a memory_budget the
+        copy is always kept.
+        """
+        if len(stft_groups) < 2:
+            return False
+
+        params = stft_groups[0][0][1]
+        budget = params.get('memory_budget')
+        if budget is None:
+            return True
+
+        analyzer = AudioAnalyzer(**params)
+        filtered = sf.samples.size * analyzer.processing_dtype().itemsize
+        peak = max(AudioAnalyzer(**group[0][1]).plan_processing(sf)[
+            'estimated_bytes']['peak'] for group in stft_groups)
+
+        if filtered + peak > budget:
+            self.logger.info('Filtering %s for each STFT configuration; a '
+                    'filtered copy of %d bytes does not fit the memory '
+                    'budget', str(sf), filtered)
+            return False
+        return True
+
+    def _group(self, configs, depth):
+        """Split configs into groups sharing the first depth stages"""
+        groups = OrderedDict()
+        for point, params in configs:
+            groups.setdefault(self._key(params, depth), []).append(
+                (point, params))
+
+        return list(groups.values())
+
+    def _predict(self, song, Sxx, params):
+        analyzer = self.analyzer
+        saved = (analyzer.params, analyzer.active_song, analyzer.Sxx)
+        try:
+            analyzer.params = params
+            analyzer.active_song = song
+            analyzer.Sxx = Sxx
+            return analyzer.predict_active()
+        finally:
+            analyzer.params, analyzer.active_song, analyzer.Sxx = saved
+
+    @staticmethod
+    def summarize(rows):
+        """Combine per-song rows into one row per configuration
+
+        Scores are averaged over songs, weighted by their number of frames.
+        """
+        metrics = ('accuracy', 'precision', 'recall', 'f1')
+        groups = OrderedDict()
+        for row in rows:
+            point = tuple((k, v) for k, v in row.items()
+                          if k not in metrics + ('song', 'frames'))
+            groups.setdefault(point, []).append(row)
+
+        summary = []
+        for point, group in groups.items():
+            weights = np.array([r['frames'] for r in group], dtype=np.float64)
+            out = OrderedDict(point)
+            out['songs'] = len(group)
+            out['frames'] = int(np.sum(weights))
+            for m in metrics:
+                out[m] = float(np.average([r[m] for r in group],
+                                          weights=weights))
+            summary.append(out)
+
+        return summary
+
+    @staticmethod
+    def to_csv(rows, filename):
+        """Write result rows to a CSV file"""
+        if not rows:
+            return
+
+        with open(filename, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
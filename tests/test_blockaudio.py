@@ -0,0 +1,171 @@
+"""
+Tests of block-compressed audio storage
+"""
+import os
+
+import numpy as np
+import pytest
+import scipy.io.wavfile
+
+from audioanalysis.blockaudio import BlockAudioFile, BlockAudioWriter
+from audioanalysis.freqanalysis import SongFile
+
+
+FS = 8000
+
+
+def extreme_samples(frames, channels=1, seed=0):
+    """int16 samples whose deltas wrap around, with runs of silence"""
+    rng = np.random.RandomState(seed)
+    samples = rng.randint(-32768, 32768, size=(max(frames, 500), channels))
+    samples[0:50] = np.where(np.arange(50) % 2, 32767, -32768)[:, np.newaxis]
+    samples[50:60] = -32768
+    samples[60:70] = 32767
+    samples[100:400] = 0
+    samples[-1] = -32768
+    samples = samples[0:frames].astype(np.int16)
+    return samples[:, 0] if channels == 1 else samples
+
+
+def write(path, samples, block_size=1000, pieces=(1, 999, 2500), **kwargs):
+    """Write samples in pieces of the given lengths, cycling"""
+    channels = 1 if samples.ndim == 1 else samples.shape[1]
+    with BlockAudioWriter(path, FS, block_size=block_size, channels=channels,
+                          **kwargs) as writer:
+        pos, k = 0, 0
+        while pos < samples.shape[0]:
+            step = pieces[k % len(pieces)]
+            writer.write(samples[pos:pos + step])
+            pos += step
+            k += 1
+    return BlockAudioFile(path)
+
+
+@pytest.mark.parametrize('channels', [1, 2, 3])
+@pytest.mark.parametrize('frames', [1, 999, 1000, 1001, 7777])
+def test_round_trip(tmpdir, channels, frames):
+    samples = extreme_samples(frames, channels)
+    blocks = write(str(tmpdir.join('a.blk')), samples)
+
+    assert len(blocks) == frames
+    assert blocks.channels == channels
+    assert blocks.Fs == FS
+    assert blocks.read().dtype == np.int16
+    np.testing.assert_array_equal(blocks.read(), samples)
+
+
+@pytest.mark.parametrize('channels', [1, 2])
+def test_reads_inside_blocks(tmpdir, channels):
+    samples = extreme_samples(7777, channels, seed=1)
+    blocks = write(str(tmpdir.join('a.blk')), samples)
+
+    ranges = [(0, 1), (10, 20), (999, 1001), (1000, 2000), (1500, 1600),
+              (250, 6999), (7776, 7777), (7000, 9000), (-5, 3), (50, 50),
+              (60, 40)]
+    rng = np.random.RandomState(2)
+    ranges += [tuple(sorted(rng.randint(0, 7777, 2))) for _ in range(50)]
+
+    for first, last in ranges:
+        expected = samples[max(0, first):max(0, last)]
+        np.testing.assert_array_equal(blocks.read(first, last), expected)
+
+    np.testing.assert_array_equal(blocks.read_time(0.25, 0.5),
+                                  samples[2000:4000])
+
+
+def test_scale_and_metadata(tmpdir):
+    samples = extreme_samples(3000)
+    blocks = write(str(tmpdir.join('a.blk')), samples, subject='bird1')
+    assert blocks.scale == 1.0 / 32767
+    assert blocks.header['subject'] == 'bird1'
+
+    blocks = write(str(tmpdir.join('b.blk')), samples, scale=0.5)
+    assert blocks.scale == 0.5
+
+
+def test_compresses_audio(tmpdir):
+    t = np.arange(FS * 10) / float(FS)
+    samples = (8000 * np.sin(2 * np.pi * 440 * t)).astype(np.int16)
+    path = str(tmpdir.join('a.blk'))
+    write(path, samples, block_size=4096)
+
+    assert os.path.getsize(path) < samples.nbytes / 2
+
+
+def test_from_wav(tmpdir):
+    samples = extreme_samples(5000, 2)
+    wav = str(tmpdir.join('a.wav'))
+    scipy.io.wavfile.write(wav, FS, samples)
+
+    blocks = BlockAudioFile.from_wav(wav, str(tmpdir.join('a.blk')),
+                                     block_size=512)
+    np.testing.assert_array_equal(blocks.read(), samples)
+
+    scipy.io.wavfile.write(wav, FS, samples.astype(np.float32))
+    with pytest.raises(TypeError):
+        BlockAudioFile.from_wav(wav, str(tmpdir.join('b.blk')))
+
+
+def test_writer_rejects_bad_samples(tmpdir):
+    with BlockAudioWriter(str(tmpdir.join('a.blk')), FS, channels=2) as w:
+        with pytest.raises(TypeError):
+            w.write(np.zeros((10, 2)))
+        with pytest.raises(ValueError):
+            w.write(np.zeros((10, 3), dtype=np.int16))
+
+
+def test_load_range_matches_load(tmpdir):
+    samples = extreme_samples(FS * 5, 2, seed=3)
+    path = str(tmpdir.join('song' + BlockAudioFile.EXTENSION))
+    write(path, samples, block_size=3000)
+
+    whole = SongFile.load(path, split=None, channels=None)[0]
+    assert whole.samples.dtype == np.int16
+    np.testing.assert_array_equal(whole.samples, samples)
+
+    part = SongFile.load_range(path, 1.3, 2.7, channels=None)
+    assert part.start == 1.3
+    assert part.scale == whole.scale
+    np.testing.assert_array_equal(part.samples,
+                                  samples[int(1.3 * FS):int(2.7 * FS)])
+    np.testing.assert_array_equal(part.data,
+                                  whole.data[int(1.3 * FS):int(2.7 * FS)])
+
+    mono = SongFile.load_range(path, 1.3, 2.7, channels=1)
+    np.testing.assert_array_equal(mono.samples,
+                                  samples[int(1.3 * FS):int(2.7 * FS), 1])
+
+
+def test_truncated_file_rejected(tmpdir):
+    samples = extreme_samples(5000)
+    path = str(tmpdir.join('a.blk'))
+    write(path, samples)
+
+    with open(path, 'rb') as f:
+        content = f.read()
+
+    for cut in (1, 8, len(BlockAudioFile.MAGIC) + 8, len(content) // 2,
+                len(content) - 9):
+        with open(path, 'wb') as f:
+            f.write(content[0:len(content) - cut])
+        with pytest.raises(ValueError):
+            BlockAudioFile(path)
+
+    with open(path, 'wb') as f:
+        f.write(b'RIFF' + content[4:])
+    with pytest.raises(ValueError):
+        BlockAudioFile(path)
+
+
+@pytest.mark.parametrize('frames', [0, 500, 5000])
+def test_unclosed_file_rejected(tmpdir, frames):
+    path = str(tmpdir.join('a.blk'))
+    writer = BlockAudioWriter(path, FS, block_size=1000)
+    writer.write(extreme_samples(frames))
+    writer.outfile.flush()
+
+    with pytest.raises(ValueError):
+        BlockAudioFile(path)
+
+    writer.close()
+    assert len(BlockAudioFile(path)) == frames
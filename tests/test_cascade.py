@@ -0,0 +1,146 @@
+"""
+Tests of the feature cascade ahead of the neural net
+"""
+import numpy as np
+
+from audioanalysis.cascade import CascadeClassifier, frame_features
+from audioanalysis.freqanalysis import AudioAnalyzer, SongFile
+
+
+FS = 22050.0
+
+
+def labeled_features(n, seed=0):
+    """Two overlapping classes of six features"""
+    rng = np.random.RandomState(seed)
+    y = rng.randint(0, 2, n)
+    X = rng.randn(n, 6)
+    X[:, 0] += 2.0 * y
+    X[:, 3] -= 1.0 * y
+    return X, y
+
+
+def settled_accuracy(cascade, X, y):
+    prbs, settled = cascade.settle(X)
+    return np.mean(np.argmax(prbs[settled], axis=1) == y[settled]), settled
+
+
+def test_calibration_meets_accuracy():
+    X, y = labeled_features(4000)
+    X_cal, y_cal = labeled_features(2000, seed=1)
+
+    for accuracy in (0.9, 0.97, 0.995):
+        cascade = CascadeClassifier(accuracy=accuracy)
+        np.random.seed(0)
+        cascade.fit(X, y)
+        cascade.calibrate(X_cal, y_cal)
+
+        met, settled = settled_accuracy(cascade, X_cal, y_cal)
+        assert met >= accuracy
+        assert 0 < np.count_nonzero(settled) < y_cal.size
+
+        # the threshold is the lowest that meets the target: settling the
+        # next most confident frame as well would miss it
+        prbs = cascade.predict_proba(X_cal)
+        confidence = np.amax(prbs, axis=1)
+        below = confidence < cascade.threshold
+        if np.any(below):
+            cascade.threshold = np.amax(confidence[below])
+            assert settled_accuracy(cascade, X_cal, y_cal)[0] < accuracy
+
+    # frames held out of the fit by fit itself
+    cascade = CascadeClassifier(accuracy=0.97)
+    np.random.seed(0)
+    cascade.fit(X, y, calibration_split=0.25)
+    order = np.random.RandomState(0).permutation(y.size)[:1000]
+    assert settled_accuracy(cascade, X[order], y[order])[0] >= 0.97
+
+    # unreachable accuracy settles nothing
+    cascade = CascadeClassifier(accuracy=1.01).fit(X, y)
+    assert cascade.threshold == np.inf
+    assert not np.any(cascade.settle(X)[1])
+
+
+def test_evaluate_report():
+    X, y = labeled_features(1000, seed=2)
+    cascade = CascadeClassifier(accuracy=0.95).fit(X, y)
+    prbs, settled = cascade.settle(X)
+
+    # a net that is right on every other frame
+    net_classes = np.where(np.arange(y.size) % 2, y, 1 - y)
+    net_prbs = np.stack([1.0 - net_classes, net_classes], axis=1)
+
+    report = cascade.evaluate(X, y, net_prbs)
+    combined = np.where(settled, np.argmax(prbs, axis=1), net_classes)
+
+    assert report['frames'] == 1000
+    assert report['deferred'] == np.mean(~settled)
+    assert 0 < report['deferred'] < 1
+    assert report['net_accuracy'] == 0.5
+    assert report['cascade_accuracy'] == np.mean(combined == y)
+    assert report['accuracy_change'] == \
+        report['cascade_accuracy'] - report['net_accuracy']
+    assert report['accuracy_change'] > 0
+    assert cascade.report is report
+
+
+def test_merge_keeps_settled_probabilities():
+    settled_prbs = np.array([[0.9, 0.1], [0.2, 0.8], [0.5, 0.5],
+                             [0.99, 0.01], [0.4, 0.6]])
+    indices = np.array([2, 4])
+    parts = [np.array([[0.1, 0.3, 0.6]]), np.array([[0.7, 0.2, 0.1]])]
+
+    merged = AudioAnalyzer._merge_cascade(settled_prbs, indices, parts)
+    assert merged.shape == (5, 3)
+    np.testing.assert_array_equal(merged[[0, 1, 3], 0:2],
+                                  settled_prbs[[0, 1, 3]])
+    np.testing.assert_array_equal(merged[[0, 1, 3], 2], 0)
+    np.testing.assert_array_equal(merged[indices], np.concatenate(parts))
+
+    # every frame settled: nothing is sent to the net
+    np.testing.assert_array_equal(
+        AudioAnalyzer._merge_cascade(settled_prbs, np.array([], dtype=int),
+                                     []),
+        settled_prbs)
+
+
+class Counting(object):
+    """A net that calls everything class 1, counting the samples it sees"""
+    def __init__(self):
+        self.samples = 0
+
+    def predict_proba(self, X, batch_size=None, verbose=0):
+        self.samples += X.shape[0]
+        return np.tile([0.25, 0.75], (X.shape[0], 1))
+
+
+def test_predict_active_defers_only_uncertain_frames():
+    rng = np.random.RandomState(3)
+    t = np.arange(int(FS * 3)) / FS
+    singing = (t % 1) < 0.5
+    x = 0.3 * singing * np.sin(2 * np.pi * 3000 * t) + \
+        0.01 * rng.randn(t.size)
+    sf = SongFile((x * 30000).astype(np.int16), FS, scale=1 / 30000.0)
+
+    analyzer = AudioAnalyzer(min_freq=500, cascade_accuracy=0.99,
+                             inference_chunk=100)
+    analyzer.set_active(sf)
+    # some mislabeled frames keep the cascade from settling everything
+    labels = ((sf.time % 1) < 0.5).astype(int)
+    flipped = rng.uniform(size=labels.size) < 0.03
+    sf.classification = np.where(flipped, 1 - labels, labels)
+
+    np.random.seed(1)
+    cascade = analyzer.train_cascade()
+    features = frame_features(sf, analyzer.Sxx)
+    cascade_prbs, settled = cascade.settle(features)
+    assert 0 < np.count_nonzero(~settled) < settled.size
+
+    analyzer.classifier = Counting()
+    prbs = analyzer.predict_active().T
+    deferred = np.count_nonzero(~settled)
+
+    assert analyzer.classifier.samples == deferred
+    np.testing.assert_array_equal(prbs[settled], cascade_prbs[settled])
+    np.testing.assert_array_equal(prbs[~settled],
+                                  np.tile([0.25, 0.75], (deferred, 1)))
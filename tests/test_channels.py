@@ -0,0 +1,166 @@
+"""
+Tests of multi-channel processing and classification
+"""
+import logging
+
+import numpy as np
+import pytest
+import scipy.io.wavfile
+
+from audioanalysis.blockaudio import BlockAudioFile
+from audioanalysis.freqanalysis import AudioAnalyzer, SongFile
+
+
+FS = 22050.0
+
+
+def one_singer(channels=4, singer=1, seconds=4, seed=0):
+    """Noise on every channel, with bursts of song on the singer's channel
+
+    Returns the SongFile and a function telling whether a time is in song.
+    """
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(FS * seconds)) / FS
+    singing = lambda time: (time % 1.0) < 0.5
+
+    x = 0.05 * rng.randn(t.size, channels)
+    x[:, singer] = 0.001 * rng.randn(t.size) + \
+        singing(t) * np.sin(2 * np.pi * 3000 * t)
+
+    sf = SongFile((x * 20000).astype(np.int16), FS, name='multi', scale=5e-5)
+    return sf, singing
+
+
+def test_combined_entropy_follows_the_singer():
+    sf, singing = one_singer()
+    AudioAnalyzer(min_freq=500).process(sf)
+
+    # frames well inside and well outside the song bursts
+    phase = sf.time % 1.0
+    song = (phase > 0.05) & (phase < 0.45)
+    gap = (phase > 0.55) & (phase < 0.95)
+
+    singer = sf.channel_entropy[1]
+    assert np.mean(singer[song]) < 0.05
+
+    np.testing.assert_array_equal(sf.entropy[song], singer[song])
+    assert np.mean(sf.entropy[song]) < 0.05
+    assert np.mean(sf.entropy[gap]) > 0.3
+
+    np.testing.assert_array_equal(sf.power, np.amax(sf.channel_power, 0))
+
+
+def test_combine_channels():
+    analyzer = AudioAnalyzer()
+    power = np.array([[1.0, 5.0, 2.0], [3.0, 1.0, 2.5]])
+    entropy = np.array([[0.9, 0.1, 0.8], [0.2, 0.7, 0.3]])
+    prbs = np.stack([np.stack([1 - entropy[c], entropy[c]])
+                     for c in range(2)])
+
+    np.testing.assert_array_equal(analyzer.combine_channels(power),
+                                  [3.0, 5.0, 2.5])
+    np.testing.assert_array_equal(analyzer.combine_channels(entropy, power),
+                                  [0.2, 0.1, 0.3])
+    np.testing.assert_array_equal(analyzer.combine_channels(prbs, power),
+                                  [[0.8, 0.9, 0.7], [0.2, 0.1, 0.3]])
+
+    mean = AudioAnalyzer(channel_combine='mean')
+    np.testing.assert_allclose(mean.combine_channels(entropy, power),
+                               [0.55, 0.4, 0.55])
+
+    with pytest.raises(ValueError):
+        AudioAnalyzer(channel_combine='sum').combine_channels(power)
+
+
+def test_channels_match_mono_processing():
+    sf, _ = one_singer(channels=2)
+    analyzer = AudioAnalyzer(min_freq=500)
+    Sxx = analyzer.process(sf, per_channel=True)
+    assert Sxx.shape[0] == 2
+
+    for c in range(2):
+        mono = SongFile(sf.samples[:, c], FS, scale=sf.scale)
+        Sxx_mono = analyzer.process(mono)
+        np.testing.assert_allclose(Sxx[c], Sxx_mono, rtol=1e-8)
+        np.testing.assert_allclose(sf.channel_power[c], mono.power,
+                                   rtol=1e-8)
+        np.testing.assert_allclose(sf.channel_entropy[c], mono.entropy,
+                                   rtol=1e-8, atol=1e-12)
+
+
+def test_classify_channels():
+    class Tonal(object):
+        """Calls low-entropy-looking samples song"""
+        def predict_proba(self, X, batch_size=None, verbose=0):
+            flat = X.reshape(X.shape[0], -1)
+            p = np.clip(np.amax(flat, 1) - np.median(flat, 1), 0, 1)
+            return np.stack([1 - p, p], axis=1)
+
+    sf, singing = one_singer()
+    analyzer = AudioAnalyzer(min_freq=500)
+    analyzer.classifier = Tonal()
+    analyzer.classify_channels(sf)
+
+    assert len(sf.channel_classification) == 4
+    assert analyzer.Sxx.ndim == 2
+    assert sf.classification.shape == sf.time.shape
+
+    # the combination follows the singing channel where it is loudest
+    song = singing(sf.time)
+    singer = sf.channel(1)
+    assert singer.classification.shape == sf.time.shape
+    assert np.mean(sf.classification[song] ==
+                   singer.classification[song]) > 0.9
+
+
+def test_load_channels(tmpdir):
+    sf, _ = one_singer(channels=3, seconds=1)
+    path = str(tmpdir.join('multi.wav'))
+    scipy.io.wavfile.write(path, int(FS), sf.samples)
+
+    mono = SongFile.load(path)[0]
+    assert mono.samples.ndim == 1
+    np.testing.assert_array_equal(mono.samples, sf.samples[:, 0])
+
+    both = SongFile.load(path, channels=[2, 0])[0]
+    np.testing.assert_array_equal(both.samples, sf.samples[:, [2, 0]])
+    assert both.channels == 2
+
+    every = SongFile.load(path, channels=None)[0]
+    np.testing.assert_array_equal(every.samples, sf.samples)
+
+    second = SongFile.load(path, channels=1)[0]
+    np.testing.assert_array_equal(second.samples, sf.samples[:, 1])
+
+
+def test_dropped_channels_warn(tmpdir, caplog):
+    sf, _ = one_singer(channels=3, seconds=1)
+    path = str(tmpdir.join('multi.wav'))
+    scipy.io.wavfile.write(path, int(FS), sf.samples)
+    mono = str(tmpdir.join('mono.wav'))
+    scipy.io.wavfile.write(mono, int(FS), sf.samples[:, 0])
+
+    def warnings(**kwargs):
+        caplog.clear()
+        with caplog.at_level(logging.WARNING, logger='JLAA.SongFile'):
+            SongFile.load(kwargs.pop('filename', path), **kwargs)
+        return [r.getMessage() for r in caplog.records
+                if 'channels=None' in r.getMessage()]
+
+    assert len(warnings()) == 1
+    assert '3 channels' in warnings()[0]
+    assert len(warnings(channels=[0, 2])) == 1
+    assert warnings(channels=None) == []
+    assert warnings(channels=[2, 1, 0]) == []
+    assert warnings(filename=mono) == []
+    assert warnings(filename=mono, channels=0) == []
+
+    block = str(tmpdir.join('multi' + BlockAudioFile.EXTENSION))
+    BlockAudioFile.from_wav(path, block, block_size=1000)
+    assert len(warnings(filename=block)) == 1
+
+    caplog.clear()
+    with caplog.at_level(logging.WARNING, logger='JLAA.SongFile'):
+        SongFile.load_range(block, 0.1, 0.5)
+        SongFile.load_range(block, 0.1, 0.5, channels=None)
+    assert len(caplog.records) == 1
@@ -0,0 +1,134 @@
+"""
+Tests of classifying many songs through shared inference batches
+"""
+import numpy as np
+import pytest
+
+from audioanalysis.cascade import frame_features
+from audioanalysis.freqanalysis import AudioAnalyzer, SongFile
+
+
+FS = 22050.0
+
+
+class Mean(object):
+    """A net whose song probability is the mean of each sample"""
+    def __init__(self):
+        self.batches = []
+
+    def predict_proba(self, X, batch_size=None, verbose=0):
+        self.batches.append(X.shape[0])
+        m = np.mean(X.reshape(X.shape[0], -1), axis=1)
+        return np.stack([1 - m, m], axis=1)
+
+
+class QuietCascade(object):
+    """Settles every frame quieter than a power threshold as silence"""
+    def __init__(self, threshold):
+        self.threshold = threshold
+
+    def features(self, sf, Sxx, idx=None):
+        return frame_features(sf, Sxx, idx)
+
+    def settle(self, X):
+        settled = X[:, 0] < self.threshold
+        prbs = np.zeros((X.shape[0], 2))
+        prbs[:, 0] = 1
+        return prbs, settled
+
+
+def songs():
+    """Songs of different lengths, one of them silent but for noise"""
+    rng = np.random.RandomState(0)
+    result = []
+    for n, (seconds, loud) in enumerate([(1.3, True), (0.4, True),
+                                         (2.1, False), (0.9, True)]):
+        t = np.arange(int(FS * seconds)) / FS
+        x = 0.001 * rng.randn(t.size)
+        if loud:
+            x += 0.3 * np.sin(2 * np.pi * 3000 * t) * ((t % 0.5) < 0.25)
+        result.append(SongFile((x * 30000).astype(np.int16), FS,
+                               name='song{0}'.format(n), scale=1 / 30000.0))
+    return result
+
+
+def record_probabilities(analyzer):
+    """Keep the probabilities postprocess is given, by song name"""
+    recorded = {}
+    postprocess = analyzer.postprocess
+
+    def record(prbs, sf):
+        recorded[sf.name] = prbs.copy()
+        return postprocess(prbs, sf)
+
+    analyzer.postprocess = record
+    return recorded
+
+
+def one_by_one(params, cascade=None):
+    analyzer = AudioAnalyzer(**params)
+    analyzer.classifier = Mean()
+    analyzer.cascade = cascade
+    recorded = record_probabilities(analyzer)
+
+    classes = {}
+    for sf in songs():
+        analyzer.set_active(sf)
+        analyzer.classify_active()
+        classes[sf.name] = np.asarray(sf.classification)
+
+    return recorded, classes
+
+
+@pytest.mark.parametrize('batch', [4096, 100, 37])
+@pytest.mark.parametrize('with_cascade', [False, True])
+def test_matches_classify_active(batch, with_cascade):
+    params = {'min_freq': 500, 'smooth_time': 0.05, 'inference_batch': batch}
+    cascade = QuietCascade(-9) if with_cascade else None
+    expected_prbs, expected = one_by_one(params, cascade)
+
+    analyzer = AudioAnalyzer(**params)
+    analyzer.classifier = Mean()
+    analyzer.cascade = cascade
+    recorded = record_probabilities(analyzer)
+
+    sfs = songs()
+    active = sfs[0]
+    analyzer.set_active(active)
+    Sxx = analyzer.Sxx
+    analyzer.classify_many(sfs)
+
+    assert analyzer.active_song is active and analyzer.Sxx is Sxx
+    for sf in sfs:
+        np.testing.assert_array_equal(recorded[sf.name],
+                                      expected_prbs[sf.name])
+        np.testing.assert_array_equal(np.asarray(sf.classification),
+                                      expected[sf.name])
+
+    # every batch but the last is full, so songs were split across them
+    sizes = analyzer.classifier.batches
+    assert all(size == batch for size in sizes[:-1])
+    assert 0 < sizes[-1] <= batch
+    if batch < 4096:
+        assert len(sizes) > len(sfs)
+
+    if with_cascade:
+        # the silent song is settled whole and never reaches the net
+        quiet = sfs[2]
+        assert np.all(recorded[quiet.name][0] == 1)
+        frames = sum(sf.time.size for sf in sfs)
+        assert sum(sizes) < frames - quiet.time.size
+
+
+def test_every_frame_settled():
+    params = {'min_freq': 500, 'smooth_time': 0.05, 'inference_batch': 64}
+    analyzer = AudioAnalyzer(**params)
+    analyzer.classifier = Mean()
+    analyzer.cascade = QuietCascade(np.inf)
+
+    sfs = songs()
+    analyzer.classify_many(sfs)
+
+    assert analyzer.classifier.batches == []
+    for sf in sfs:
+        assert not np.any(np.asarray(sf.classification))
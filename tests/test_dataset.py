@@ -0,0 +1,100 @@
+"""
+Tests of the sharded dataset builder
+"""
+import numpy as np
+import pytest
+
+from audioanalysis.dataset import DatasetBuilder, ShardedDataset
+from audioanalysis.freqanalysis import AudioAnalyzer, SongFile
+
+
+FS = 22050.0
+PARAMS = {'min_freq': 500, 'img_rows': 64, 'img_cols': 3}
+
+
+def labeled_song(seconds, seed):
+    rng = np.random.RandomState(seed)
+    samples = (rng.randn(int(FS * seconds)) * 3000).astype(np.int16)
+    sf = SongFile(samples, FS, name='song{0}'.format(seed), scale=1e-4)
+
+    frames = AudioAnalyzer(**PARAMS).plan_processing(sf)['frames']
+    sf.classification = (np.arange(frames) // 50 + seed) % 3
+    return sf
+
+
+def whole_song(sf):
+    """The samples and labels of sf built in one request"""
+    analyzer = AudioAnalyzer(**PARAMS)
+    analyzer.set_active(sf)
+    idx = np.arange(sf.time.size)
+    return analyzer.get_data_sample(idx), analyzer.get_classification(idx)
+
+
+@pytest.fixture(scope='module')
+def songs():
+    # a short motif file and two longer songs of different lengths
+    return [labeled_song(s, i) for i, s in enumerate((0.3, 2.0, 3.1))]
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_build_matches_whole_song_samples(tmpdir, songs, processes):
+    builder = DatasetBuilder(str(tmpdir), shard_size=500, block_size=64,
+                             **PARAMS)
+
+    np.random.seed(0)
+    dataset = builder.build(songs, processes=processes)
+
+    np.random.seed(0)
+    frames = [AudioAnalyzer(**PARAMS).plan_processing(sf)['frames']
+              for sf in songs]
+    layout = builder._layout(frames)
+
+    assert len(dataset) == sum(frames)
+    assert dataset.sample_shape == (1, 64, 3)
+    assert [s['size'] for s in dataset.shards][:-1] == \
+        [500] * (len(dataset.shards) - 1)
+
+    X = np.concatenate([dataset.shard(n)[0] for n in range(len(dataset.shards))])
+    y = np.concatenate([dataset.shard(n)[1] for n in range(len(dataset.shards))])
+
+    for sf, placement in zip(songs, layout):
+        X_song, y_song = whole_song(sf)
+        for first, last, offset in placement:
+            np.testing.assert_allclose(X[offset:offset + last - first],
+                                       X_song[first:last], rtol=1e-6)
+            np.testing.assert_array_equal(y[offset:offset + last - first],
+                                          y_song[first:last])
+
+
+def test_shards_mix_songs(tmpdir, songs):
+    builder = DatasetBuilder(str(tmpdir), shard_size=500, block_size=64,
+                             **PARAMS)
+    np.random.seed(1)
+    builder.build(songs, processes=1)
+
+    np.random.seed(1)
+    frames = [AudioAnalyzer(**PARAMS).plan_processing(sf)['frames']
+              for sf in songs]
+    layout = builder._layout(frames)
+
+    # every full shard holds blocks of more than one song
+    for n in range(sum(frames) // 500):
+        owners = set(i for i, placement in enumerate(layout)
+                     for _, _, offset in placement
+                     if n * 500 <= offset < (n + 1) * 500)
+        assert len(owners) > 1
+
+
+def test_split_by_samples(tmpdir, songs):
+    builder = DatasetBuilder(str(tmpdir), shard_size=200, **PARAMS)
+    dataset = builder.build(songs, processes=1)
+
+    train, test = dataset.split(0.25)
+    assert sorted(train + test) == list(range(len(dataset.shards)))
+
+    held = sum(dataset.shards[n]['size'] for n in test)
+    assert abs(held - 0.25 * len(dataset)) <= 200
+
+    reopened = ShardedDataset(str(tmpdir))
+    seen = sum(y.size for _, y in reopened.batches(64, train))
+    assert seen == len(dataset) - held
@@ -0,0 +1,122 @@
+"""
+Tests of SongFile export and the bulk exporter
+"""
+import os
+import time
+
+import numpy as np
+import pytest
+import scipy.io.wavfile
+
+from audioanalysis.export import BulkExporter, MotifArchive
+from audioanalysis.freqanalysis import SongFile
+
+
+def songfile(seed, channels=1):
+    rng = np.random.RandomState(seed)
+    shape = (1000,) if channels == 1 else (1000, channels)
+    return SongFile((rng.randn(*shape) * 3000).astype(np.int16), 8000.0,
+                    name='clip{0}'.format(seed), start=seed, scale=1e-4)
+
+
+class SlowSongFile(SongFile):
+    """A SongFile whose samples take delay seconds to read"""
+    delay = 0
+
+    @property
+    def samples(self):
+        time.sleep(self.delay)
+        return self._samples
+
+    @samples.setter
+    def samples(self, value):
+        self._samples = value
+
+
+@pytest.mark.parametrize('int16', [False, True])
+@pytest.mark.parametrize('filename', [None, 'named', 'named.wav'])
+def test_bulk_files_match_export(tmpdir, filename, int16):
+    sf = songfile(0)
+    single = tmpdir.mkdir('single')
+    bulk = tmpdir.mkdir('bulk')
+
+    sf.export(str(single), filename)
+    with BulkExporter(str(bulk), workers=2, int16=int16) as exporter:
+        exporter.submit(sf, filename)
+
+    assert os.listdir(str(single)) == os.listdir(str(bulk))
+    name = os.listdir(str(bulk))[0]
+    assert name == sf.output_filename(filename)
+    assert name.count('.wav') == 1
+
+    with open(os.path.join(str(single), name), 'rb') as f:
+        expected = f.read()
+    with open(os.path.join(str(bulk), name), 'rb') as f:
+        assert f.read() == expected
+
+    _, data = scipy.io.wavfile.read(os.path.join(str(bulk), name))
+    assert data.dtype == np.int16
+    np.testing.assert_array_equal(data, sf.samples)
+
+
+def test_bulk_float_songs(tmpdir):
+    sf = SongFile(np.linspace(-0.5, 0.5, 800, dtype=np.float32), 8000.0,
+                  name='float')
+
+    with BulkExporter(str(tmpdir), int16=False) as exporter:
+        exporter.submit(sf, 'as_float')
+    with BulkExporter(str(tmpdir), int16=True) as exporter:
+        exporter.submit(sf, 'as_int16')
+
+    _, data = scipy.io.wavfile.read(str(tmpdir.join('as_float.wav')))
+    assert data.dtype == np.float32
+    _, data = scipy.io.wavfile.read(str(tmpdir.join('as_int16.wav')))
+    assert data.dtype == np.int16
+    np.testing.assert_allclose(data / 32767.0, sf.data, atol=1e-4)
+
+
+def test_output_filename():
+    sf = songfile(2)
+    assert sf.output_filename() == str(sf) + '.wav'
+    assert sf.output_filename(extension='.pkl') == str(sf) + '.pkl'
+    assert sf.output_filename('a.pkl', '.pkl') == 'a.pkl'
+    assert sf.output_filename('a.pkl') == 'a.pkl.wav'
+
+
+def test_archive_round_trip(tmpdir):
+    songs = [songfile(i, channels=1 + i % 2) for i in range(4)]
+    with BulkExporter(str(tmpdir), archive='motifs.arc') as exporter:
+        exporter.export(songs)
+
+    archive = MotifArchive(str(tmpdir.join('motifs.arc')))
+    assert len(archive) == len(songs)
+
+    by_name = dict((entry['name'], i)
+                   for i, entry in enumerate(archive.entries))
+    for sf in songs:
+        clip = archive.read(by_name[sf.name])
+        np.testing.assert_array_equal(clip.samples, sf.samples)
+        assert clip.scale == sf.scale
+        assert clip.start == sf.start
+
+
+def test_archive_keeps_submit_order(tmpdir):
+    songs = []
+    for i in range(8):
+        sf = songfile(i)
+        slow = SlowSongFile(sf.samples, sf.Fs, name=sf.name, start=sf.start,
+                            scale=sf.scale)
+        # earlier clips take longer, so they finish last
+        slow.delay = 0.01 * (8 - i)
+        songs.append(slow)
+
+    with BulkExporter(str(tmpdir), workers=4, archive='motifs.arc') as \
+            exporter:
+        exporter.export(songs)
+
+    archive = MotifArchive(str(tmpdir.join('motifs.arc')))
+    assert [entry['seq'] for entry in archive.entries] == list(range(8))
+    assert [entry['name'] for entry in archive.entries] == \
+        [sf.name for sf in songs]
+    for i, sf in enumerate(songs):
+        np.testing.assert_array_equal(archive.samples(i), sf._samples)
@@ -0,0 +1,97 @@
+"""
+Tests of the batched inference server
+"""
+import threading
+import time
+
+import numpy as np
+
+from audioanalysis.freqanalysis import AudioAnalyzer
+from audioanalysis.inference import InferenceServer, InferenceClient
+
+
+class Stub(object):
+    """Returns each sample's first value and its negation, slowly"""
+    def __init__(self):
+        self.batches = []
+
+    def predict_proba(self, X, batch_size=None, verbose=0):
+        self.batches.append(X.shape[0])
+        time.sleep(0.01)
+        first = X[:, 0, 0, 0]
+        return np.stack([first, -first], axis=1)
+
+
+def start_server(tmpdir, monkeypatch, **kwargs):
+    stub = Stub()
+    monkeypatch.setattr(AudioAnalyzer, 'load_neural_net',
+                        lambda self, folder: stub)
+
+    server = InferenceServer(str(tmpdir), address=str(tmpdir.join('s.sock')),
+                             **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server, thread, stub
+
+
+def test_concurrent_clients(tmpdir, monkeypatch):
+    server, thread, stub = start_server(tmpdir, monkeypatch,
+                                        max_latency_ms=100)
+    clients = [InferenceClient(server.address) for _ in range(8)]
+    assert clients[0].folder == server.folder
+
+    go = threading.Event()
+    results = {}
+
+    def predict(c):
+        X = (1000 * c + np.arange(20 + c, dtype=np.float32))
+        X = X.reshape(-1, 1, 1, 1)
+        go.wait()
+        for repeat in range(3):
+            results[c, repeat] = (X, clients[c].predict_proba(X))
+
+    threads = [threading.Thread(target=predict, args=(c,))
+               for c in range(len(clients))]
+    for t in threads:
+        t.start()
+    go.set()
+    for t in threads:
+        t.join(10)
+
+    assert len(results) == 24
+    for X, prbs in results.values():
+        np.testing.assert_array_equal(prbs[:, 0], X.ravel())
+        np.testing.assert_array_equal(prbs[:, 1], -X.ravel())
+
+    assert server.requests == 24
+    assert server.batches == len(stub.batches) < 24
+    assert sum(stub.batches) == sum(X.shape[0] for X, _ in results.values())
+
+    for client in clients[1:]:
+        client.close()
+    clients[0].shutdown()
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_full_batch_runs_at_once(tmpdir, monkeypatch):
+    server, thread, stub = start_server(tmpdir, monkeypatch, max_batch=10,
+                                        max_latency_ms=1000)
+
+    with InferenceClient(server.address) as client:
+        start = time.time()
+        prbs = client.predict_proba(np.ones((12, 1, 2, 1), dtype=np.float32))
+        # a full batch does not wait out the latency
+        assert time.time() - start < 1
+
+        empty = client.predict_proba(np.zeros((0, 1, 2, 1),
+                                              dtype=np.float32))
+
+    assert prbs.shape == (12, 2)
+    assert empty.shape == (0, 2)
+
+    server.close()
+    thread.join(5)
+    assert not thread.is_alive()
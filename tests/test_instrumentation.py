@@ -0,0 +1,132 @@
+"""
+Tests of stage instrumentation and its sinks
+"""
+import json
+
+import numpy as np
+import pytest
+import scipy.io.wavfile
+
+from audioanalysis.freqanalysis import AudioAnalyzer
+from audioanalysis.instrumentation import (Instrumentation, JSONLinesSink,
+                                           AggregateSink)
+
+
+FS = 22050
+
+STAGES = ['load', 'highpass', 'stft', 'features', 'samples', 'inference',
+          'smoothing', 'thresholding', 'medfilt', 'motifs']
+
+
+class Loudness(object):
+    """Calls loud samples song"""
+    def predict_proba(self, X, batch_size=None, verbose=0):
+        p = np.mean(X.reshape(X.shape[0], -1), axis=1)
+        return np.stack([1 - p, p], axis=1)
+
+
+def run_pipeline(tmpdir, instrumentation):
+    rng = np.random.RandomState(0)
+    t = np.arange(FS * 4) / float(FS)
+    x = 0.3 * np.sin(2 * np.pi * 3000 * t) * ((t % 2) < 1) + \
+        0.01 * rng.randn(t.size)
+    path = str(tmpdir.join('song.wav'))
+    scipy.io.wavfile.write(path, FS, (x * 30000).astype(np.int16))
+
+    analyzer = AudioAnalyzer(min_freq=500, power_threshold=-200,
+                             medfilt_time=0.05)
+    analyzer.instrumentation = instrumentation
+    analyzer.classifier = Loudness()
+
+    sf = analyzer.load_song(path)[0]
+    analyzer.set_active(sf)
+    analyzer.classify_active()
+    sf.find_motifs(instrumentation=instrumentation)
+
+
+def test_every_stage_recorded(tmpdir):
+    aggregate = AggregateSink()
+    run_pipeline(tmpdir, Instrumentation(sinks=[aggregate]))
+
+    assert set(STAGES) <= set(aggregate.stages)
+    for name in STAGES:
+        totals = aggregate.stages[name]
+        assert totals['count'] >= 1
+        assert totals['wall_s'] >= 0
+        assert totals['cpu_s'] >= 0
+
+    assert aggregate.stages['load']['items'] == FS * 4
+    assert aggregate.stages['samples']['items'] > 0
+    assert [s['wall_s'] for s in aggregate.summary()] == sorted(
+        [s['wall_s'] for s in aggregate.summary()], reverse=True)
+    assert 'inference' in str(aggregate)
+
+
+def test_json_lines(tmpdir):
+    path = str(tmpdir.join('pipeline.jsonl'))
+    sink = JSONLinesSink(path)
+    run_pipeline(tmpdir, Instrumentation(sinks=[sink]))
+    sink.close()
+
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert set(STAGES) <= set(r['stage'] for r in records)
+    for record in records:
+        assert set(['wall_s', 'cpu_s', 'peak_bytes', 'maxrss_bytes',
+                    'items']) <= set(record)
+
+    with open(path, 'w') as f:
+        with Instrumentation(sinks=[JSONLinesSink(f)]).stage(
+                'load', items=3, song='x'):
+            pass
+    with open(path) as f:
+        record = json.loads(f.read())
+    assert (record['stage'], record['items'], record['song']) == \
+        ('load', 3, 'x')
+
+
+def test_no_sinks_records_nothing():
+    instrumentation = Instrumentation()
+    with instrumentation.stage('stft', items=5) as record:
+        pass
+    assert record == {'stage': 'stft', 'items': 5}
+
+
+def traced():
+    instrumentation = Instrumentation(trace_memory=True)
+    if not instrumentation.trace_memory:
+        pytest.skip('tracemalloc.reset_peak is not available')
+    return instrumentation
+
+
+def test_nested_stages_report_own_peaks():
+    aggregate = AggregateSink()
+    instrumentation = traced()
+    instrumentation.add_sink(aggregate)
+
+    with instrumentation.stage('outer'):
+        with instrumentation.stage('inner'):
+            small = np.ones(125000)  # 1 MB
+            del small
+        big = np.ones(1000000)  # 8 MB
+        del big
+
+    inner = aggregate.stages['inner']['peak_bytes']
+    outer = aggregate.stages['outer']['peak_bytes']
+    assert 1e6 <= inner < 2e6
+    assert 8e6 <= outer < 9e6
+    assert instrumentation._stack() == []
+
+
+def test_equal_frames_pop_in_order():
+    instrumentation = traced()
+
+    outer = instrumentation._enter()
+    inner = instrumentation._enter()
+    outer.update(base=0, peak=0)
+    inner.update(base=0, peak=0)
+
+    instrumentation._exit(inner)
+    assert instrumentation._stack()[-1] is outer
+    instrumentation._exit(outer)
+    assert instrumentation._stack() == []
@@ -0,0 +1,102 @@
+"""
+Tests of the on-disk motif index
+"""
+import logging
+import os
+
+import numpy as np
+
+from audioanalysis.freqanalysis import AudioAnalyzer, SongFile
+from audioanalysis.motifindex import MotifIndex
+
+
+FS = 22050.0
+
+
+def motif(seed):
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(FS * 0.3)) / FS
+    x = np.sin(2 * np.pi * (1000 + 500 * seed) * t) + 0.1 * rng.randn(t.size)
+    sf = SongFile((x * 10000).astype(np.int16), FS,
+                  name='motif{0}'.format(seed), scale=1e-4)
+    return sf, AudioAnalyzer().process(sf)
+
+
+def test_interrupted_add_is_discarded(tmpdir):
+    folder = str(tmpdir.join('index'))
+    index = MotifIndex(folder)
+    index.add_many([motif(i) for i in range(3)])
+
+    # an add_many that wrote its rows but not the header
+    interrupted = MotifIndex(folder)
+    count = interrupted.header['count']
+    interrupted.add_many([motif(i) for i in range(3, 5)])
+    interrupted.header['count'] = count
+    interrupted._write_header()
+
+    reopened = MotifIndex(folder)
+    assert len(reopened) == 3
+    assert os.path.getsize(os.path.join(folder, MotifIndex.EMBEDDINGS)) == \
+        3 * reopened.dim * 4
+
+    ids = reopened.add_many([motif(7)])
+    assert ids == [3]
+
+    sf, Sxx = motif(7)
+    best = reopened.query(sf, Sxx, k=1)[0]
+    assert best['id'] == 3
+    assert best['name'] == 'motif7'
+    assert [m['name'] for m in reopened.metadata([0, 2, 3])] == \
+        ['motif0', 'motif2', 'motif7']
+
+
+def reference_dtw(q, c, r):
+    """Squared banded DTW distance, one cell at a time"""
+    n = q.shape[1]
+    D = np.full((n + 1, n + 1), np.inf)
+    D[0, 0] = 0
+    for i in range(1, n + 1):
+        for j in range(max(1, i - r), min(n, i + r) + 1):
+            cost = np.sum(np.square(q[:, i - 1] - c[:, j - 1]))
+            D[i, j] = cost + min(D[i - 1, j - 1], D[i - 1, j], D[i, j - 1])
+    return D[n, n]
+
+
+def test_dtw_matches_reference():
+    rng = np.random.RandomState(1)
+    q = rng.randn(2, 20)
+    C = rng.randn(5, 2, 20)
+    for r in (1, 3, 20):
+        np.testing.assert_allclose(
+            MotifIndex.dtw(q, C, r),
+            [reference_dtw(q, c, r) for c in C], rtol=1e-12)
+
+
+def test_rerank_matches_brute_force(tmpdir, caplog):
+    index = MotifIndex(str(tmpdir.join('index')), contour_length=32)
+    rng = np.random.RandomState(2)
+    query = rng.randn(*index.contour_shape)
+
+    # a few near neighbours among many unrelated contours, so most
+    # candidates are pruned by their lower bound
+    contours = rng.randn(400, *index.contour_shape)
+    contours[::50] = query + 0.3 * rng.randn(8, *index.contour_shape)
+    contours = contours.astype(np.float32)
+    cand = np.sort(rng.choice(400, 300, replace=False))
+    cand = np.union1d(cand, np.arange(0, 400, 50))
+
+    exact = MotifIndex.dtw(query, contours[cand].astype(np.float64),
+                           index.window)
+
+    for k in (1, 5, 12):
+        with caplog.at_level(logging.DEBUG, logger='JLAA.MotifIndex'):
+            ids, distances = index._rerank(query, cand, contours, k)
+
+        order = np.argsort(exact)[:k]
+        np.testing.assert_array_equal(ids, cand[order])
+        np.testing.assert_allclose(distances, np.sqrt(exact[order]),
+                                   rtol=1e-12)
+
+    pruned = [r.getMessage() for r in caplog.records if 'pruned' in
+              r.getMessage()]
+    assert pruned and not pruned[0].startswith('DTW re-ranking pruned 0 ')
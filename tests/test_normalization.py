@@ -0,0 +1,114 @@
+"""
+Tests of corpus-wide normalization statistics
+"""
+import numpy as np
+import pytest
+
+from audioanalysis.freqanalysis import AudioAnalyzer, SongFile
+from audioanalysis.normalization import NormalizationStats
+
+
+FS = 22050.0
+
+
+def spectrogram(cols, seed=0):
+    rng = np.random.RandomState(seed)
+    Sxx = rng.lognormal(-20, 3, size=(65, cols))
+    Sxx[3, 5] = 0
+    return Sxx
+
+
+def noise_song(seconds, seed=0):
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(FS * seconds)) / FS
+    x = 0.2 * np.sin(2 * np.pi * 2000 * t) * ((t % 1) < 0.5) + \
+        0.02 * rng.randn(t.size)
+    return SongFile((x * 30000).astype(np.int16), FS, scale=1 / 30000.0)
+
+
+@pytest.mark.parametrize('mode', NormalizationStats.MODES)
+def test_chunks_and_merge_match_one_pass(mode):
+    Sxx = spectrogram(5000)
+
+    whole = NormalizationStats(mode)
+    whole.update(Sxx)
+
+    parts = []
+    for start, stop in [(0, 1), (1, 1200), (1200, 1200), (1200, 5000)]:
+        part = NormalizationStats(mode)
+        part.chunk_cols = 333
+        part.update(Sxx[:, start:stop])
+        parts.append(part)
+
+    merged = NormalizationStats(mode)
+    for part in parts:
+        merged.merge(part)
+
+    assert merged.count == whole.count == 5000
+    np.testing.assert_array_equal(merged.minimum, whole.minimum)
+    np.testing.assert_array_equal(merged.maximum, whole.maximum)
+    np.testing.assert_allclose(merged.mean, whole.mean, rtol=1e-12)
+    np.testing.assert_allclose(merged.std, whole.std, rtol=1e-9)
+    np.testing.assert_allclose(merged.apply(Sxx), whole.apply(Sxx),
+                               rtol=1e-9, atol=1e-12)
+
+    logS = NormalizationStats.log_power(Sxx)
+    assert np.all(np.isfinite(logS))
+    np.testing.assert_allclose(whole.mean, np.mean(logS, 1), rtol=1e-12)
+    np.testing.assert_allclose(whole.std, np.std(logS, 1), rtol=1e-9)
+
+
+def test_apply_scales_rows():
+    Sxx = spectrogram(1000)
+    stats = NormalizationStats('minmax')
+    stats.update(Sxx)
+
+    scaled = stats.apply(Sxx)
+    np.testing.assert_allclose(np.amin(scaled, 1), 0, atol=1e-12)
+    np.testing.assert_allclose(np.amax(scaled, 1), 1, atol=1e-12)
+    np.testing.assert_array_equal(stats.apply(Sxx[0:10, 0:50]),
+                                  scaled[0:10, 0:50])
+    assert stats.apply(Sxx.astype(np.float32)).dtype == np.float32
+
+    with pytest.raises(ValueError):
+        stats.update(Sxx[0:10])
+
+
+def test_save_and_load(tmpdir):
+    assert NormalizationStats.load(str(tmpdir)) is None
+
+    stats = NormalizationStats('standard')
+    stats.update(spectrogram(700))
+    stats.save(str(tmpdir))
+
+    loaded = NormalizationStats.load(str(tmpdir))
+    assert loaded.mode == 'standard'
+    assert loaded.count == 700
+    for name in ('minimum', 'maximum', 'total', 'total_sq'):
+        np.testing.assert_array_equal(getattr(loaded, name),
+                                      getattr(stats, name))
+
+    Sxx = spectrogram(100, seed=1)
+    np.testing.assert_array_equal(loaded.apply(Sxx), stats.apply(Sxx))
+
+
+def test_unknown_mode_rejected():
+    with pytest.raises(ValueError):
+        NormalizationStats('zscore')
+    with pytest.raises(ValueError):
+        NormalizationStats().affine()
+
+
+def test_frames_match_between_requests():
+    analyzer = AudioAnalyzer(min_freq=500, img_cols=3)
+    analyzer.compute_normalization([noise_song(2, seed=1),
+                                    noise_song(2, seed=2)])
+
+    analyzer.set_active(noise_song(3))
+    frames = analyzer.Sxx.shape[1]
+    whole = analyzer.get_data_sample(np.arange(frames))
+
+    for idx in (np.arange(10, 20), np.array([0, frames - 1]),
+                np.arange(frames // 2, frames)):
+        np.testing.assert_array_equal(analyzer.get_data_sample(idx),
+                                      whole[idx])
@@ -0,0 +1,124 @@
+"""
+Accuracy of float32 processing against the float64 path
+"""
+import numpy as np
+import pytest
+
+from audioanalysis.freqanalysis import AudioAnalyzer, SongFile
+
+
+FS = 22050
+
+
+def synthetic_song(seconds=10, seed=1):
+    """int16 samples of a gated 3 kHz tone over noise and 60 Hz hum"""
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(FS * seconds)) / float(FS)
+    x = (0.3 * np.sin(2 * np.pi * 3000 * t) * (np.sin(2 * np.pi * 0.5 * t) > 0)
+         + 0.02 * rng.randn(t.size) + 0.2 * np.sin(2 * np.pi * 60 * t))
+    return (x / np.amax(np.abs(x)) * 30000).astype(np.int16)
+
+
+def run(dtype, samples, **params):
+    analyzer = AudioAnalyzer(dtype=dtype, min_freq=500, **params)
+    sf = SongFile(samples, float(FS), scale=1 / 30000.0)
+    analyzer.set_active(sf)
+    idx = np.arange(analyzer.Sxx.shape[1])
+
+    return {
+        'analyzer': analyzer,
+        'sf': sf,
+        'Sxx': analyzer.Sxx,
+        'filtered': analyzer.highpass(sf),
+        'samples': analyzer.get_data_sample(idx),
+    }
+
+
+@pytest.fixture(scope='module')
+def results():
+    samples = synthetic_song()
+    return (run('float64', samples, passband_floor=True),
+            run('float32', samples))
+
+
+def test_dtypes(results):
+    r64, r32 = results
+    for key in ('Sxx', 'filtered', 'samples'):
+        assert r64[key].dtype == np.float64
+        assert r32[key].dtype == np.float32
+    assert r32['sf'].power.dtype == np.float32
+    assert r32['sf'].entropy.dtype == np.float32
+
+
+def test_filtered_signal(results):
+    r64, r32 = results
+    np.testing.assert_allclose(r32['filtered'], r64['filtered'], rtol=0,
+                               atol=1e-5 * np.amax(np.abs(r64['filtered'])))
+
+
+def test_spectrogram_passband(results):
+    r64, r32 = results
+    first = r64['analyzer'].passband_row(r64['Sxx'].shape[0])
+    assert first > 0
+
+    # within 0.1 dB above the highpass cutoff
+    np.testing.assert_allclose(np.log10(r32['Sxx'][first:]),
+                               np.log10(r64['Sxx'][first:]), rtol=0,
+                               atol=0.01)
+
+
+def test_power_and_entropy(results):
+    r64, r32 = results
+    np.testing.assert_allclose(r32['sf'].power, r64['sf'].power, rtol=1e-5)
+    np.testing.assert_allclose(r32['sf'].entropy, r64['sf'].entropy, rtol=0,
+                               atol=1e-3)
+
+
+def test_samples(results):
+    r64, r32 = results
+    diff = np.abs(r32['samples'] - r64['samples'])
+    assert np.amax(diff) < 5e-3
+    assert np.mean(diff) < 1e-4
+
+
+def test_sample_bounds_ignore_stopband(results):
+    r64, r32 = results
+    b64 = r64['analyzer'].sample_bounds()
+    b32 = r32['analyzer'].sample_bounds()
+    np.testing.assert_allclose(b32, b64, rtol=0, atol=0.01)
+
+    # the stopband floor is below the bounds and is clamped to zero
+    assert np.log10(np.amin(r64['Sxx'])) < b64[0]
+    assert np.amin(r64['samples']) == 0
+    assert np.amin(r32['samples']) == 0
+
+
+def test_bounds_match_whole_request(results):
+    r64, _ = results
+    analyzer = r64['analyzer']
+    idx = np.arange(100, 200)
+    np.testing.assert_allclose(
+        analyzer.get_data_sample(idx, bounds=analyzer.sample_bounds()),
+        r64['samples'][idx])
+
+
+def test_float64_default_matches_baseline():
+    analyzer = run('float64', synthetic_song(seconds=5))['analyzer']
+    assert analyzer.sample_floor_row(analyzer.Sxx.shape[0]) == 0
+
+    idx = np.arange(analyzer.Sxx.shape[1])
+    expected = np.log10(analyzer.Sxx.T[:, np.newaxis, :, np.newaxis])
+    expected -= np.amin(expected)
+    expected /= np.amax(expected)
+
+    np.testing.assert_allclose(analyzer.get_data_sample(idx), expected,
+                               rtol=0, atol=1e-12)
+    np.testing.assert_allclose(
+        analyzer.get_data_sample(idx[100:200],
+                                 bounds=analyzer.sample_bounds()),
+        expected[100:200], rtol=0, atol=1e-12)
+
+
+def test_float16_rejected():
+    with pytest.raises(ValueError):
+        AudioAnalyzer(dtype='float16').processing_dtype()
@@ -0,0 +1,140 @@
+"""
+Tests of chunked processing and memory planning
+"""
+import logging
+
+import numpy as np
+import pytest
+import scipy.io.wavfile
+
+from audioanalysis.freqanalysis import AudioAnalyzer, SongFile
+
+
+FS = 22050.0
+
+
+def noise_song(seconds, seed=0):
+    rng = np.random.RandomState(seed)
+    samples = (rng.randn(int(FS * seconds)) * 3000).astype(np.int16)
+    return SongFile(samples, FS, name='noise', scale=1e-4)
+
+
+def test_chunks_match_single_pass():
+    sf = noise_song(3)
+    whole = AudioAnalyzer(min_freq=500, process_chunk_s=100)
+    chunked = AudioAnalyzer(min_freq=500, process_chunk_s=0.25)
+
+    Sxx = whole.process(sf)
+    power, entropy, time = sf.power, sf.entropy, sf.time
+    assert len(whole.processing_plan['chunks']) == 1
+
+    Sxx_chunked = chunked.process(sf)
+    assert len(chunked.processing_plan['chunks']) > 5
+
+    np.testing.assert_allclose(Sxx_chunked, Sxx, rtol=1e-10)
+    np.testing.assert_allclose(sf.power, power, rtol=1e-10)
+    np.testing.assert_allclose(sf.entropy, entropy, rtol=1e-10)
+    np.testing.assert_allclose(sf.time, time)
+
+
+@pytest.mark.parametrize('n', [2, 50, 219])
+def test_shorter_than_one_window(n):
+    sf = SongFile(np.arange(n, dtype=np.int16) - 25, FS, scale=1e-3)
+    analyzer = AudioAnalyzer()
+    assert n < analyzer.stft_geometry(FS)[0]
+
+    plan = analyzer.plan_processing(sf)
+    assert plan['frames'] == 1
+    assert plan['chunks'] == [(0, n)]
+    assert plan['noverlap'] < plan['nperseg'] == n
+
+    Sxx = analyzer.process(sf)
+    assert Sxx.shape[1] == sf.time.size == sf.power.size == 1
+
+
+def test_empty_song_rejected():
+    with pytest.raises(ValueError):
+        AudioAnalyzer().plan_processing(
+            SongFile(np.zeros(0, dtype=np.int16), FS))
+
+
+def test_peak_over_budget_warns(caplog):
+    sf = noise_song(10)
+    analyzer = AudioAnalyzer(memory_budget=3e6)
+
+    with caplog.at_level(logging.WARNING, logger='JLAA.AudioAnalyzer'):
+        plan = analyzer.plan_processing(sf)
+
+    assert plan['estimated_bytes']['peak'] > 3e6
+    assert any('memory budget' in r.getMessage() for r in caplog.records)
+
+
+@pytest.mark.parametrize('budget', [20e6, 60e6])
+def test_max_song_length_fits_budget(caplog, budget):
+    analyzer = AudioAnalyzer(memory_budget=budget)
+    seconds = analyzer.max_song_length(FS)
+    assert seconds > 1
+
+    with caplog.at_level(logging.WARNING, logger='JLAA.AudioAnalyzer'):
+        plan = analyzer.plan_processing(noise_song(seconds * 0.99))
+
+    assert plan['estimated_bytes']['peak'] <= budget
+    assert not caplog.records
+
+
+def test_chunked_inference_matches_whole_song():
+    class Mean(object):
+        def predict_proba(self, X, batch_size=None, verbose=0):
+            m = np.mean(X.reshape(X.shape[0], -1), axis=1)
+            return np.stack([1 - m, m], axis=1)
+
+    sf = noise_song(2)
+    results = []
+    for chunk in (100000, 333):
+        analyzer = AudioAnalyzer(min_freq=500, inference_chunk=chunk)
+        analyzer.classifier = Mean()
+        analyzer.set_active(sf)
+        results.append(analyzer.predict_active())
+
+    np.testing.assert_allclose(results[1], results[0], rtol=1e-12)
+
+
+def owner(array):
+    """The object that owns the memory of array"""
+    while isinstance(array, np.ndarray) and array.base is not None:
+        array = array.base
+    return array
+
+
+@pytest.mark.parametrize('dtype', [np.int16, np.float32])
+def test_sections_do_not_hold_the_file(tmpdir, dtype):
+    rng = np.random.RandomState(1)
+    samples = rng.randn(int(FS * 30), 3) * 0.1
+    if dtype == np.int16:
+        samples = (samples * 30000).astype(np.int16)
+    else:
+        samples = samples.astype(np.float32)
+    path = str(tmpdir.join('long.wav'))
+    scipy.io.wavfile.write(path, int(FS), samples)
+
+    analyzer = AudioAnalyzer(memory_budget=20e6)
+    sfs = analyzer.load_song(path, channels=[2, 0])
+    assert len(sfs) > 1
+
+    for sf in sfs:
+        root = owner(sf.samples)
+        assert not (isinstance(root, np.ndarray) and
+                    root.nbytes > sf.samples.nbytes)
+        assert sf.samples.nbytes < samples.nbytes / 2
+
+    joined = np.concatenate([sf.samples for sf in sfs])
+    if dtype == np.int16:
+        np.testing.assert_array_equal(joined, samples[:, [2, 0]])
+    else:
+        np.testing.assert_allclose(joined,
+                                   samples[:, [2, 0]] / np.max(samples))
+
+    if dtype == np.int16:
+        # single channels of integer sections are views of the memory map
+        first = SongFile.load(path, split=5, channels=1)[0]
+        assert not isinstance(owner(first.samples), np.ndarray)
@@ -0,0 +1,110 @@
+"""
+Tests of the multi-resolution spectrogram pyramid
+"""
+import numpy as np
+import pytest
+
+from audioanalysis.freqanalysis import SongFile
+from audioanalysis.normalization import NormalizationStats
+from audioanalysis.pyramid import SpectrogramPyramid
+
+
+def processed_song(frames=5001, rows=40, seed=0):
+    """A SongFile with the attributes process sets, and its spectrogram"""
+    rng = np.random.RandomState(seed)
+    sf = SongFile(np.zeros(10, dtype=np.int16), 22050.0, name='song')
+    sf.time = np.arange(frames) * 0.01
+    sf.freq = np.linspace(0, 11025, rows)
+    sf.power = rng.lognormal(-15, 2, frames)
+    sf.entropy = rng.uniform(size=frames)
+
+    labels = np.zeros(frames)
+    labels[1000:1003] = 2
+    labels[2000:2600] = 1
+    labels[4999] = 3
+    sf.classification = labels
+
+    Sxx = rng.lognormal(-25, 4, size=(rows, frames))
+    return sf, Sxx
+
+
+@pytest.fixture(params=['float32', 'float16'])
+def pyramid(request, tmpdir, monkeypatch):
+    monkeypatch.setattr(SpectrogramPyramid, 'block_cols', 300)
+    sf, Sxx = processed_song()
+    return (SpectrogramPyramid.build(str(tmpdir.join('pyr')), sf, Sxx,
+                                     min_columns=100, dtype=request.param),
+            sf, Sxx)
+
+
+def test_levels_pool_pairs(pyramid):
+    pyr, sf, Sxx = pyramid
+    assert pyr.levels == 7
+
+    mean, maximum, tracks = pyr._level(0)
+    np.testing.assert_allclose(
+        mean, NormalizationStats.log_power(Sxx).T, rtol=0,
+        atol=1e-5 if mean.dtype == np.float32 else 0.01)
+    np.testing.assert_array_equal(tracks[:, 3], sf.classification != 0)
+
+    for level in range(1, pyr.levels):
+        below_mean, below_max, below_tracks = pyr._level(level - 1)
+        mean, maximum, tracks = pyr._level(level)
+        n = below_mean.shape[0]
+        assert mean.shape[0] == maximum.shape[0] == (n + 1) // 2
+
+        # an odd last column is paired with itself
+        pairs = np.append(np.arange(n), [n - 1] * (n % 2)).astype(int)
+        pairs = pairs.reshape(-1, 2)
+        np.testing.assert_array_equal(
+            maximum, np.maximum(below_max[pairs[:, 0]],
+                                below_max[pairs[:, 1]]))
+        np.testing.assert_allclose(
+            mean, (below_mean[pairs[:, 0]].astype(np.float32) +
+                   below_mean[pairs[:, 1]]) / 2,
+            rtol=1e-6 if mean.dtype == np.float32 else 1e-3)
+
+        np.testing.assert_allclose(
+            tracks[:, 0], (below_tracks[pairs[:, 0], 0] +
+                           below_tracks[pairs[:, 1], 0]) / 2, rtol=1e-6)
+        np.testing.assert_array_equal(
+            tracks[:, 1], np.maximum(below_tracks[pairs[:, 0], 1],
+                                     below_tracks[pairs[:, 1], 1]))
+        np.testing.assert_array_equal(
+            tracks[:, 3], np.maximum(below_tracks[pairs[:, 0], 3],
+                                     below_tracks[pairs[:, 1], 3]))
+
+
+def test_labeled_track_marks_any_label(pyramid):
+    pyr, sf, _ = pyramid
+    mean, maximum, tracks = pyr._level(pyr.levels - 1)
+    scale = 2 ** (pyr.levels - 1)
+
+    expected = [np.any(sf.classification[c * scale:(c + 1) * scale] != 0)
+                for c in range(tracks.shape[0])]
+    np.testing.assert_array_equal(tracks[:, 3], expected)
+    assert set(np.unique(tracks[:, 3])) == set([0, 1])
+
+
+@pytest.mark.parametrize('width_px', [1, 7, 64, 100, 333, 1000, 4000])
+@pytest.mark.parametrize('t0, t1', [(0, 50), (3.33, 41.7), (10, 20)])
+def test_query_picks_level_by_width(pyramid, width_px, t0, t1):
+    pyr, sf, _ = pyramid
+    result = pyr.query(t0, t1, 1000, 5000, width_px)
+
+    columns = result['mean'].shape[1]
+    frames = np.count_nonzero((sf.time >= t0) & (sf.time <= t1))
+    if frames < width_px:
+        assert result['level'] == 0
+    elif result['level'] < pyr.levels - 1:
+        assert width_px <= columns < 2 * width_px
+    else:
+        assert columns >= width_px
+
+    assert result['max'].shape == result['mean'].shape
+    assert result['mean'].shape[0] == result['freq'].size
+    assert np.all((result['freq'] >= 1000) & (result['freq'] <= 5000))
+    for key in ('time', 'power', 'power_max', 'entropy', 'labeled'):
+        assert result[key].shape == (columns,)
+    assert result['time'][0] <= t0 < result['time'][0] + \
+        0.01 * 2 ** result['level']
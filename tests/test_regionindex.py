@@ -0,0 +1,93 @@
+"""
+Tests of recording times and the region index
+"""
+import logging
+import os
+import time
+
+import numpy as np
+import scipy.io.wavfile
+
+from audioanalysis.blockaudio import BlockAudioFile
+from audioanalysis.freqanalysis import SongFile
+from audioanalysis.regionindex import RegionIndex
+
+
+FS = 8000
+
+
+def write_wav(tmpdir, name='20150601_063000.wav'):
+    samples = (np.random.RandomState(0).randn(FS * 3) * 3000).astype(np.int16)
+    path = str(tmpdir.join(name))
+    scipy.io.wavfile.write(path, FS, samples)
+    return path
+
+
+def parse_name(filename):
+    """POSIX seconds from a YYYYmmdd_HHMMSS file name"""
+    stamp = os.path.splitext(os.path.basename(filename))[0]
+    return time.mktime(time.strptime(stamp, '%Y%m%d_%H%M%S'))
+
+
+def test_recorded_is_not_guessed(tmpdir):
+    path = write_wav(tmpdir)
+    for sf in SongFile.load(path, split=1):
+        assert sf.recorded is None
+
+
+def test_recorded_argument(tmpdir):
+    path = write_wav(tmpdir)
+
+    sfs = SongFile.load(path, split=1, recorded=1.4e9)
+    assert [sf.recorded for sf in sfs] == [1.4e9] * 3
+
+    sfs = SongFile.load(path, split=1, recorded=parse_name)
+    assert sfs[0].recorded == parse_name(path)
+    assert time.localtime(sfs[0].recorded).tm_hour == 6
+
+    assert SongFile.load(path, recorded=lambda f: None)[0].recorded is None
+
+
+def test_recorded_from_block_header(tmpdir):
+    wav = write_wav(tmpdir)
+    block = str(tmpdir.join('song' + BlockAudioFile.EXTENSION))
+    BlockAudioFile.from_wav(wav, block, block_size=1000, recorded=1.5e9)
+
+    assert SongFile.load(block)[0].recorded == 1.5e9
+    assert SongFile.load_range(block, 1, 2).recorded == 1.5e9
+    assert SongFile.load_range(block, 1, 2, recorded=7.0).recorded == 7.0
+
+
+def classified_song(recorded):
+    sf = SongFile(np.zeros(FS, dtype=np.int16), float(FS), name='song',
+                  start=10, scale=1.0)
+    sf.source = '/data/song.wav'
+    sf.recorded = recorded
+    sf.time = np.arange(100) * 0.01
+    sf.power = np.ones(100)
+    sf.entropy = np.full(100, 0.5)
+    labels = np.zeros(100)
+    labels[20:40] = 1
+    labels[60:65] = 2
+    sf.classification = labels
+    return sf
+
+
+def test_index_absolute_times(tmpdir):
+    with RegionIndex(str(tmpdir.join('regions.db'))) as index:
+        assert index.add_song(classified_song(1.4e9)) == 2
+
+        rows = index.query(start=1.4e9 + 10.3, end=1.4e9 + 10.5)
+        assert [r['label'] for r in rows] == [1]
+        assert abs(rows[0]['start'] - (1.4e9 + 10.2)) < 1e-6
+        assert abs(rows[0]['duration'] - 0.2) < 1e-6
+
+
+def test_index_warns_without_recording_time(tmpdir, caplog):
+    with RegionIndex(str(tmpdir.join('regions.db'))) as index:
+        with caplog.at_level(logging.WARNING, logger='JLAA.RegionIndex'):
+            index.add_song(classified_song(None))
+
+        assert any('no recording time' in r.getMessage()
+                   for r in caplog.records)
+        assert index.query(label=2)[0]['start'] == 10.6
@@ -0,0 +1,176 @@
+"""
+Tests of run-length encoded label tracks against dense arrays
+"""
+import pickle
+
+import numpy as np
+import pytest
+
+from audioanalysis.freqanalysis import SongFile
+from audioanalysis.runs import LabelRuns
+
+
+def random_track(n, seed, classes=3, mean_run=20):
+    """A dense label track of n frames with runs of random length"""
+    rng = np.random.RandomState(seed)
+    labels = []
+    while len(labels) < n:
+        labels.extend([rng.randint(classes)] * (1 + rng.poisson(mean_run)))
+    return np.array(labels[0:n], dtype=np.float64)
+
+
+def dense_regions(labels):
+    """The non-zero regions found by the original dense scan
+
+    A region still open at the end of the track is not returned.
+    """
+    regions = []
+    noise = True
+    for idx, val in enumerate(labels):
+        if val != 0 and noise:
+            start = idx
+            noise = False
+
+        if val == 0 and not noise:
+            noise = True
+            regions.append((start, idx))
+
+    return regions
+
+
+TRACKS = [random_track(1000, seed) for seed in range(6)] + [
+    np.zeros(10), np.ones(10), np.array([0, 1, 1, 0, 2]),
+    np.array([2.0]), np.zeros(0)]
+
+
+@pytest.mark.parametrize('labels', TRACKS)
+def test_round_trip(labels):
+    runs = LabelRuns.from_dense(labels)
+    assert len(runs) == labels.size
+    np.testing.assert_array_equal(runs.to_dense(), labels)
+    assert runs.to_dense().dtype == labels.dtype
+
+    if labels.size:
+        # runs are maximal
+        assert np.all(runs.values[1:] != runs.values[:-1])
+
+
+@pytest.mark.parametrize('labels', TRACKS[0:6])
+def test_at(labels):
+    runs = LabelRuns.from_dense(labels)
+    idx = np.random.RandomState(0).randint(0, labels.size, 200)
+    np.testing.assert_array_equal(runs.at(idx), labels[idx])
+    assert runs.at(labels.size - 1) == labels[-1]
+
+    with pytest.raises(IndexError):
+        runs.at(labels.size)
+    with pytest.raises(IndexError):
+        runs.at(-1)
+
+
+@pytest.mark.parametrize('labels', TRACKS[0:6])
+def test_slice(labels):
+    runs = LabelRuns.from_dense(labels)
+    for first, last in [(0, labels.size), (13, 14), (100, 537), (990, 2000),
+                        (-5, 30), (500, 500), (700, 600)]:
+        expected = labels[max(0, first):max(0, last)]
+        np.testing.assert_array_equal(runs.slice(first, last).to_dense(),
+                                      expected)
+
+
+@pytest.mark.parametrize('labels', TRACKS[0:6] + [np.zeros(0)])
+@pytest.mark.parametrize('left,right', [(0, 0), (3, 0), (0, 4), (5, 6)])
+def test_pad(labels, left, right):
+    padded = LabelRuns.from_dense(labels).pad(left, right)
+    expected = np.concatenate((np.zeros(left), labels, np.zeros(right)))
+    np.testing.assert_array_equal(padded.to_dense(), expected)
+    assert np.all(padded.values[1:] != padded.values[:-1])
+
+
+@pytest.mark.parametrize('labels', TRACKS)
+def test_regions(labels):
+    starts, stops = LabelRuns.from_dense(labels).regions()
+    regions = list(zip(starts.tolist(), stops.tolist()))
+
+    closed = dense_regions(labels)
+    if labels.size and labels[-1] != 0:
+        # the open region runs to the end of the track
+        assert regions[-1][1] == labels.size
+        assert regions[:-1] == closed
+        assert labels[regions[-1][0]:].all()
+    else:
+        assert regions == closed
+
+
+def test_pickle_round_trip():
+    labels = random_track(500, 3)
+    sf = SongFile(np.zeros(100, dtype=np.int16), 1000.0)
+    sf.classification = labels
+
+    restored = pickle.loads(pickle.dumps(sf, protocol=2))
+    assert isinstance(restored.classification_runs, LabelRuns)
+    np.testing.assert_array_equal(restored.classification, labels)
+
+
+def dense_find_motifs(labels, time, min_density=0.80, min_dense_time=0.5,
+                      join_gap=1.0):
+    """The (start, stop) times of the motifs found by the original dense
+    implementation of find_motifs"""
+    regions = [(time[a], time[b], 1.0) for a, b in dense_regions(labels)]
+
+    idx = 0
+    while idx < len(regions) - 1:
+        left, right = regions[idx], regions[idx + 1]
+        prop = (left[2] * (left[1] - left[0]) + right[2]
+                * (right[1] - right[0])) / (right[1] - left[0])
+        if prop > min_density and right[0] - left[1] < join_gap:
+            regions = regions[:idx] + [(left[0], right[1], prop)] + \
+                regions[idx + 2:]
+            idx = 0
+            continue
+        idx += 1
+
+    idx = len(regions) - 1
+    final_regions = []
+    while idx > 0:
+        r = (regions[idx][0], regions[idx][1])
+        if r[1] - r[0] < min_dense_time:
+            idx -= 1
+        else:
+            j = 1
+            preceding = regions[idx - j]
+            while r[0] - preceding[1] <= join_gap and idx - j >= 0:
+                r = (preceding[0], r[1])
+                j += 1
+                preceding = regions[idx - j]
+            final_regions.append(r)
+            idx = idx - j
+
+    return [(r[0] - 1.0, r[1] + 1.0) for r in reversed(final_regions)]
+
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('open_end', [False, True])
+def test_find_motifs_matches_dense(seed, open_end):
+    Fs = 1000.0
+    frames = 20000
+    time = np.arange(frames) * 0.002
+
+    # sparse song regions over silence
+    labels = random_track(frames, seed, classes=2, mean_run=300)
+    labels[labels.size // 2:labels.size // 2 + 900] = 1
+    labels[-50:] = 1 if open_end else 0
+
+    sf = SongFile(np.zeros(int(time[-1] * Fs) + 1, dtype=np.int16), Fs,
+                  name='song')
+    sf.time = time
+    sf.classification = labels
+
+    motifs = sf.find_motifs()
+    expected = dense_find_motifs(labels, time)
+
+    assert len(motifs) == len(expected) > 0
+    for m, (t0, t1) in zip(motifs, expected):
+        first, last = np.searchsorted(time, [t0, t1])
+        assert m.start == time[first]
+        np.testing.assert_array_equal(m.classification, labels[first:last])
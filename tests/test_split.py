@@ -0,0 +1,112 @@
+"""
+Tests of splitting recordings into sections
+"""
+import logging
+
+import numpy as np
+import pytest
+import scipy.io.wavfile
+
+from audioanalysis.freqanalysis import SongFile
+
+
+FS = 8000
+
+# song bouts, in seconds
+BOUTS = [(8.0, 12.2), (17.0, 19.6), (20.4, 23.0), (28.0, 33.0)]
+
+
+def recording(tmpdir, seconds=40, channels=1):
+    rng = np.random.RandomState(0)
+    t = np.arange(FS * seconds) / float(FS)
+    x = 0.01 * rng.randn(t.size)
+    for start, stop in BOUTS:
+        bout = (t >= start) & (t < stop)
+        x[bout] += 0.3 * np.sin(2 * np.pi * 2000 * t[bout])
+
+    samples = (x * 30000).astype(np.int16)
+    if channels > 1:
+        # song only on the last channel
+        quiet = (0.01 * rng.randn(t.size, channels - 1) * 30000)
+        samples = np.column_stack((quiet.astype(np.int16), samples))
+
+    path = str(tmpdir.join('bouts.wav'))
+    scipy.io.wavfile.write(path, FS, samples)
+    return path
+
+
+def cuts(sfs):
+    return [sf.start for sf in sfs[1:]]
+
+
+def in_song(t, margin=0.01):
+    return any(start - margin < t < stop + margin for start, stop in BOUTS)
+
+
+def test_fixed_cuts(tmpdir):
+    sfs = SongFile.load(recording(tmpdir), split=10)
+    assert cuts(sfs) == [10, 20, 30]
+
+
+@pytest.mark.parametrize('tolerance', [0.5, 1.0, 2.5, 5.0])
+def test_silence_cuts_land_in_gaps(tmpdir, caplog, tolerance):
+    with caplog.at_level(logging.WARNING, logger='JLAA.SongFile'):
+        sfs = SongFile.load(recording(tmpdir), split=10,
+                            split_mode='silence', split_tolerance=tolerance)
+
+    warned = [r.getMessage() for r in caplog.records
+              if 'No quiet gap' in r.getMessage()]
+    assert sum(sf.samples.shape[0] for sf in sfs) == 40 * FS
+
+    # each cut is sought split seconds after the one before
+    for sf, cut in zip(sfs, cuts(sfs)):
+        nominal = sf.start + 10
+        assert abs(cut - nominal) <= tolerance
+        message = '{0:g} seconds;'.format(nominal)
+        if in_song(cut):
+            # no gap in reach: the cut stays put and says so
+            assert cut == nominal
+            assert any(message in m for m in warned)
+        else:
+            assert not any(message in m for m in warned)
+
+    if tolerance == 0.5:
+        assert cuts(sfs)[0] == 10
+        assert 19.6 < cuts(sfs)[1] < 20.4
+        assert len(warned) == 2
+    if tolerance >= 2.5:
+        assert not warned
+        assert not any(in_song(cut) for cut in cuts(sfs))
+
+
+def test_silence_in_selected_channels(tmpdir):
+    path = recording(tmpdir, channels=3)
+
+    song = SongFile.load(path, split=10, split_mode='silence',
+                         split_tolerance=2.5, channels=2)
+    assert not any(in_song(cut) for cut in cuts(song))
+
+    both = SongFile.load(path, split=10, split_mode='silence',
+                         split_tolerance=2.5, channels=[0, 2])
+    assert cuts(both) == cuts(song)
+    assert both[0].samples.shape[1] == 2
+
+
+def test_envelope_streams_in_chunks():
+    rng = np.random.RandomState(1)
+    data = (rng.randn(10007, 2) * 1000).astype(np.int16)
+
+    energy = SongFile._envelope(data, 80, channels=None, chunk_blocks=7)
+    expected = np.mean(np.square(data[0:125 * 80].astype(np.float64)
+                                 .reshape(125, -1)), axis=1)
+    np.testing.assert_allclose(energy, expected)
+
+    energy = SongFile._envelope(data, 80, channels=1, chunk_blocks=7)
+    expected = np.mean(np.square(data[0:125 * 80, 1].astype(np.float64)
+                                 .reshape(125, -1)), axis=1)
+    np.testing.assert_allclose(energy, expected)
+
+
+def test_unknown_split_mode(tmpdir):
+    with pytest.raises(ValueError):
+        SongFile.load(recording(tmpdir), split=10, split_mode='quiet')
@@ -0,0 +1,98 @@
+"""
+Tests of the parameter sweep runner
+"""
+import copy
+
+import numpy as np
+import pytest
+
+from audioanalysis.freqanalysis import AudioAnalyzer, SongFile
+from audioanalysis.sweep import ParameterSweep, score
+
+
+FS = 22050.0
+
+
+class LoudnessClassifier(object):
+    """Calls a sample song when its mean scaled log power is high"""
+
+    def predict_proba(self, X, batch_size=None, verbose=0):
+        level = np.mean(X.reshape(X.shape[0], -1), axis=1)
+        p = 1 / (1 + np.exp(-20 * (level - 0.5)))
+        return np.stack([1 - p, p], axis=1)
+
+
+def labeled_song():
+    rng = np.random.RandomState(0)
+    t = np.arange(int(FS * 2)) / FS
+    gate = np.sin(2 * np.pi * t) > 0
+    x = gate * np.sin(2 * np.pi * 2500 * t) + 0.01 * rng.randn(t.size)
+    sf = SongFile((x * 20000).astype(np.int16), FS, name='song', scale=5e-5)
+
+    analyzer = AudioAnalyzer()
+    analyzer.process(sf)
+    sf.classification = (np.sin(2 * np.pi * sf.time) > 0).astype(np.float64)
+    return sf
+
+
+def direct(sf, params):
+    """Score one configuration by running the whole pipeline"""
+    analyzer = AudioAnalyzer(**params)
+    analyzer.classifier = LoudnessClassifier()
+
+    song = copy.copy(sf)
+    song.classification_runs = None
+    analyzer.set_active(song)
+    classes = analyzer.postprocess(analyzer.predict_active(), song)
+
+    return score(classes, sf.label_at(song.time))
+
+
+GRID = {
+    'min_freq': [300, 1000],
+    'fft_time_step_ms': [2, 4],
+    'medfilt_time': [0.01, 0.05],
+}
+
+
+@pytest.mark.parametrize('budget', [None, 4e6, 1e9])
+def test_sweep_matches_direct_runs(budget):
+    sf = labeled_song()
+    defaults = {} if budget is None else {'memory_budget': budget}
+
+    analyzer = AudioAnalyzer(**defaults)
+    analyzer.classifier = LoudnessClassifier()
+    sweep = ParameterSweep(analyzer, GRID)
+
+    rows = sweep.run([sf], processes=2)
+    assert len(rows) == 8
+
+    configs = list(sweep.configs())
+    for row in rows:
+        params = [params for point, params in configs
+                  if all(row[k] == v for k, v in point.items())]
+        assert len(params) == 1
+        expected = direct(sf, params[0])
+        for metric in ('frames', 'accuracy', 'precision', 'recall', 'f1'):
+            assert row[metric] == pytest.approx(expected[metric])
+
+
+def test_keep_filtered_respects_budget():
+    sf = labeled_song()
+    sweep = ParameterSweep(AudioAnalyzer(), GRID)
+    groups = sweep._group(list(sweep.configs()), 2)[0:2]
+
+    assert sweep._keep_filtered(sf, groups)
+    assert not sweep._keep_filtered(sf, groups[0:1])
+
+    for group in groups:
+        for _, params in group:
+            params['memory_budget'] = 4e6
+    assert not sweep._keep_filtered(sf, groups)
+
+
+@pytest.mark.parametrize('name', ['process_chunk_s', 'batch_size',
+                                  'inference_chunk', 'unknown'])
+def test_unsweepable_parameters(name):
+    with pytest.raises(ValueError):
+        ParameterSweep(AudioAnalyzer(), {name: [1, 2]})